@@ -3,7 +3,7 @@ from envs.env_fn import env_fn
 from envs.confidence_wrapper import ConfidenceWrapper
 from envs.utils import Config, Loader
 from custom_feature_extractor import CustomFeaturesExtractor
-from callbacks import LoggingCallback, SaveCacheCallback
+from callbacks import LoggingCallback, SaveCacheCallback, PrefetchCallback
 from stable_baselines3 import A2C
 from stable_baselines3.common.callbacks import CheckpointCallback, EvalCallback, StopTrainingOnNoModelImprovement, CallbackList
 from stable_baselines3.common.monitor import Monitor
@@ -123,7 +123,10 @@ def main():
     )
     """
     #callback = CallbackList([checkpoint_callback, logs_callback, eval_callback])
-    callback = CallbackList([checkpoint_callback, logs_callback, cache_callback])
+    callbacks = [checkpoint_callback, logs_callback, cache_callback]
+    if config.get_env_values('use_prefetch'):
+        callbacks.append(PrefetchCallback())
+    callback = CallbackList(callbacks)
     
     # Create a dictionary with policy parameters.
     policy_kwargs = dict(
@@ -1,7 +1,9 @@
 from stable_baselines3.common.callbacks import BaseCallback
+import torch as th
 from envs.env_fn import env_fn
 from envs.confidence_wrapper import ConfidenceWrapper
 from envs.logger import TrajectoryLogger
+from envs.simulator import PRIORITY_RENDER
 import imageio
 import os
 import numpy as np
@@ -67,7 +69,7 @@ class LoggingCallback(BaseCallback):
                 )
                 
                 # Initialize an env for the gif creation.
-                eval_env = env_fn(eval_trajectory_logger, self.config_file)
+                eval_env = env_fn(eval_trajectory_logger, self.config_file, priority=PRIORITY_RENDER)
                 if self.use_confidence:
                     eval_env = ConfidenceWrapper(eval_env, self.conf_reward_params)
                 
@@ -226,7 +228,9 @@ class LoggingCallback(BaseCallback):
 class SaveCacheCallback(BaseCallback):
     """
     SaveCacheCallback:
-    _on_training_end: Save cache memory to a file when training is over.
+    _on_training_end: Save cache memory to a file when training is over,
+        and the RF cache (see PhantomUsEnv's 'use_rf_cache') if it is used
+        (see PhantomUsEnv.save_cache).
     
     :param exp_dir: experiment's directory.
     """
@@ -249,7 +253,33 @@ class SaveCacheCallback(BaseCallback):
         """               
         
     def _on_training_end(self):
-        cache = self.training_env.envs[0].cache
-        np.savez(os.path.join(self.exp_dir, 'cache_memory.npz'), **cache)
+        self.training_env.envs[0].save_cache(self.exp_dir)
         
 
+class PrefetchCallback(BaseCallback):
+    """
+    PrefetchCallback:
+    _on_training_start: stop the training envs from prefetching after each
+        step, so every neighbour state is submitted once, by this callback.
+    _on_step: prioritize the prefetched neighbour states of the training
+        envs by the policy's action probabilities in the new observations,
+        so the states the agent will most likely visit are simulated first.
+    _on_training_end: the training envs prefetch after each step again.
+    """
+    def _on_training_start(self):
+        for env in self.training_env.envs:
+            # The wrappers (e.g. Monitor) do not pass attributes set on them.
+            env.unwrapped.prefetch_on_step = False
+
+    def _on_step(self) -> bool:
+        obs_tensor, _ = self.model.policy.obs_to_tensor(self.locals['new_obs'])
+        with th.no_grad():
+            distribution = self.model.policy.get_distribution(obs_tensor)
+            probs = distribution.distribution.probs.cpu().numpy()
+        for env, action_probabilities in zip(self.training_env.envs, probs):
+            env.prefetch_neighbours(action_probabilities=action_probabilities)
+        return True
+
+    def _on_training_end(self):
+        for env in self.training_env.envs:
+            env.unwrapped.prefetch_on_step = True
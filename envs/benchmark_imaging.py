@@ -0,0 +1,115 @@
+import argparse
+import time
+import numpy as np
+from scipy import signal, interpolate
+from envs.env_fn import simulator_fn, probe_fn, phantom_fn, imaging_fn
+from envs.utils import Config
+
+
+def _time(fn, *args, repeat=1):
+    """
+    :return: result of fn call and the mean time of a call [s].
+    """
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn(*args)
+    return result, (time.perf_counter() - start)/repeat
+
+
+def _reference_image(imaging, rf):
+    """
+    B-mode image as computed before the imaging steps were optimized: exact
+    length Hilbert transform, a new bicubic spline per frame (FITPACK, the
+    same as interp2d) and signal.medfilt.
+    """
+    data = np.abs(signal.hilbert(rf[::imaging.dec, :], axis=0))
+    data = imaging._adjust_dynamic_range(data, dr=imaging.dr_threshold)
+    input_xs = np.arange(0, data.shape[1])*(imaging.image_width/data.shape[1])
+    input_zs = np.arange(0, data.shape[0])*(imaging.c/(2*imaging.fs))
+    output_xs = np.arange(imaging.image_width, step=imaging.image_width/imaging.image_resolution[0])
+    output_zs = np.arange(imaging.image_height, step=imaging.image_height/imaging.image_resolution[1])
+    data = interpolate.RectBivariateSpline(input_zs, input_xs, data)(
+        np.clip(output_zs, input_zs[0], input_zs[-1]), np.clip(output_xs, input_xs[0], input_xs[-1]))
+    data = signal.medfilt(data, kernel_size=imaging.median_filter_size)
+    data = data-data.min()
+    return data/data.max()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the time of imaging a frame, next to the time of simulating it.")
+    parser.add_argument("--config_path", dest="config_path", type=str,
+                        help="Path of the configurations file",
+                        required=True)
+    parser.add_argument("--backend", dest="backend", type=str, default="numpy",
+                        help="Simulator backend ('field2', 'numpy' or 'server')")
+    parser.add_argument("--frames", dest="frames", type=int, default=8,
+                        help="Number of simulated frames (probe poses)")
+    parser.add_argument("--repeat", dest="repeat", type=int, default=5,
+                        help="Number of times each frame is imaged")
+    args = parser.parse_args()
+
+    config = Config(args.config_path)
+    imaging = imaging_fn(config)
+    phantom = phantom_fn(config)
+    probe = probe_fn(config)
+    simulator = simulator_fn(config, backend=args.backend, attach=False)
+    try:
+        rf_arrays, sim_times = [], []
+        for x in np.linspace(-5e-3, 5e-3, args.frames):
+            points, amps, _ = probe.translate(np.array([x, 0, 0])).get_fov(phantom)
+            (rf_array, _), sim_time = _time(
+                simulator.simulate_linear_array, points, amps, imaging.fs,
+                imaging.no_lines, probe.focal_depth, imaging.image_width)
+            rf_arrays.append(np.array(rf_array))
+            sim_times.append(sim_time)
+    finally:
+        simulator.close()
+
+    iq = np.iscomplexobj(rf_arrays[0])
+    image = imaging.image_iq if iq else imaging.image
+    # Interpolation matrices of the frame's shape are computed once.
+    image(rf_arrays[0])
+    steps = {"envelope": [], "compression": [], "interpolation": [], "filter, normalize": []}
+    image_times, reference_times, differences = [], [], []
+    for rf_array in rf_arrays:
+        bmode, image_time = _time(image, rf_array, repeat=args.repeat)
+        image_times.append(image_time)
+        if iq:
+            envelope, envelope_time = _time(lambda data: np.abs(data).astype(np.float64), rf_array)
+            fs = imaging.fs/imaging.iq_decimation
+        else:
+            envelope, envelope_time = _time(imaging._detect_envelope, rf_array[::imaging.dec, :])
+            fs = imaging.fs
+            reference, reference_time = _time(_reference_image, imaging, rf_array)
+            reference_times.append(reference_time)
+            differences.append(np.abs(bmode - reference).mean())
+        steps["envelope"].append(envelope_time)
+        compressed, compression_time = _time(imaging._adjust_dynamic_range, envelope, imaging.dr_threshold)
+        steps["compression"].append(compression_time)
+        interpolated, interp_time = _time(imaging._interp, compressed, fs)
+        steps["interpolation"].append(interp_time)
+        # Interpolation, median filter and normalization.
+        _, rest_time = _time(imaging._image_compressed, compressed, fs)
+        steps["filter, normalize"].append(max(rest_time - interp_time, 0))
+    batch_time = None
+    # Frames of different lengths (not gated) are not stacked.
+    if len(set(rf_array.shape for rf_array in rf_arrays)) == 1:
+        _, batch_time = _time(imaging.image_batch, np.stack(rf_arrays))
+
+    print("Frame: %s %s, %d frames, %s backend." % (
+        rf_arrays[0].shape, rf_arrays[0].dtype, len(rf_arrays), args.backend))
+    print("Simulation:        %8.1f ms/frame" % (1e3*np.mean(sim_times)))
+    print("Imaging:           %8.1f ms/frame (%.1f%% of simulation)" % (
+        1e3*np.mean(image_times), 100*np.mean(image_times)/np.mean(sim_times)))
+    for step, times in steps.items():
+        print("  %-16s %8.1f ms" % (step, 1e3*np.mean(times)))
+    if batch_time is not None:
+        print("Batched imaging:   %8.1f ms/frame" % (1e3*batch_time/len(rf_arrays)))
+    if reference_times:
+        print("Reference imaging: %8.1f ms/frame (mean abs. difference of the images: %.2g)" % (
+            1e3*np.mean(reference_times), np.mean(differences)))
+
+
+if __name__ == '__main__':
+    main()
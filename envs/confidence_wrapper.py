@@ -36,9 +36,12 @@ class ConfidenceWrapper(gym.Wrapper):
         self.conf_reward_params = conf_reward_params,
         # A list of 2 arrays which consists of the current and previous
         #   confidence map.
+        # Confidence maps are in [0, 1], also for uint8 observations.
+        maps_dtype = self.env.observation_space.dtype if self.env.imaging.is_float() else np.float32
         self.confidence_maps = np.ndarray(shape=(2,
                                             self.env.imaging.image_resolution[1],
-                                            self.env.imaging.image_resolution[0],))
+                                            self.env.imaging.image_resolution[0],),
+                                          dtype=maps_dtype)
         atexit.register(self._cleanup)
         self._start_sessions()
             
@@ -161,7 +164,10 @@ class ConfidenceWrapper(gym.Wrapper):
         """
         self._assert_workers_exists()
         
-        # Save the bmode observation in order to load it from matlab script.
+        # Save the bmode observation in order to load it from matlab script,
+        # with values in [0, 1].
+        if not self.env.imaging.is_float():
+            bmode = bmode/255
         np.savetxt(os.path.join(self.working_dir.name, 'bmode.csv'), bmode.squeeze(), delimiter=",")
         
         # Create "go" file
@@ -180,7 +186,7 @@ class ConfidenceWrapper(gym.Wrapper):
         conf_file = os.path.join(self.working_dir.name, 'confidence_map.csv')
         
         # Load the confidence map from the file saved from matlab script.
-        conf_map = np.genfromtxt(conf_file, delimiter=',')
+        conf_map = np.genfromtxt(conf_file, delimiter=',', dtype=self.confidence_maps.dtype)
 
         # Cleanup.
         os.remove(conf_file)
@@ -2,34 +2,135 @@ from envs.imaging import Probe, ImagingSystem
 from envs.phantom import Teddy, ScatterersPhantom
 from envs.generator import RandomProbeGenerator, ConstProbeGenerator, ConstPhantomGenerator
 from envs.us_env import PhantomUsEnv
+from envs.fieldii import Field2, start_matlab_worker
+from envs.python_worker import start_python_worker
+from envs.simulator import FarFieldSimulator, PRIORITY_TRAIN
+from envs.sim_client import SimulationClient, DEFAULT_SERVER_ADDRESS
 from envs.focal_point_task_us_env import FocalPointTaskUsEnv
 from envs.plane_task_us_env import PlaneTaskUsEnv
 from envs.utils import Config
 import numpy as np
+from functools import partial
 
-def env_fn(trajectory_logger, config_file):
+def depth_gate_fn(config):
     """
-    env_fn: Function the creates an enviroment based on the
+    depth_gate_fn: The simulators' depth gate, from 'min_depth' to the
+    'image_height' of the displayed image, or None if 'depth_gate' is off.
+    The gate changes the B-mode images at low 'dr_threshold' values (see
+    Simulator), so it is off by default.
+
+    :param config: Config object.
+    """
+    if not config.get_imaging_values('depth_gate'):
+        return None
+    return (config.get_imaging_values('min_depth'), config.get_imaging_values('image_height'))
+
+def server_address_fn(config):
+    """
+    server_address_fn: Socket of the simulation server, 'address' in the
+    'config.json', or the default one in the current user's runtime
+    directory if it is null.
+
+    :param config: Config object.
+    """
+    address = config.get_simulator_values('address')
+    return DEFAULT_SERVER_ADDRESS if address is None else address
+
+def start_worker_fn(config):
+    """
+    start_worker_fn: Function which starts the Field2 workers, MATLAB ones
+    or their Python stand-ins (see 'envs/python_worker.py'), as given by
+    'worker' in the 'config.json'.
+
+    :param config: Config object.
+    """
+    worker = config.get_simulator_values('worker')
+    if worker == 'matlab':
+        return start_matlab_worker
+    elif worker == 'python':
+        return partial(start_python_worker, **config.get_simulator_values('python_worker'))
+    else:
+        raise ValueError('Unknown Field2 worker "%s".' % worker)
+
+def simulator_fn(config, backend=None, priority=PRIORITY_TRAIN, attach=True):
+    """
+    simulator_fn: Function that creates the RF data simulator based on the
     values given in the 'config.json'.
 
-    :param trajectory_logger: Trajectory Logger object.
-    :param config_file: Path of the configurations file.
-    """        
-    config = Config(config_file)
-    
-    probe = Probe(
+    :param config: Config object.
+    :param backend: 'field2', 'numpy' or 'server', the configured backend
+        if None.
+    :param priority: priority of the simulator's requests, on a simulation
+        server ('server' backend, or an attached Field2) or in the Field2
+        session.
+    :param attach: whether Field2 attaches to the simulation server, if it
+        is running ('field2' backend only).
+    """
+    if backend is None:
+        backend = config.get_simulator_values('backend')
+    if backend == 'field2':
+        return Field2(
+            no_workers=config.get_env_values('no_workers'),
+            ipc=config.get_simulator_values('ipc'),
+            lines_per_shard=config.get_simulator_values('lines_per_shard'),
+            speculation_factor=config.get_simulator_values('speculation_factor'),
+            transport=config.get_simulator_values('transport'),
+            min_workers=config.get_simulator_values('min_workers'),
+            max_workers=config.get_simulator_values('max_workers'),
+            spare_workers=config.get_simulator_values('spare_workers'),
+            idle_timeout=config.get_simulator_values('idle_timeout'),
+            max_queue_time=config.get_simulator_values('max_queue_time'),
+            server_address=server_address_fn(config) if attach else None,
+            remote_workers=config.get_simulator_values('remote_workers'),
+            remote_authkey=config.get_simulator_values('remote_authkey'),
+            iq_decimation=config.get_imaging_values('iq_decimation'),
+            depth_gate=depth_gate_fn(config),
+            max_retries=config.get_simulator_values('max_retries'),
+            start_worker=start_worker_fn(config),
+            priority=priority
+        )
+    elif backend == 'numpy':
+        return FarFieldSimulator(
+            c=config.get_imaging_values('c'),
+            iq_decimation=config.get_imaging_values('iq_decimation'),
+            depth_gate=depth_gate_fn(config))
+    elif backend == 'server':
+        return SimulationClient(
+            address=server_address_fn(config),
+            priority=priority
+        )
+    else:
+        raise ValueError('Unknown simulator backend "%s".' % backend)
+
+def probe_fn(config):
+    """
+    probe_fn: Function that creates the reference probe based on the
+    values given in the 'config.json'.
+
+    :param config: Config object.
+    """
+    return Probe(
         pos = np.array(config.get_probe_values('pos')),
         angle = config.get_probe_values('angle'),
         width = config.get_probe_values('width'),
         height = config.get_probe_values('height'),
         focal_depth = config.get_probe_values('focal_depth')
     )
+
+
+def phantom_fn(config):
+    """
+    phantom_fn: Function that creates the phantom (with the teddy as its
+    only object) based on the values given in the 'config.json'.
+
+    :param config: Config object.
+    """
     teddy = Teddy(
         belly_pos = np.array(config.get_teddy_values('belly_pos')),
         scale = config.get_teddy_values('scale'),
         head_offset = config.get_teddy_values('head_offset')
     )
-    phantom = ScatterersPhantom(
+    return ScatterersPhantom(
         objects=[teddy],
         x_border = config.get_scatters_values('x_border'),
         y_border = config.get_scatters_values('y_border'),
@@ -37,7 +138,16 @@ def env_fn(trajectory_logger, config_file):
         n_scatterers = int(config.get_scatters_values('n_scatterers')),
         n_bck_scatterers = int(config.get_scatters_values('n_bck_scatterers'))
     )
-    imaging = ImagingSystem(
+
+
+def imaging_fn(config):
+    """
+    imaging_fn: Function that creates the imaging system based on the
+    values given in the 'config.json'.
+
+    :param config: Config object.
+    """
+    return ImagingSystem(
         c = config.get_imaging_values('c'),
         fs = config.get_imaging_values('fs'),
         image_width = config.get_imaging_values('image_width'),
@@ -46,8 +156,29 @@ def env_fn(trajectory_logger, config_file):
         median_filter_size = config.get_imaging_values('median_filter_size'),
         dr_threshold = config.get_imaging_values('dr_threshold'),
         dec = config.get_imaging_values('dec'),
-        no_lines = config.get_imaging_values('no_lines')
+        no_lines = config.get_imaging_values('no_lines'),
+        iq_decimation = config.get_imaging_values('iq_decimation'),
+        dtype = config.get_imaging_values('dtype')
     )
+
+
+def env_fn(trajectory_logger, config_file, priority=PRIORITY_TRAIN):
+    """
+    env_fn: Function the creates an enviroment based on the
+    values given in the 'config.json'.
+
+    :param trajectory_logger: Trajectory Logger object.
+    :param config_file: Path of the configurations file.
+    :param priority: priority of the environment's simulation requests,
+        e.g. PRIORITY_EVAL for an evaluation environment (used with a
+        simulation server).
+    """        
+    config = Config(config_file)
+    
+    probe = probe_fn(config)
+    phantom = phantom_fn(config)
+    teddy = phantom.objects[0]
+    imaging = imaging_fn(config)
     if config.get_generator_values('random'):
         x_values = config.get_generator_values('x_pos')
         y_values = config.get_generator_values('y_pos')
@@ -65,6 +196,8 @@ def env_fn(trajectory_logger, config_file):
     else:
         probe_generator = ConstProbeGenerator(probe)
     
+    simulator = simulator_fn(config, priority=priority)
+
     env_task = {
         'us_env': PhantomUsEnv,
         'focal': FocalPointTaskUsEnv,
@@ -90,6 +223,16 @@ def env_fn(trajectory_logger, config_file):
         steps_tolerance = config.get_env_values('steps_tolerance'),
         noise_prob = config.get_env_values('noise_prob'),
         max_probe_dislocation = config.get_env_values('max_probe_dislocation'),
-        noise_seed = config.get_env_values('noise_seed')
+        noise_seed = config.get_env_values('noise_seed'),
+        simulator = simulator,
+        use_prefetch = config.get_env_values('use_prefetch'),
+        use_resident_phantom = config.get_env_values('use_resident_phantom'),
+        use_streaming = config.get_env_values('use_streaming'),
+        use_synthetic_aperture = config.get_env_values('use_synthetic_aperture'),
+        channel_cache_size = config.get_env_values('channel_cache_size'),
+        use_scanline_cache = config.get_env_values('use_scanline_cache'),
+        scanline_cache_size = config.get_env_values('scanline_cache_size'),
+        scanline_elevation_spacing = config.get_env_values('scanline_elevation_spacing'),
+        use_rf_cache = config.get_env_values('use_rf_cache')
     )
     return env
@@ -1,15 +1,22 @@
 import subprocess
 import tempfile
-import glob
 import os.path
 import os
+import select
 import numpy as np
 import scipy.io
 import shutil
-import operator
 import time
 import atexit
-from collections import namedtuple
+import math
+import threading
+import hashlib
+from concurrent.futures import Future
+from collections import namedtuple, deque
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client
+from envs.simulator import Simulator, PRIORITY_DEFAULT, cull_points, get_gate_samples, get_iq_samples
+from envs.sim_client import SimulationClient, DEFAULT_SERVER_ADDRESS
 
 _SCANLINES_DIR_SUFFIX = ".rf"
 POINTS_MAT_VAR = "point_positions"
@@ -17,6 +24,40 @@ AMPS_MAT_VAR = "point_amplitudes"
 SAMPL_FREQ_MAT_VAR = "fs"
 RF_DATA_MAT_VAR = "rf_data"
 TSTART_MAT_VAR = "tstart"
+RF_BUFFER_MAT_VAR = "rf_buffer"
+RF_BUFFER_SAMPLES_MAT_VAR = "rf_buffer_samples"
+PHANTOM_MAT_VAR = "phantom"
+PHANTOM_POINTS_MAT_VAR = "phantom_positions"
+PHANTOM_AMPS_MAT_VAR = "phantom_amplitudes"
+PROBE_POS_MAT_VAR = "probe_pos"
+PROBE_ANGLE_MAT_VAR = "probe_angle"
+FOV_MAT_VAR = "fov"
+DEPTH_GATE_MAT_VAR = "depth_gate"
+IQ_DECIMATION_MAT_VAR = "iq_decimation"
+CENTER_FREQUENCY_MAT_VAR = "center_frequency"
+
+# Environment variable with the key of the remote worker hosts, used when
+# it is not given (see 'remote_authkey' of Field2, and remote_worker.py).
+REMOTE_AUTHKEY_ENV_VAR = "FIELD2_AUTHKEY"
+
+# Every row of an RF buffer starts with tstart, line number (counting from
+# 1) and the end of the scanline's samples, which start at t=0. The samples
+# follow, or if the job's RF data is demodulated, the scanline's I/Q data
+# with the filter's tail (see rf_to_iq), as interleaved real and imaginary
+# parts.
+_RF_BUFFER_HEADER = 3
+# Used to size the RF buffers: the RF data of a point ends before the echo
+# from the farthest element of the transducer in 'simulate_linear_array.m'
+# (half length of the transducer [m], speed of sound [m/s]) and the two-way
+# impulse response [samples].
+_PROBE_HALF_LENGTH = 50/1000
+_SPEED_OF_SOUND = 1540
+_PULSE_SAMPLES = 1024
+# Max. time to wait for a MATLAB worker to start [s].
+_STARTUP_TIMEOUT = 120
+# Max. number of workers in a row which die before they are started, the
+# session fails then (e.g. MATLAB cannot be started at all).
+_MAX_FAILED_STARTS = 3
 
 
 LinearArrayParams = namedtuple("LinearArrayParams", [
@@ -28,22 +69,582 @@ LinearArrayParams = namedtuple("LinearArrayParams", [
     "image_width"
 ])
 
-class Field2:
+
+class _FileChannel:
+    """
+    Channel to a Field2 worker which uses files in the working directory:
+    'go.N'/'die.N' files are requests, 'started.N'/'ready.N' files are
+    replies. The content of 'go.N' and 'ready.N' is the message itself.
+    Replies can be detected by polling only.
+
+    :param working_dir: working directory of the Field2 session.
+    :param worker_id: id of the worker.
+    """
+    def __init__(self, working_dir, worker_id):
+        self.working_dir = working_dir
+        self.worker_id = worker_id
+
+    def fileno(self):
+        return None
+
+    def send(self, message):
+        if message == "die":
+            open(os.path.join(self.working_dir, "die.%d" % self.worker_id), 'a').close()
+        else:
+            path = os.path.join(self.working_dir, "go.%d" % self.worker_id)
+            with open(path + ".tmp", 'w') as f:
+                f.write(message)
+            os.replace(path + ".tmp", path)
+
+    def recv(self):
+        """
+        :return: list of the replies received since the last call.
+        """
+        messages = []
+        started_file = os.path.join(self.working_dir, "started.%d" % self.worker_id)
+        if os.path.isfile(started_file):
+            os.remove(started_file)
+            messages.append("started")
+        ready_file = os.path.join(self.working_dir, "ready.%d" % self.worker_id)
+        if os.path.isfile(ready_file):
+            with open(ready_file) as f:
+                messages.append(f.read().strip())
+            os.remove(ready_file)
+        return messages
+
+    def close(self):
+        for name in ("go", "ready"):
+            path = os.path.join(self.working_dir, "%s.%d" % (name, self.worker_id))
+            if os.path.isfile(path):
+                os.remove(path)
+
+
+class _FifoChannel:
+    """
+    Channel to a Field2 worker which uses a pair of named pipes in the
+    working directory: requests are written to 'cmd.N' and replies are read
+    from 'reply.N', one message per line. A reply wakes up select() at once.
+
+    :param working_dir: working directory of the Field2 session.
+    :param worker_id: id of the worker.
+    """
+    def __init__(self, working_dir, worker_id):
+        self.worker_id = worker_id
+        self._cmd_path = os.path.join(working_dir, "cmd.%d" % worker_id)
+        self._reply_path = os.path.join(working_dir, "reply.%d" % worker_id)
+        os.mkfifo(self._cmd_path)
+        os.mkfifo(self._reply_path)
+        # Both pipes are opened for reading and writing, so opening does not
+        # block till the worker opens its end and reading never returns EOF.
+        self._cmd_fd = os.open(self._cmd_path, os.O_RDWR)
+        self._reply_fd = os.open(self._reply_path, os.O_RDWR | os.O_NONBLOCK)
+        self._buffer = b""
+
+    def fileno(self):
+        return self._reply_fd
+
+    def send(self, message):
+        os.write(self._cmd_fd, (message + "\n").encode())
+
+    def recv(self):
+        """
+        :return: list of the replies received since the last call.
+        """
+        try:
+            self._buffer += os.read(self._reply_fd, 65536)
+        except BlockingIOError:
+            pass
+        *lines, self._buffer = self._buffer.split(b"\n")
+        return [line.decode().strip() for line in lines if line.strip()]
+
+    def close(self):
+        if self._cmd_fd is not None:
+            os.close(self._cmd_fd)
+            os.close(self._reply_fd)
+            self._cmd_fd, self._reply_fd = None, None
+            os.remove(self._cmd_path)
+            os.remove(self._reply_path)
+
+
+_CHANNELS = {
+    "file": _FileChannel,
+    "fifo": _FifoChannel
+}
+
+
+class _RemoteChannel:
+    """
+    Channel to a Field2 worker on another host, served by a remote worker
+    host (see 'envs/remote_worker.py') listening on a TCP endpoint. Requests
+    and replies are the same as the local ones. Before the first shard of a
+    job, the job's .mat file (and the file of its resident phantom) is sent
+    to the host. A 'done' reply comes with the rows of the shard's
+    scanlines, in the layout of the RF buffer (with I/Q data if the job's RF
+    data is demodulated, see 'iq_decimation' of Field2).
+
+    The channel stands for the worker's process as well: the worker is
+    alive till the connection is closed.
+
+    :param endpoint: 'host:port' of the remote worker host.
+    :param authkey: key used to authenticate the connection, or None.
+    :param working_dir: working directory of the Field2 session.
+    """
+    def __init__(self, endpoint, authkey, working_dir):
+        host, port = endpoint.rsplit(":", 1)
+        self.endpoint = endpoint
+        self.working_dir = working_dir
+        self._connection = Client((host, int(port)), family="AF_INET", authkey=authkey)
+        self._uploaded = set()
+        # Replies read while polling the connection.
+        self._replies = []
+        # 'done' reply -> rows of the shard's scanlines.
+        self._scanlines = {}
+        self.returncode = None
+
+    def fileno(self):
+        if self.returncode is not None:
+            return None
+        return self._connection.fileno()
+
+    def send(self, message):
+        if self.returncode is not None:
+            return
+        try:
+            if message.startswith("go"):
+                self._upload_job(message.split()[1])
+            self._connection.send(("message", message))
+        except OSError:
+            self.returncode = 1
+
+    def recv(self):
+        """
+        :return: list of the replies received since the last call.
+        """
+        self._read()
+        replies, self._replies = self._replies, []
+        return replies
+
+    def get_scanlines(self, message):
+        """
+        :return: rows of the scanlines of given 'done' reply.
+        """
+        return self._scanlines.pop(message, None)
+
+    def release_job(self, name):
+        """
+        Remove the files of a job from the remote host.
+        """
+        if name in self._uploaded:
+            self._uploaded.discard(name)
+            if self.returncode is None:
+                try:
+                    self._connection.send(("remove", name))
+                except OSError:
+                    self.returncode = 1
+
+    def poll(self):
+        self._read()
+        return self.returncode
+
+    def kill(self):
+        self.close()
+
+    def close(self):
+        if not self._connection.closed:
+            self._connection.close()
+        if self.returncode is None:
+            self.returncode = -9
+
+    def _read(self):
+        try:
+            while self.returncode is None and self._connection.poll():
+                _, message, scanlines = self._connection.recv()
+                if scanlines is not None:
+                    self._scanlines[message] = scanlines
+                self._replies.append(message)
+        except (EOFError, OSError):
+            self.returncode = 1
+
+    def _upload_job(self, name):
+        if name in self._uploaded:
+            return
+        input_file = os.path.join(self.working_dir, name)
+        phantom_file = scipy.io.loadmat(input_file, variable_names=[PHANTOM_MAT_VAR])[PHANTOM_MAT_VAR]
+        if phantom_file.size > 0:
+            phantom_name = os.path.basename(str(phantom_file[0]))
+            if phantom_name not in self._uploaded:
+                with open(str(phantom_file[0]), "rb") as f:
+                    self._connection.send(("phantom", phantom_name, f.read()))
+                # Phantoms stay on the host till the end of the session.
+                self._uploaded.add(phantom_name)
+        with open(input_file, "rb") as f:
+            self._connection.send(("job", name, f.read()))
+        self._uploaded.add(name)
+
+
+def start_matlab_worker(worker_id, working_dir, ipc):
+    """
+    Start a MATLAB process running a Field2 worker
+    ('simulate_linear_array.m').
+
+    ..warning:
+        Add Field2 to path unless it's added in matlab's path already.
+        Also, in matlab_call, add matlab's path.
+
+    :param worker_id: id of the worker.
+    :param working_dir: directory of the worker's requests and replies.
+    :param ipc: 'fifo' or 'file'.
+    :return: subprocess.Popen of the MATLAB process.
+    """
+    prev_dir = os.getcwd()
+    os.chdir(os.path.dirname(__file__))
+    fn_call = (
+        "addpath('/home/spbtu/Manolis_Files/Field2'), " +
+        "field_init, " +
+        "try, " +
+        ("simulate_linear_array(%d, \'%s\',\'%s\',\'%s\'), " % (worker_id,
+                                                                working_dir,
+                                                                working_dir,
+                                                                ipc)) +
+        "exit(0),"
+        "catch ex, " +
+        "fprintf('%s, %s \\n', ex.identifier, ex.message)," +
+        "exit(1), " +
+        "end ")
+    matlab_call = ["/usr/local/MATLAB/R2018a/bin/matlab", "-nosplash", "-nodesktop", "-r", fn_call]
+    pipe = subprocess.Popen(matlab_call)
+    os.chdir(prev_dir)
+    return pipe
+
+
+class _Shard:
+    """
+    A range of scanlines of a single pose of a job, the unit of work given
+    to a worker. The same shard can be given to more than one worker
+    (speculatively), the first worker which reports it done is the one whose
+    results are used.
+
+    :param job: job of the shard.
+    :param pose: index of the pose (counting from 1, as in MATLAB).
+    :param first: first scanline (counting from 1).
+    :param last: last scanline (inclusive).
+    """
+    def __init__(self, job, pose, first, last):
+        self.job = job
+        self.pose = pose
+        self.first = first
+        self.last = last
+        self.workers = {}  # worker -> time of dispatch
+        self.done_by = None
+        # Number of times the shard was re-queued after its worker died.
+        self.retries = 0
+
+    def is_done(self):
+        return self.done_by is not None
+
+
+def _get_line_ranges(lines, lines_per_shard):
+    """
+    :param lines: indices (from 0) of the scanlines.
+    :return: (first, last) ranges of consecutive scanlines (counting from 1,
+        inclusive), of at most lines_per_shard scanlines each.
+    """
+    ranges = []
+    for line in sorted(set(lines)):
+        first, last = ranges[-1] if ranges else (None, None)
+        if ranges and line == last and last - first + 1 < lines_per_shard:
+            ranges[-1] = (first, line + 1)
+        else:
+            ranges.append((line + 1, line + 1))
+    return ranges
+
+
+class _Job:
+    """
+    A single simulation request of one or more probe poses: its .mat file,
+    output directory, shards and the future of its result.
+
+    :param name: name of the job's .mat file.
+    :param working_dir: working directory of the Field2 session.
+    :param no_poses: number of probe poses.
+    :param no_lines: number of scanlines per pose.
+    :param lines_per_shard: number of scanlines per shard.
+    :param sampling_frequency: sampling frequency.
+    :param batch: whether the result is a stack of RF arrays (one per pose),
+        or RF array of the single pose.
+    :param priority: priority of the job, lower values are served first.
+    :param owner: who submitted the job.
+    :param rf_buffer_file: file of the memory-mapped RF buffer, which the
+        workers write the scanlines to. If None, scanlines are saved to .mat
+        files in the output directory.
+    :param rf_buffer_samples: max. number of samples of a scanline in the RF
+        buffer.
+    :param iq_decimation: decimation factor of the I/Q data the RF data of
+        the job is demodulated to, or None.
+    :param on_scanlines: function called with the scanlines of each shard
+        when it is done (see Simulator.submit), or None.
+    :param lines: indices (from 0) of the scanlines of each pose to simulate,
+        or None for all of them. The rows of the other scanlines stay empty.
+    """
+    def __init__(
+        self,
+        name,
+        working_dir,
+        no_poses,
+        no_lines,
+        lines_per_shard,
+        sampling_frequency,
+        batch,
+        priority,
+        owner=None,
+        rf_buffer_file=None,
+        rf_buffer_samples=0,
+        iq_decimation=None,
+        on_scanlines=None,
+        lines=None
+    ):
+        self.name = name
+        self.input_file = os.path.join(working_dir, name)
+        self.output_dir = self.input_file + _SCANLINES_DIR_SUFFIX
+        self.rf_buffer_file = rf_buffer_file
+        self.rf_buffer = None
+        if rf_buffer_file is not None:
+            self.rf_buffer = np.memmap(
+                rf_buffer_file, dtype=np.float64, mode="w+",
+                shape=(no_poses, no_lines, _RF_BUFFER_HEADER + rf_buffer_samples))
+        self.no_poses = no_poses
+        self.no_lines = no_lines
+        self.sampling_frequency = sampling_frequency
+        self.iq_decimation = iq_decimation
+        self.batch = batch
+        self.priority = priority
+        self.owner = owner
+        self.on_scanlines = on_scanlines
+        # (pose, line) -> RF buffer header and (samples, ) I/Q data of the
+        # scanlines demodulated by the remote workers, both counting from 1,
+        # if the job has no RF buffer.
+        self.remote_iq = {}
+        self.future = Future()
+        # Whether any shard of the job was given to a worker.
+        self.started = False
+        if lines is None:
+            lines = range(no_lines)
+        self.shards = [_Shard(self, pose, first, last)
+                       for pose in range(1, no_poses + 1)
+                       for first, last in _get_line_ranges(lines, lines_per_shard)]
+        self.queue = deque(self.shards)
+
+    def is_done(self):
+        return all(shard.is_done() for shard in self.shards)
+
+    def get_line_files(self, pose):
+        """
+        :return: files with the scanlines of given pose, in order.
+        """
+        return [os.path.join(self.output_dir, "p%d_ln%d.%d.mat" % (pose, line, shard.done_by))
+                for shard in self.shards if shard.pose == pose
+                for line in range(shard.first, shard.last + 1)
+                if (pose, line) not in self.remote_iq]
+
+    def remove_files(self):
+        """
+        Remove the files of the job. The RF arrays returned from the RF buffer
+        stay valid, the mapping is released when they are not used anymore.
+        """
+        if os.path.isfile(self.input_file):
+            os.remove(self.input_file)
+        if self.rf_buffer_file is not None and os.path.isfile(self.rf_buffer_file):
+            os.remove(self.rf_buffer_file)
+        shutil.rmtree(self.output_dir, ignore_errors=True)
+
+
+class Field2(Simulator):
     """
     Field2: A class used to start Field2 sessions and
         generate data.
-        
+
     :param working_dir: working directory for Field2 sessions.
-    :param no_workers: number of workers for Field2 sessions.
+    :param no_workers: number of workers started with the Field2 session.
+    :param ipc: how requests and replies are exchanged with the workers,
+        'fifo' (named pipes, event-driven) or 'file' (go/ready files,
+        polled every second).
+    :param lines_per_shard: number of scanlines in a single piece of work
+        pulled from the job queue by an idle worker. If None, every worker
+        gets about 4 shards per frame ('fifo') or a single one ('file').
+    :param speculation_factor: a shard which is in progress for longer than
+        speculation_factor times the average shard time is given to an idle
+        worker as well, the first result is used. None disables speculation.
+    :param transport: how the workers return the RF data, 'mmap' (scanlines
+        are written to a memory-mapped RF buffer in /dev/shm, which is
+        returned without copying) or 'mat' (a .mat file per scanline).
+    :param min_workers: min. number of workers, no_workers if None.
+    :param max_workers: max. number of workers, no_workers if None (the pool
+        is not scaled up).
+    :param spare_workers: number of idle workers kept warm, so a burst of
+        requests does not wait for a MATLAB start.
+    :param idle_timeout: a worker idle for longer than idle_timeout [s] is
+        stopped, if there are more than min_workers workers and more than
+        spare_workers idle ones.
+    :param max_queue_time: a worker is added when the queued shards would
+        wait longer than max_queue_time [s] for the running workers (as
+        estimated from the average shard time).
+    :param server_address: socket of a running simulation server (see
+        'envs/sim_server.py'). If the server is listening, requests are sent
+        to its warm workers and no workers are started, otherwise the
+        session starts its own workers. A socket of another user is never
+        attached to (see check_server_address). By default, the socket in
+        the current user's runtime directory. None never attaches.
+    :param remote_workers: list of 'host:port' endpoints of remote worker
+        hosts (see 'envs/remote_worker.py'), a worker is started on the host
+        for each endpoint (an endpoint can be repeated). Remote workers get
+        shards as the local ones and are not scaled, min_workers and
+        max_workers count the local workers only.
+    :param remote_authkey: key used to authenticate the connections to the
+        remote worker hosts, required with remote_workers. If None, it is
+        read from the FIELD2_AUTHKEY environment variable.
+    :param max_retries: max. number of times a shard is re-queued after the
+        worker which simulated it died, the shard's job fails then.
+    :param start_worker: function which starts a local worker process, given
+        (worker id, working directory, ipc), e.g. start_python_worker (see
+        'envs/python_worker.py') to run Field2 without MATLAB.
+    :param iq_decimation: if given, the RF data of a job is demodulated to
+        complex64 I/Q data decimated by this factor, so the result is an
+        order of magnitude smaller (see Simulator). With RF buffers, the
+        workers demodulate their scanlines and write the I/Q data to the
+        buffer, so it is the I/Q data which is merged (and sent over the
+        network by remote worker hosts). Scanlines saved to .mat files are
+        demodulated when the job is merged. When attached to a simulation
+        server, the server's setting is used.
+    :param depth_gate: (min. depth, max. depth) [m] of the returned data, or
+        None (see Simulator). Scatterers whose echoes miss the gate are
+        culled before a job is saved (by the workers for resident phantoms),
+        and the workers compute and return the samples of the gate only.
+        When attached to a simulation server, the server's setting is used.
+    :param priority: default priority of the jobs of this session, e.g.
+        PRIORITY_RENDER for the environment which renders gifs. It is the
+        priority of the requests sent to a simulation server as well.
+
+    Jobs are handed to the workers by a dispatcher thread, so a simulation
+    can be started with 'submit' and collected later, while the caller does
+    something else. Jobs are served in the order of priority, so low priority
+    jobs (e.g. prefetching) get the workers which would be idle otherwise.
+    Shards of the jobs of the same priority are given to their owners in
+    turn, and to the jobs of an owner in the order of submission. The
+    dispatcher also scales the pool of workers between min_workers and
+    max_workers, starting a worker at a time in the background.
+
+    A worker which dies (e.g. killed on out of memory) is replaced with a
+    new one, and the shard it was simulating is given to another worker.
+    The numbers of replaced workers and re-queued shards are counted in
+    no_respawns and no_retries.
     """
-    def __init__(self, working_dir=None, no_workers=1):
+    asynchronous = True
+
+    def __init__(
+        self,
+        working_dir=None,
+        no_workers=1,
+        ipc="fifo",
+        lines_per_shard=None,
+        speculation_factor=2.0,
+        transport="mmap",
+        min_workers=None,
+        max_workers=None,
+        spare_workers=0,
+        idle_timeout=60,
+        max_queue_time=0,
+        server_address=DEFAULT_SERVER_ADDRESS,
+        remote_workers=None,
+        remote_authkey=None,
+        iq_decimation=None,
+        depth_gate=None,
+        max_retries=3,
+        start_worker=start_matlab_worker,
+        priority=PRIORITY_DEFAULT
+    ):
+        if ipc not in _CHANNELS:
+            raise ValueError("Unknown ipc '%s', available: %s." % (ipc, list(_CHANNELS)))
+        if transport not in ("mmap", "mat"):
+            raise ValueError("Unknown transport '%s', available: ['mmap', 'mat']." % transport)
+        # Center frequency of the transducer in 'simulate_linear_array.m'.
+        super().__init__(
+            iq_decimation=iq_decimation, center_frequency=3.5e6, depth_gate=depth_gate,
+            speed_of_sound=_SPEED_OF_SOUND)
+        self.no_respawns = 0
+        self.no_retries = 0
+        self.priority = priority
+        self._server = self._attach(server_address) if server_address is not None else None
+        if self._server is not None:
+            print("Attached to the simulation server on %s." % server_address)
+            return
         self._remove_working_dir = working_dir is None
         if working_dir is None:
             working_dir = tempfile.TemporaryDirectory(suffix='_fieldii')
         self.working_dir = working_dir
-        self.no_workers = no_workers
+        self.min_workers = no_workers if min_workers is None else min_workers
+        self.max_workers = max(no_workers, self.min_workers) if max_workers is None else max_workers
+        self.spare_workers = spare_workers
+        self.idle_timeout = idle_timeout
+        self.max_queue_time = max_queue_time
+        self.ipc = ipc
+        self.lines_per_shard = lines_per_shard
+        self.speculation_factor = speculation_factor
+        self.transport = transport
+        self.remote_workers = list(remote_workers or [])
+        if remote_authkey is None:
+            remote_authkey = os.environ.get(REMOTE_AUTHKEY_ENV_VAR)
+        if self.remote_workers and not remote_authkey:
+            raise ValueError("Remote workers require remote_authkey.")
+        if isinstance(remote_authkey, str):
+            remote_authkey = remote_authkey.encode()
+        self.remote_authkey = remote_authkey
+        self.max_retries = max_retries
+        self.start_worker = start_worker
+        self._buffer_dir = None
+        if transport == "mmap":
+            self._buffer_dir = tempfile.TemporaryDirectory(
+                suffix='_fieldii', dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+        # worker -> MATLAB process, channel.
+        self._pipes, self._channels = {}, {}
+        self._next_worker = 0
+        # worker -> start time, for the workers which are not started yet.
+        self._starting = {}
+        # Workers which can get shards.
+        self._ready = set()
+        # Workers which were asked to stop.
+        self._retiring = set()
+        # Workers on the remote hosts.
+        self._remote = set()
+        # Number of workers in a row which died before they were started.
+        self._failed_starts = 0
+        # worker -> time since when the worker is idle.
+        self._idle_since = {}
+        # worker -> shard in progress.
+        self._busy = {}
+        # Merged jobs, which still have speculative shards in progress.
+        self._finished_jobs = []
+        self._no_jobs = 0
+        # Digest of the scatterers -> id of the uploaded phantom.
+        self._phantom_ids = {}
+        # Moving average of the shard time [s].
+        self._shard_time = None
+        # owner -> number of the last shard given to the owner's jobs.
+        self._last_served = {}
+        self._no_served = 0
+        # Submitted jobs which are not done yet, shared with the dispatcher.
+        self._jobs = deque()
+        self._lock = threading.Lock()
+        # Writing to the pipe wakes up the dispatcher waiting for replies.
+        self._wakeup_fds = os.pipe()
+        os.set_blocking(self._wakeup_fds[0], False)
+        self._closing = False
+        self._error = None
+        self._dispatcher = None
         atexit.register(self._cleanup)
-        self._start_sessions()
+        self._start_sessions(no_workers)
+        self._dispatcher = threading.Thread(
+            target=self._dispatch, name="Field2-dispatcher", daemon=True)
+        self._dispatcher.start()
 
     def simulate_linear_array(
         self,
@@ -53,11 +654,12 @@ class Field2:
         """
         Create RF data.
         Create a .mat file which includes all the necessary data to generate
-        the RF data. Then, go.* files are used as signals to begin the rf data
-        scanlines generation process and ready.* files mean that scanlines are
-        successfully generated. Merge the scanlines and delete .mat, go and ready
-        files.
-        
+        the RF data. Then, the scanlines are split into shards, which are
+        given to idle workers one by one ('go <job> <pose> <first> <last>'
+        requests). A 'done <job> <pose> <first> <last>' reply means that the
+        shard's scanlines are generated. Merge the scanlines and delete the
+        .mat files.
+
         :param point_positions: (n, 3) points used to generate the RF data.
         :param point_amplitudes: (n, 1) amplitudes of the points used.
         :param sampling_frequency: sampling frequency.
@@ -67,48 +669,356 @@ class Field2:
         :return: RF data and a vector including start time of each
             scanline.
         """
-        self._assert_workers_exists()
-        input_file_path = os.path.join(self.working_dir.name, "input.mat")
+        print("Simulating linear array in Field II...")
+        rf_array, t_start = self.submit(
+            point_positions, point_amplitudes, sampling_frequency,
+            no_lines=no_lines, z_focus=z_focus, image_width=image_width).result()
+        print("...simulation completed.")
+        return rf_array, t_start
+
+    def simulate_linear_array_batch(
+        self,
+        point_positions, point_amplitudes, sampling_frequency,
+        no_lines=50, z_focus=60/1000, image_width=40/1000
+    ):
+        """
+        Create RF data for many probe poses in a single job, so the .mat file
+        is written, and loaded by every worker, once per batch. Shards of all
+        poses share the job's queue.
+
+        :param point_positions: list of (n_k, 3) points, one per pose.
+        :param point_amplitudes: list of (n_k, 1) amplitudes, one per pose.
+        :param sampling_frequency: sampling frequency.
+        :param no_lines: number of lines of RF data.
+        :param z_focus: focal depth of the probe, a single value or one per
+            pose.
+        :param image_width: number of columns of RF data.
+        :return: (N, samples, no_lines) RF data, zero padded to the longest
+            pose, and (N, no_lines) start times of the scanlines.
+        """
+        print("Simulating linear array in Field II (%d poses)..." % len(point_positions))
+        rf_arrays, t_starts = self.submit_batch(
+            point_positions, point_amplitudes, sampling_frequency,
+            no_lines=no_lines, z_focus=z_focus, image_width=image_width).result()
+        print("...simulation completed.")
+        return rf_arrays, t_starts
+
+    def submit(
+        self,
+        point_positions, point_amplitudes, sampling_frequency,
+        no_lines=50, z_focus=60/1000, image_width=40/1000,
+        priority=None, owner=None, on_scanlines=None, lines=None
+    ):
+        """
+        Start creating RF data, without waiting for the result. Parameters
+        are the same as in 'simulate_linear_array'.
+
+        :param priority: priority of the job, lower values are served first,
+            the session's priority if None.
+        :param owner: who submits the job, jobs of the same priority are
+            served fairly between the owners.
+        :param on_scanlines: function called by the dispatcher thread with
+            (first line, (samples, k) data) of each shard when it is done
+            (see Simulator.submit), or None. Used with the 'mmap' transport
+            only, and not when attached to a simulation server.
+        :param lines: indices (from 0) of the scanlines to simulate, or None
+            for all of them. The other scanlines are zeros, with start time
+            0.
+        :return: concurrent.futures.Future of (RF data, start times). A job
+            can be cancelled till any of its shards is given to a worker.
+        """
+        if priority is None:
+            priority = self.priority
+        if self._server is not None:
+            return self._server.submit(
+                point_positions, point_amplitudes, sampling_frequency,
+                no_lines=no_lines, z_focus=z_focus, image_width=image_width, priority=priority,
+                lines=lines)
+        return self._submit_job(
+            [point_positions], [point_amplitudes], sampling_frequency,
+            no_lines, [z_focus], image_width, batch=False, priority=priority, owner=owner,
+            on_scanlines=on_scanlines, lines=lines)
+
+    def submit_batch(
+        self,
+        point_positions, point_amplitudes, sampling_frequency,
+        no_lines=50, z_focus=60/1000, image_width=40/1000,
+        priority=None, owner=None
+    ):
+        """
+        Start creating RF data for many probe poses, without waiting for the
+        result. Parameters are the same as in 'simulate_linear_array_batch'.
+
+        :param priority: priority of the job, lower values are served first,
+            the session's priority if None.
+        :param owner: who submits the job.
+        :return: concurrent.futures.Future of (RF data, start times).
+        """
+        if priority is None:
+            priority = self.priority
+        if self._server is not None:
+            return self._server.submit_batch(
+                point_positions, point_amplitudes, sampling_frequency,
+                no_lines=no_lines, z_focus=z_focus, image_width=image_width, priority=priority)
+        return self._submit_job(
+            point_positions, point_amplitudes, sampling_frequency,
+            no_lines, np.broadcast_to(z_focus, (len(point_positions),)), image_width,
+            batch=True, priority=priority, owner=owner)
+
+    def upload_phantom(self, point_positions, point_amplitudes):
+        """
+        Save the scatterers of a static phantom to the working directory,
+        once. Workers load a phantom when they get its first job and keep it
+        till a job of another phantom comes. Uploading the same scatterers
+        again returns the same id.
+
+        :param point_positions: (n, 3) points, in the phantom's frame.
+        :param point_amplitudes: (n, 1) amplitudes of the points.
+        :return: id of the phantom.
+        """
+        if self._server is not None:
+            return self._server.upload_phantom(point_positions, point_amplitudes)
+        point_positions = np.asarray(point_positions, dtype=np.float64).reshape(-1, 3)
+        point_amplitudes = np.asarray(point_amplitudes, dtype=np.float64).reshape(-1, 1)
+        digest = hashlib.sha1(point_positions.tobytes() + point_amplitudes.tobytes()).hexdigest()
+        # The id is known to others (e.g. clients of a simulation server
+        # uploading the same scatterers) once the phantom is saved.
+        with self._lock:
+            if digest in self._phantom_ids:
+                return self._phantom_ids[digest]
+            phantom_id = len(self._phantom_ids)
+            filename = os.path.join(self.working_dir.name, "phantom_%d.mat" % phantom_id)
+            scipy.io.savemat(filename, {
+                PHANTOM_POINTS_MAT_VAR: point_positions,
+                PHANTOM_AMPS_MAT_VAR: point_amplitudes
+            })
+            # Range of depths is used to size the RF buffers.
+            self._phantoms[phantom_id] = (
+                filename, np.min(point_positions[:, 2], initial=0), np.max(point_positions[:, 2], initial=0))
+            self._phantom_ids[digest] = phantom_id
+        return phantom_id
+
+    def submit_pose(
+        self,
+        phantom_id, probe_pos, probe_angle, window, sampling_frequency,
+        no_lines=50, z_focus=60/1000, image_width=40/1000,
+        priority=None, owner=None, on_scanlines=None, lines=None
+    ):
+        """
+        Start creating RF data of a resident phantom seen from given probe
+        pose. The job's .mat file carries only the pose, workers move the
+        phantom's scatterers to the probe's frame and crop the field of view
+        themselves.
+
+        :param phantom_id: id returned by 'upload_phantom'.
+        :param probe_pos: 3-D position of the probe.
+        :param probe_angle: angle of the probe, in degrees.
+        :param window: (x size, y size) of the probe's field of view [m].
+        :param on_scanlines: see 'submit'.
+        :param lines: see 'submit'.
+        :return: concurrent.futures.Future of (RF data, start times).
+        """
+        if priority is None:
+            priority = self.priority
+        if self._server is not None:
+            return self._server.submit_pose(
+                phantom_id, probe_pos, probe_angle, window, sampling_frequency,
+                no_lines=no_lines, z_focus=z_focus, image_width=image_width, priority=priority,
+                lines=lines)
+        return self._submit_job(
+            None, None, sampling_frequency,
+            no_lines, [z_focus], image_width, batch=False, priority=priority, owner=owner,
+            phantom_id=phantom_id, probe_poses=[(probe_pos, probe_angle)], window=window,
+            on_scanlines=on_scanlines, lines=lines)
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+            return
+        # Closed once: the exit handler is not needed anymore.
+        atexit.unregister(self._cleanup)
+        self._cleanup()
+
+    def is_attached(self):
+        """
+        :return: whether the requests are served by a simulation server.
+        """
+        return self._server is not None
+
+    @staticmethod
+    def _attach(server_address):
+        """
+        :return: client of the simulation server listening on given address,
+            None if there is no such server, or its socket is not safe.
+        """
+        try:
+            return SimulationClient(server_address)
+        except (FileNotFoundError, ConnectionRefusedError):
+            return None
+        except PermissionError as ex:
+            print("WARN: not attaching to the simulation server: %s" % ex)
+            return None
+
+    def _submit_job(
+        self,
+        point_positions, point_amplitudes, sampling_frequency,
+        no_lines, z_focus, image_width, batch, priority, owner,
+        phantom_id=None, probe_poses=None, window=None, on_scanlines=None, lines=None
+    ):
+        """
+        Save a job of one or more poses and add it to the dispatcher's
+        queue. The poses are given by the points of each pose, or by the
+        (position, angle) of the probe in a resident phantom.
+
+        :return: future of the job's result.
+        """
+        if self._error is not None:
+            raise RuntimeError("Field2 session is not available: %s" % self._error)
+        if self._closing:
+            raise RuntimeError("Field2 session is closed.")
+        with self._lock:
+            name = "job_%d.mat" % self._no_jobs
+            self._no_jobs += 1
+        rf_buffer_file = None
+        if self.transport == "mmap":
+            rf_buffer_file = os.path.join(self._buffer_dir.name, name + _SCANLINES_DIR_SUFFIX)
+        if phantom_id is None and self.depth_gate is not None:
+            point_positions, point_amplitudes = self._cull_poses(point_positions, point_amplitudes)
+        # Remote workers use RF buffers of this size with either transport.
+        if phantom_id is None:
+            max_range = self._get_max_range(point_positions)
+        else:
+            max_range = self._get_max_phantom_range(phantom_id, probe_poses, window)
+        rf_buffer_samples = self._get_max_samples(
+            max_range, image_width, sampling_frequency)
+        if self.depth_gate is not None:
+            _, gate_end = get_gate_samples(self.depth_gate, sampling_frequency, _SPEED_OF_SOUND)
+            rf_buffer_samples = min(rf_buffer_samples, gate_end)
+        if self.iq_decimation is not None:
+            # A row holds the I/Q data of the scanline, which has a tail.
+            rf_buffer_samples = max(
+                rf_buffer_samples, 2*get_iq_samples(rf_buffer_samples, self.iq_decimation, tail=True))
+        job = _Job(
+            name=name,
+            working_dir=self.working_dir.name,
+            no_poses=len(z_focus),
+            no_lines=no_lines,
+            lines_per_shard=self._get_lines_per_shard(no_lines if lines is None else len(lines)),
+            sampling_frequency=sampling_frequency,
+            batch=batch,
+            priority=priority,
+            owner=owner,
+            rf_buffer_file=rf_buffer_file,
+            rf_buffer_samples=rf_buffer_samples,
+            iq_decimation=self.iq_decimation,
+            on_scanlines=on_scanlines,
+            lines=lines
+        )
         self._save_mat_file(
-            filename=input_file_path,
+            filename=job.input_file,
             point_positions=point_positions,
             point_amplitudes=point_amplitudes,
             sampling_frequency=sampling_frequency,
             no_lines=no_lines,
             z_focus=z_focus,
-            image_width=image_width
+            image_width=image_width,
+            rf_buffer_file=rf_buffer_file,
+            rf_buffer_samples=rf_buffer_samples,
+            phantom_file=None if phantom_id is None else self._phantoms[phantom_id][0],
+            probe_poses=probe_poses,
+            window=window
         )
-        # Create "go files" n times.
-        print("Simulating linear array in Field II...")
-        for worker in range(self.no_workers):
-            open(os.path.join(self.working_dir.name, ('go.%d' % worker)), 'a').close()
-        # Wait till all matlab processes finish the job.
-        ready_sign_pattern = os.path.join(self.working_dir.name, 'ready.*')
-        i = 0
-        while len(glob.glob(ready_sign_pattern)) != self.no_workers:
-            time.sleep(1)
-            if i % 10 == 0:
+        if rf_buffer_file is None:
+            os.mkdir(job.output_dir)
+        with self._lock:
+            self._jobs.append(job)
+        self._wakeup()
+        return job.future
+
+    @property
+    def no_workers(self):
+        """
+        Current number of workers (including the ones which are starting),
+        0 if attached to a simulation server.
+        """
+        if self._server is not None:
+            return 0
+        return len(self._pipes) - len(self._retiring)
+
+    def _wakeup(self):
+        os.write(self._wakeup_fds[1], b"\0")
+
+    def _dispatch(self):
+        """
+        Main loop of the dispatcher thread: give shards to the idle workers,
+        handle their replies and resolve the futures of the finished jobs.
+        """
+        try:
+            while not self._closing:
+                self._remove_cancelled_jobs()
+                with self._lock:
+                    jobs = list(self._jobs)
+                self._schedule(jobs)
+                self._scale(jobs)
+                for worker, message in self._receive():
+                    self._handle_reply(worker, message)
+                for job in jobs:
+                    if job.is_done():
+                        self._complete_job(job)
                 self._assert_workers_exists()
-            i = i+1
-        # Output data is ready.
-        (rf_array, t_start) = self._merge_scanlines(
-            os.path.join(self.working_dir.name, "input.mat.rf"),
-            sampling_frequency)
-        # Cleanup.
-        for worker in range(self.no_workers):
-            go_file = os.path.join(self.working_dir.name, "go.%d" % worker)
-            ready_file = os.path.join(self.working_dir.name, "ready.%d" % worker)
-            if os.path.isfile(go_file):
-                os.remove(go_file)
-            if os.path.isfile(ready_file):
-                os.remove(ready_file)
-        os.remove(os.path.join(self.working_dir.name, "input.mat"))
-        shutil.rmtree(os.path.join(self.working_dir.name, "input.mat.rf"))
-        print("...simulation completed.")
-        return rf_array, t_start
+        except Exception as ex:
+            self._error = ex
+            self._fail_jobs(ex)
 
-    def close(self):
-        self._cleanup()
+    def _complete_job(self, job):
+        """
+        Merge the scanlines of a finished job and set its result.
+        """
+        with self._lock:
+            self._jobs.remove(job)
+        try:
+            if job.rf_buffer is not None and job.iq_decimation is not None:
+                # The workers demodulated the scanlines, after the depth gate.
+                rf_arrays, t_starts = self._get_iq_arrays(job.rf_buffer, job.iq_decimation)
+            else:
+                rf_buffer = job.rf_buffer
+                if rf_buffer is None:
+                    rf_buffer = self._load_scanlines(job)
+                rf_arrays, t_starts = self._get_rf_arrays(rf_buffer)
+                rf_arrays = self._get_output(rf_arrays, job.sampling_frequency)
+                for (pose, line), (_, iq) in job.remote_iq.items():
+                    no_samples = min(iq.shape[0], rf_arrays.shape[-2])
+                    rf_arrays[pose - 1, :no_samples, line - 1] = iq[:no_samples]
+            if job.batch:
+                job.future.set_result((rf_arrays, t_starts))
+            else:
+                job.future.set_result((rf_arrays[0], t_starts[0]))
+        except Exception as ex:
+            job.future.set_exception(ex)
+        self._finish_job(job)
+
+    def _remove_cancelled_jobs(self):
+        with self._lock:
+            cancelled = [job for job in self._jobs if job.future.cancelled()]
+            for job in cancelled:
+                self._jobs.remove(job)
+        for job in cancelled:
+            self._finish_job(job)
+
+    def _fail_jobs(self, ex):
+        """
+        Set given exception as the result of all jobs which are not done.
+        """
+        with self._lock:
+            jobs = list(self._jobs)
+            self._jobs.clear()
+        for job in jobs:
+            if not job.future.done():
+                job.future.set_exception(ex)
+
+    def _finish_job(self, job):
+        self._finished_jobs.append(job)
+        self._remove_finished_jobs()
 
     def _save_mat_file(
         self,
@@ -118,106 +1028,563 @@ class Field2:
         sampling_frequency,
         no_lines,
         z_focus,
-        image_width
+        image_width,
+        rf_buffer_file=None,
+        rf_buffer_samples=0,
+        phantom_file=None,
+        probe_poses=None,
+        window=None
     ):
+        """
+        Save a job's .mat file. Points and amplitudes are saved as cell
+        arrays, with one cell per pose. An empty RF buffer file name means
+        that scanlines are saved to .mat files. A job of a resident phantom
+        has empty cells and the phantom's file, probe positions, angles and
+        field of view instead.
+        """
+        no_poses = len(z_focus)
+        positions_cell = np.empty(no_poses, dtype=object)
+        amplitudes_cell = np.empty(no_poses, dtype=object)
+        probe_pos = np.zeros((no_poses, 3))
+        probe_angle = np.zeros(no_poses)
+        if phantom_file is None:
+            for pose, (points, amps) in enumerate(zip(point_positions, point_amplitudes)):
+                positions_cell[pose] = np.asarray(points, dtype=np.float64)
+                amplitudes_cell[pose] = np.asarray(amps, dtype=np.float64)
+        else:
+            for pose, (pos, angle) in enumerate(probe_poses):
+                positions_cell[pose] = np.zeros((0, 3))
+                amplitudes_cell[pose] = np.zeros((0, 1))
+                probe_pos[pose] = pos
+                probe_angle[pose] = angle
         scipy.io.savemat(
             filename, {
-            POINTS_MAT_VAR: point_positions,
-            AMPS_MAT_VAR: point_amplitudes,
+            POINTS_MAT_VAR: positions_cell,
+            AMPS_MAT_VAR: amplitudes_cell,
             "no_lines": np.int32(no_lines),
-            "z_focus": float(z_focus),
-            "image_width": float(image_width)
+            "z_focus": np.array(z_focus, dtype=np.float64),
+            "image_width": float(image_width),
+            RF_BUFFER_MAT_VAR: rf_buffer_file or "",
+            RF_BUFFER_SAMPLES_MAT_VAR: np.int32(rf_buffer_samples),
+            PHANTOM_MAT_VAR: phantom_file or "",
+            PROBE_POS_MAT_VAR: probe_pos,
+            PROBE_ANGLE_MAT_VAR: probe_angle,
+            FOV_MAT_VAR: np.array(window if window is not None else (0, 0), dtype=np.float64),
+            DEPTH_GATE_MAT_VAR: np.array(
+                self.depth_gate if self.depth_gate is not None else (), dtype=np.float64),
+            # Used by the remote worker hosts to demodulate the scanlines.
+            SAMPL_FREQ_MAT_VAR: float(sampling_frequency),
+            IQ_DECIMATION_MAT_VAR: np.array(
+                self.iq_decimation if self.iq_decimation is not None else (), dtype=np.float64),
+            CENTER_FREQUENCY_MAT_VAR: float(self.center_frequency)
         })
 
-    def _start_sessions(self):
+    def _cull_poses(self, point_positions, point_amplitudes):
+        """
+        :return: points and amplitudes of given poses, without the ones
+            whose echoes miss the depth gate.
+        """
+        culled = [cull_points(points, amps, self.depth_gate, _PROBE_HALF_LENGTH)
+                  for points, amps in zip(point_positions, point_amplitudes)]
+        return [points for points, _ in culled], [amps for _, amps in culled]
+
+    def _get_max_range(self, point_positions):
+        """
+        :return: max. distance of the points of given poses from the probe.
+        """
+        return max((np.max(np.linalg.norm(np.asarray(points).reshape(-1, 3), axis=1))
+                    for points in point_positions if np.size(points) > 0),
+                   default=0)
+
+    def _get_max_phantom_range(self, phantom_id, probe_poses, window):
+        """
+        :return: upper bound of the distance of the resident phantom's points
+            in the field of view of given poses from the probe.
+        """
+        _, z_min, z_max = self._phantoms[phantom_id]
+        max_depth = max(max(abs(z_min - pos[2]), abs(z_max - pos[2])) for pos, _ in probe_poses)
+        return math.sqrt((window[0]/2)**2 + (window[1]/2)**2 + max_depth**2)
+
+    def _get_max_samples(self, max_range, image_width, sampling_frequency):
+        """
+        :return: upper bound of the number of samples of a scanline (starting
+            at t=0), for the points at most max_range from the probe.
+        """
+        max_range += image_width/2 + _PROBE_HALF_LENGTH
+        return int(math.ceil(2*max_range/_SPEED_OF_SOUND*sampling_frequency)) + _PULSE_SAMPLES
+
+    def _start_sessions(self, no_workers):
         """
         Start a Field2 session.
         """
-        self._pipes = [self._start_session(worker) for worker in range(self.no_workers)]
-        print("Started %d MATLAB worker(s)." % len(self._pipes))
-        timeout = 120
-        print("Waiting max. %d [s] till all MATLAB workers will be available..." % timeout)
-        started_sign_pattern = os.path.join(self.working_dir.name, 'started.*')
-        while len(glob.glob(started_sign_pattern)) != self.no_workers and timeout > 0:
-            time.sleep(1)
-            timeout -= 1
-        if timeout <= 0:
-             raise RuntimeError("Timeout waiting for MATLAB processes, stopping.")
+        for _ in range(no_workers):
+            self._add_worker()
+        for endpoint in self.remote_workers:
+            self._add_remote_worker(endpoint)
+        print("Started %d MATLAB worker(s), %d remote." % (len(self._pipes), len(self._remote)))
+        print("Waiting max. %d [s] till all MATLAB workers will be available..." % _STARTUP_TIMEOUT)
+        deadline = time.monotonic() + _STARTUP_TIMEOUT
+        while self._starting:
+            if time.monotonic() > deadline:
+                raise RuntimeError("Timeout waiting for MATLAB processes, stopping.")
+            for worker, message in self._receive():
+                self._handle_reply(worker, message)
+            self._assert_workers_exists()
         print("Checking state of workers...")
         self._assert_workers_exists()
         print("...OK!")
 
+    def _add_worker(self):
+        """
+        Start a new worker, which gets shards once it replies 'started'.
+
+        :return: id of the worker.
+        """
+        worker = self._next_worker
+        self._next_worker += 1
+        self._channels[worker] = _CHANNELS[self.ipc](self.working_dir.name, worker)
+        self._pipes[worker] = self._start_session(worker)
+        self._starting[worker] = time.monotonic()
+        return worker
+
+    def _add_remote_worker(self, endpoint):
+        """
+        Start a new worker on a remote worker host, which gets shards once it
+        replies 'started'.
+
+        :return: id of the worker.
+        """
+        worker = self._next_worker
+        self._next_worker += 1
+        try:
+            channel = _RemoteChannel(endpoint, self.remote_authkey, self.working_dir.name)
+        except (OSError, AuthenticationError) as ex:
+            raise RuntimeError("Cannot connect to the remote worker host %s: %s" % (endpoint, ex))
+        # The channel stands for the worker's process.
+        self._channels[worker] = self._pipes[worker] = channel
+        self._remote.add(worker)
+        self._starting[worker] = time.monotonic()
+        return worker
+
+    def _retire_worker(self, worker, kill=False):
+        """
+        Ask a worker to stop. It is removed from the pool when its process
+        exits.
+
+        :param kill: whether to kill the process instead.
+        """
+        self._retiring.add(worker)
+        self._ready.discard(worker)
+        self._starting.pop(worker, None)
+        self._idle_since.pop(worker, None)
+        if kill:
+            self._pipes[worker].kill()
+        else:
+            self._channels[worker].send("die")
+
+    def _remove_worker(self, worker):
+        self._channels.pop(worker).close()
+        del self._pipes[worker]
+        self._retiring.discard(worker)
+        self._remote.discard(worker)
+
+    def _scale(self, jobs):
+        """
+        Add a worker when the queued shards wait for too long, or there are
+        not enough spare workers. Stop a worker which is idle for too long.
+        Workers are started one at a time.
+        """
+        now = time.monotonic()
+        for worker, start_time in list(self._starting.items()):
+            if now - start_time > _STARTUP_TIMEOUT:
+                # The killed worker is replaced as a dead one, which counts as
+                # a failed start (see _respawn_worker).
+                print("Worker %d did not start in %d [s], killing it." % (worker, _STARTUP_TIMEOUT))
+                self._pipes[worker].kill()
+        idle = [worker for worker in self._ready if worker not in self._busy]
+        no_queued = sum(len(job.queue) for job in jobs)
+        no_local_workers = self.no_workers - len(self._remote - self._retiring)
+        if no_local_workers < self.max_workers and not self._starting:
+            if len(idle) < self.spare_workers or \
+                    (no_queued > 0 and not idle and self._get_queue_time(no_queued) > self.max_queue_time):
+                worker = self._add_worker()
+                print("Starting worker %d (%d queued shards, %d idle workers)."
+                      % (worker, no_queued, len(idle)))
+                return
+        local_idle = [worker for worker in idle if worker not in self._remote]
+        if no_local_workers > self.min_workers and len(idle) > self.spare_workers and no_queued == 0 \
+                and local_idle:
+            worker = min(local_idle, key=lambda w: self._idle_since[w])
+            if now - self._idle_since[worker] > self.idle_timeout:
+                print("Stopping worker %d, idle for %.0f [s]." % (worker, now - self._idle_since[worker]))
+                self._retire_worker(worker)
+
+    def _get_queue_time(self, no_queued):
+        """
+        :return: estimated time [s] till the running workers take given
+            number of queued shards.
+        """
+        if self._shard_time is None or not self._ready:
+            return math.inf
+        return no_queued*self._shard_time/len(self._ready)
+
     def _start_session(self, session_id):
         """
         Initialize Field2 simulation.
-        
-        ..warning:
-            Add Field2 to path unless it's added in matlab's path already.
-            Also, in matlab_call, add matlab's path.
-        """
-        prev_dir = os.getcwd()
-        os.chdir(os.path.dirname(__file__))
-        fn_call = (
-            "addpath('/home/spbtu/Manolis_Files/Field2'), " +
-            "field_init, " +
-            "try, " +
-            ("simulate_linear_array(%d, \'%s\',\'%s\'), " % (session_id,
-                                                             self.working_dir.name,
-                                                             self.working_dir.name)) +
-            "exit(0),"
-            "catch ex, " +
-            "fprintf('%s, %s \\n', ex.identifier, ex.message)," +
-            "exit(1), " +
-            "end ")
-        matlab_call = ["/usr/local/MATLAB/R2018a/bin/matlab", "-nosplash", "-nodesktop", "-r", fn_call]
-        pipe = subprocess.Popen(matlab_call)
-        os.chdir(prev_dir)
-        return pipe
+        """
+        return self.start_worker(session_id, self.working_dir.name, self.ipc)
+
+    def _receive(self, timeout=1):
+        """
+        Wait for replies from the workers. Waiting on 'fifo' channels is
+        event-driven, 'file' channels are polled every second.
+
+        The wait is interrupted by '_wakeup' as well.
+
+        :param timeout: max. waiting time [s].
+        :return: list of (worker, message) tuples.
+        """
+        fds = [channel.fileno() for channel in self._channels.values()
+               if channel.fileno() is not None]
+        readable, _, _ = select.select(fds + [self._wakeup_fds[0]], [], [], timeout)
+        if self._wakeup_fds[0] in readable:
+            os.read(self._wakeup_fds[0], 4096)
+        return [(worker, message)
+                for worker, channel in list(self._channels.items())
+                for message in channel.recv()]
+
+    def _get_lines_per_shard(self, no_lines):
+        if self.lines_per_shard is not None:
+            return self.lines_per_shard
+        shards_per_worker = 4 if self.ipc == "fifo" else 1
+        return max(1, math.ceil(no_lines/(shards_per_worker*max(1, len(self._ready)))))
+
+    def _schedule(self, jobs):
+        """
+        Give work to the idle workers: queued shards of the jobs first, then
+        copies of the shards which take too long.
+        """
+        now = time.monotonic()
+        for worker in sorted(self._ready):
+            if worker in self._busy:
+                continue
+            shard = self._get_next_shard(jobs, now)
+            if shard is None:
+                break
+            self._channels[worker].send(
+                "go %s %d %d %d" % (shard.job.name, shard.pose, shard.first, shard.last))
+            shard.workers[worker] = now
+            self._busy[worker] = shard
+            self._idle_since.pop(worker, None)
+
+    def _get_next_shard(self, jobs, now):
+        """
+        :return: the next shard to give to an idle worker, None if there is
+            nothing to do.
+        """
+        queued = [job for job in jobs if job.queue]
+        while queued:
+            job = self._get_next_job(queued)
+            if not job.started:
+                # The job cannot be cancelled from now on.
+                if not job.future.set_running_or_notify_cancel():
+                    queued.remove(job)
+                    continue
+                job.started = True
+            self._no_served += 1
+            self._last_served[job.owner] = self._no_served
+            return job.queue.popleft()
+        for job in sorted(jobs, key=lambda job: job.priority):
+            shard = self._get_straggler(job, now)
+            if shard is not None:
+                return shard
+        return None
+
+    def _get_next_job(self, jobs):
+        """
+        :return: the oldest job of the owner served least recently among the
+            jobs of the highest priority.
+        """
+        priority = min(job.priority for job in jobs)
+        return min((job for job in jobs if job.priority == priority),
+                   key=lambda job: self._last_served.get(job.owner, 0))
+
+    def _get_straggler(self, job, now):
+        """
+        :return: the longest running shard of the job, if it runs for too long
+            and is not speculatively executed already, None otherwise.
+        """
+        if self.speculation_factor is None or self._shard_time is None:
+            return None
+        in_progress = [shard for shard in job.shards
+                       if not shard.is_done() and len(shard.workers) == 1]
+        if not in_progress:
+            return None
+        shard = min(in_progress, key=lambda s: min(s.workers.values()))
+        if now - min(shard.workers.values()) > self.speculation_factor*self._shard_time:
+            return shard
+        return None
+
+    def _handle_reply(self, worker, message):
+        """
+        Handle a 'started' reply: the worker can get shards, or a
+        'done <job> <pose> <first> <last>' reply: the worker is idle again,
+        and the first result of a shard is the one used.
+        """
+        if message == "started" and worker in self._starting:
+            del self._starting[worker]
+            self._ready.add(worker)
+            self._failed_starts = 0
+            self._idle_since[worker] = time.monotonic()
+            return
+        if not message.startswith("done") or worker not in self._busy:
+            return
+        shard = self._busy.pop(worker)
+        scanlines = None
+        if worker in self._remote:
+            scanlines = self._channels[worker].get_scanlines(message)
+        if worker in self._ready:
+            self._idle_since[worker] = time.monotonic()
+        if shard.is_done():
+            self._remove_finished_jobs()
+            return
+        if scanlines is not None:
+            self._store_scanlines(shard, worker, scanlines)
+        shard.done_by = worker
+        if shard.job.on_scanlines is not None and shard.job.rf_buffer is not None:
+            self._stream_scanlines(shard)
+        shard_time = time.monotonic() - shard.workers[worker]
+        if self._shard_time is None:
+            self._shard_time = shard_time
+        else:
+            self._shard_time = 0.8*self._shard_time + 0.2*shard_time
+
+    def _remove_finished_jobs(self):
+        """
+        Remove the files of the merged jobs which have no shards in progress.
+        """
+        in_progress = set(shard.job for shard in self._busy.values())
+        for job in [job for job in self._finished_jobs if job not in in_progress]:
+            job.remove_files()
+            for worker in self._remote:
+                self._channels[worker].release_job(job.name)
+            self._finished_jobs.remove(job)
+
+    def _store_scanlines(self, shard, worker, scanlines):
+        """
+        Store the scanlines of a shard received from a remote worker as a
+        local worker would: to the job's RF buffer, or to .mat files. I/Q
+        data of a job without an RF buffer is kept with the job.
+
+        :param scanlines: rows of the shard's scanlines, in the layout of the
+            RF buffer.
+        """
+        job = shard.job
+        if job.rf_buffer is not None:
+            job.rf_buffer[shard.pose - 1, shard.first - 1:shard.last, :scanlines.shape[1]] = scanlines
+            return
+        if job.iq_decimation is not None:
+            iq_arrays, _ = self._get_iq_arrays(scanlines[None], job.iq_decimation, tail=True)
+            for header, line_iq in zip(scanlines[:, :_RF_BUFFER_HEADER], iq_arrays[0].T):
+                job.remote_iq[(shard.pose, int(header[1]))] = (header, line_iq)
+            return
+        for row in scanlines:
+            tstart, line, end = row[:_RF_BUFFER_HEADER]
+            first = int(np.round(tstart*job.sampling_frequency))
+            # Samples before t=0 were dropped by the worker, zeros stand for them.
+            scanline = np.concatenate((
+                np.zeros(max(-first, 0)),
+                row[_RF_BUFFER_HEADER + max(first, 0):_RF_BUFFER_HEADER + int(end)]))
+            scipy.io.savemat(
+                os.path.join(job.output_dir, "p%d_ln%d.%d.mat" % (shard.pose, line, worker)),
+                {"i": int(line), RF_DATA_MAT_VAR: scanline[:, None], TSTART_MAT_VAR: tstart})
+
+    def _stream_scanlines(self, shard):
+        """
+        Pass the scanlines of a done shard to its job's on_scanlines.
+        """
+        job = shard.job
+        if (shard.pose, shard.first) in job.remote_iq:
+            data = np.stack([job.remote_iq[(shard.pose, line)][1]
+                             for line in range(shard.first, shard.last + 1)], axis=1)
+        elif job.iq_decimation is not None:
+            rows = job.rf_buffer[shard.pose - 1:shard.pose, shard.first - 1:shard.last]
+            iq_arrays, _ = self._get_iq_arrays(rows, job.iq_decimation, tail=True)
+            data = iq_arrays[0]
+        else:
+            rows = job.rf_buffer[shard.pose - 1:shard.pose, shard.first - 1:shard.last]
+            rf_arrays, _ = self._get_rf_arrays(rows)
+            data = self._get_output(np.array(rf_arrays[0]), job.sampling_frequency)
+        try:
+            job.on_scanlines(shard.first - 1, data)
+        except Exception as ex:
+            # The scanlines come with the result as well.
+            print("WARN: on_scanlines of job %s failed: %r" % (job.name, ex))
 
     def _assert_workers_exists(self):
         """
-        Check if there are any workers left.
-        """
-        for worker in range(self.no_workers):
-            if self._pipes[worker].poll() is not None:
-                raise RuntimeError("Worker %d is dead! Check logs, why he has been stopped." % worker)
-
-    def _merge_scanlines(self, scanline_dir, sampling_frequency):
-        ln_path = glob.glob(os.path.join(scanline_dir, "ln*.mat"))
-        mats = (scipy.io.loadmat(line_file) for line_file in ln_path)
-
-        data = [(mat[RF_DATA_MAT_VAR].flatten(), mat[TSTART_MAT_VAR][0][0], mat['i'][0][0])
-                for mat in mats]
-        data.sort(key=operator.itemgetter(2))
-        
-        # Make all scanlines start from t=0.
-        # We pad the scanlines from the left with zeros (because we don't know
-        # what values should be between t=0 and t=tstart).
-        def pad_scanline_from_t_0(scanline, tstart):
-            # we want to start from sample close to t=0
-            idx = np.round(tstart*sampling_frequency).astype(int)
-            if idx <= 0:
-                return scanline[-(idx):]
-            return np.concatenate((np.zeros(idx), scanline))
-        left_padded_data = [(pad_scanline_from_t_0(scanline, tstart), tstart)
-                            for (scanline, tstart, _) in data]
-        t_start_vector = np.array([tstart for (_, tstart) in left_padded_data])
-        # make all scanlines the same size
-        scanline_max_length = max((scanline.shape[0] for (scanline, _) in left_padded_data))
-        right_padded_data = (np.concatenate((scanline, np.zeros(scanline_max_length-scanline.shape[0])))
-                             for scanline, _ in  left_padded_data)
-        columns = [scanline.reshape((-1, 1)) for scanline in right_padded_data]
-        rf_array = np.concatenate(columns, axis=1)
-        return (rf_array, t_start_vector)
+        Check if there are any workers left. The workers which were asked to
+        stop are removed from the pool, the ones which died are replaced.
+        """
+        for worker, pipe in list(self._pipes.items()):
+            if pipe.poll() is None:
+                continue
+            if worker in self._retiring:
+                self._remove_worker(worker)
+            else:
+                self._respawn_worker(worker)
+        if not self._pipes and self.max_workers == 0:
+            raise RuntimeError("All workers are dead, and no local worker can be started.")
+
+    def _respawn_worker(self, worker):
+        """
+        Replace a dead worker with a new one (on the same host), and re-queue
+        the shard it was simulating, unless another worker simulates it too.
+        """
+        if worker in self._starting:
+            self._failed_starts += 1
+            if self._failed_starts > _MAX_FAILED_STARTS:
+                raise RuntimeError("Worker %d is dead! %d workers in a row died before they started, "
+                                   "check logs." % (worker, self._failed_starts))
+        shard = self._busy.pop(worker, None)
+        endpoint = self._channels[worker].endpoint if worker in self._remote else None
+        self._ready.discard(worker)
+        self._starting.pop(worker, None)
+        self._idle_since.pop(worker, None)
+        self._remove_worker(worker)
+        if shard is not None and not shard.is_done():
+            del shard.workers[worker]
+            if not shard.workers:
+                self._retry_shard(shard)
+        self.no_respawns += 1
+        if endpoint is None:
+            new_worker = self._add_worker()
+        else:
+            try:
+                new_worker = self._add_remote_worker(endpoint)
+            except RuntimeError as ex:
+                print("Worker %d is dead and cannot be replaced: %s" % (worker, ex))
+                return
+        print("Worker %d is dead, replaced with worker %d (%d respawns, %d retries so far)."
+              % (worker, new_worker, self.no_respawns, self.no_retries))
+
+    def _retry_shard(self, shard):
+        """
+        Put a shard whose worker died back to the front of its job's queue,
+        or fail the job if the shard was retried max_retries times already.
+        """
+        job = shard.job
+        if job.future.done():
+            return
+        if shard.retries >= self.max_retries:
+            with self._lock:
+                if job not in self._jobs:
+                    return
+                self._jobs.remove(job)
+            job.future.set_exception(RuntimeError(
+                "Shard %d-%d of pose %d of job %s failed %d times, its workers died."
+                % (shard.first, shard.last, shard.pose, job.name, shard.retries + 1)))
+            self._finish_job(job)
+            return
+        shard.retries += 1
+        self.no_retries += 1
+        job.queue.appendleft(shard)
+
+    def _load_scanlines(self, job):
+        """
+        Load the scanlines of a job from .mat files to an RF buffer (of the
+        same layout as the memory-mapped ones).
+
+        :return: (no_poses, no_lines, header + samples) RF buffer.
+        """
+        fs = job.sampling_frequency
+        lines = []
+        for pose in range(1, job.no_poses + 1):
+            for line_file in job.get_line_files(pose):
+                mat = scipy.io.loadmat(line_file)
+                scanline = mat[RF_DATA_MAT_VAR].flatten()
+                tstart = mat[TSTART_MAT_VAR][0][0]
+                # Make the scanline start from t=0: the samples before tstart
+                # are zeros (because we don't know what values should be
+                # between t=0 and t=tstart).
+                first = int(np.round(tstart*fs))
+                if first < 0:
+                    scanline, first = scanline[-first:], 0
+                lines.append((pose, mat['i'][0][0], tstart, first, scanline))
+        no_samples = max((first + scanline.shape[0] for _, _, _, first, scanline in lines), default=0)
+        # The scanlines demodulated by the remote workers have their headers
+        # only, so the RF data is as long as the longest of all scanlines.
+        no_samples = max([no_samples] + [int(header[2]) for header, _ in job.remote_iq.values()])
+        rf_buffer = np.zeros((job.no_poses, job.no_lines, _RF_BUFFER_HEADER + no_samples))
+        for (pose, line), (header, _) in job.remote_iq.items():
+            rf_buffer[pose - 1, line - 1, :_RF_BUFFER_HEADER] = header
+        for pose, line, tstart, first, scanline in lines:
+            row = rf_buffer[pose - 1, line - 1]
+            end = first + scanline.shape[0]
+            row[:_RF_BUFFER_HEADER] = (tstart, line, end)
+            row[_RF_BUFFER_HEADER + first:_RF_BUFFER_HEADER + end] = scanline
+        return rf_buffer
+
+    def _get_rf_arrays(self, rf_buffer):
+        """
+        :param rf_buffer: (no_poses, no_lines, header + samples) RF buffer.
+        :return: (no_poses, samples, no_lines) RF data (a view of the buffer),
+            which ends at the end of the longest scanline, and
+            (no_poses, no_lines) start times of the scanlines.
+        """
+        no_samples = int(np.max(rf_buffer[:, :, 2], initial=0))
+        rf_arrays = rf_buffer[:, :, _RF_BUFFER_HEADER:_RF_BUFFER_HEADER + no_samples]
+        return rf_arrays.transpose(0, 2, 1), np.array(rf_buffer[:, :, 0])
+
+    def _get_iq_arrays(self, rf_buffer, decimation, tail=False):
+        """
+        :param rf_buffer: (no_poses, no_lines, header + samples) RF buffer,
+            whose rows hold I/Q data.
+        :param decimation: decimation factor of the I/Q data.
+        :param tail: whether the filter's tail is returned as well.
+        :return: (no_poses, samples, no_lines) complex64 I/Q data of the RF
+            data which ends at the end of the longest scanline, the same as
+            rf_to_iq of the merged RF data, and (no_poses, no_lines) start
+            times of the scanlines.
+        """
+        no_samples = int(np.max(rf_buffer[:, :, 2], initial=0))
+        no_iq_samples = get_iq_samples(no_samples, decimation, tail)
+        # The rest of each row is zeros: the filter's response to the zeros
+        # after the end of the scanline.
+        values = np.zeros(rf_buffer.shape[:2] + (2*no_iq_samples,))
+        rows = rf_buffer[:, :, _RF_BUFFER_HEADER:_RF_BUFFER_HEADER + 2*no_iq_samples]
+        values[:, :, :rows.shape[2]] = rows
+        iq_arrays = values.view(np.complex128).astype(np.complex64)
+        return iq_arrays.transpose(0, 2, 1), np.array(rf_buffer[:, :, 0])
 
     def _cleanup(self):
         """
         Clear Field2 sessions.
         """
-        for worker in range(self.no_workers):
-            open(os.path.join(self.working_dir.name, ('die.%d' % worker)), 'a').close()
+        self._closing = True
+        if self._dispatcher is not None:
+            self._wakeup()
+            self._dispatcher.join()
+            self._dispatcher = None
+        with self._lock:
+            self._finished_jobs.extend(self._jobs)
+        self._fail_jobs(RuntimeError("Field2 session is closed."))
+        for channel in self._channels.values():
+            channel.send("die")
         print("Waiting till all child processes die...")
-        for pipe in self._pipes:
+        for pipe in self._pipes.values():
             while pipe.poll() is None:
                 time.sleep(2)
+        for channel in self._channels.values():
+            channel.close()
+        self._channels, self._pipes = {}, {}
+        for job in self._finished_jobs:
+            job.remove_files()
+        self._finished_jobs = []
+        for phantom_file, _, _ in self._phantoms.values():
+            if os.path.isfile(phantom_file):
+                os.remove(phantom_file)
+        self._phantoms = {}
+        if self._buffer_dir is not None:
+            self._buffer_dir.cleanup()
         print("All subprocesses are dead now, session is closed.")
@@ -1,9 +1,68 @@
 import numpy as np
 import random
-from scipy import signal, interpolate
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from scipy import fft, interpolate, ndimage
+from scipy.sparse.linalg import splu
 from envs.utils import to_string, copy_and_apply
 
 
+# Max number of input shapes, which interpolation matrices are kept for (the
+# number of samples varies between frames when the RF data is not gated).
+_INTERP_CACHE_SIZE = 8
+
+
+# Number of threads of the FFTs of the envelope detection, all cores if -1.
+_FFT_WORKERS = -1
+
+
+# Version of the imaging pipeline, increased when its changes change the
+# images (2: envelope FFT zero padded to a fast length), see
+# ImagingSystem.get_signature.
+IMAGING_VERSION = 2
+
+
+@lru_cache(maxsize=_INTERP_CACHE_SIZE)
+def _get_analytic_mask(n):
+    """
+    :return: (n//2 + 1, 1) weights of the one-sided spectrum of a real signal
+        of length n, which give its analytic signal (as in
+        scipy.signal.hilbert).
+    """
+    mask = np.full((n//2 + 1, 1), 2.0)
+    mask[0] = 1
+    if n % 2 == 0:
+        mask[-1] = 1
+    return mask
+
+
+def _get_interp_matrix(input_xs, output_xs):
+    """
+    Matrix of the cubic spline interpolation (not-a-knot, the same as
+    FITPACK's interpolating spline) from given input to output points:
+    interpolated values are matrix @ values. Output points outside the
+    input range are clipped to it. Less than 4 input points are
+    interpolated linearly.
+
+    :param input_xs: increasing input points.
+    :param output_xs: output points.
+    :return: (len(output_xs), len(input_xs)) array.
+    """
+    if len(input_xs) == 1:
+        return np.ones((len(output_xs), 1))
+    if len(input_xs) < 4:
+        k, t = 1, np.r_[input_xs[0], input_xs, input_xs[-1]]
+    else:
+        k, t = 3, np.r_[(input_xs[0],)*4, input_xs[2:-2], (input_xs[-1],)*4]
+    # Values at the output points are basis @ inv(collocation) @ values.
+    collocation = interpolate.BSpline.design_matrix(input_xs, t, k)
+    basis = interpolate.BSpline.design_matrix(
+        np.clip(output_xs, input_xs[0], input_xs[-1]), t, k)
+    return splu(collocation.T.tocsc()).solve(basis.T.toarray()).T
+
+
 class Probe:
     """
     Probe used to scan the environment.
@@ -91,6 +150,15 @@ class ImagingSystem:
     :param dr_threshold: dynamic range threshold
     :param dec: RF data decimation factor
     :param no_lines: number of lines of RF data. 
+    :param iq_decimation: decimation factor of the I/Q data given to
+        'image_iq', w.r.t. fs.
+    :param dtype: type of the B-mode images. For floating point types,
+        the imaging after the log compression runs in this precision as
+        well: np.float32 halves the memory of the observations (and of the
+        cache). With np.uint8, images are computed in float32 and quantized
+        to [0, 255]. The envelope and its log compression are always
+        computed in float64, as the noise floor of float32 (about -140 dB)
+        is within the usual dynamic range thresholds.
     """
     def __init__(
         self,
@@ -102,7 +170,9 @@ class ImagingSystem:
         median_filter_size,
         dr_threshold,
         no_lines,
-        dec=1
+        dec=1,
+        iq_decimation=None,
+        dtype=np.float64
     ):
 
         self.c = c
@@ -114,40 +184,280 @@ class ImagingSystem:
         self.dr_threshold = dr_threshold
         self.dec = dec
         self.no_lines = no_lines
+        self.iq_decimation = iq_decimation
+        self.dtype = np.dtype(dtype)
+        # Precision of the imaging.
+        self._float_dtype = self.dtype if self.is_float() else np.dtype(np.float32)
+        # Thread of the streamed imaging, started with the first stream.
+        self._executor = None
+        # (input shape, fs) -> interpolation matrices of the rows and columns.
+        self._interp_matrices = OrderedDict()
 
-    def _interp(self, data):
-        input_xs = np.arange(0, data.shape[1])*(self.image_width/data.shape[1])
-        input_zs = np.arange(0, data.shape[0])*(self.c/(2*self.fs))
-        output_xs = np.arange(
-            self.image_width,
-            step=self.image_width/self.image_resolution[0])
-        output_zs = np.arange(
-            self.image_height,
-            step=self.image_height/self.image_resolution[1])
-        return interpolate.interp2d(input_xs, input_zs, data, kind="cubic")\
-            (output_xs, output_zs)
+    def is_float(self):
+        """
+        :return: whether the B-mode images are floating point, in [0, 1].
+            Otherwise they are quantized to [0, 255].
+        """
+        return np.issubdtype(self.dtype, np.floating)
+
+    def get_signature(self):
+        """
+        :return: string which identifies the images of this imaging system:
+            the version of the pipeline and the parameters the images depend
+            on. The dtype is not included, see 'convert'.
+        """
+        return repr((
+            IMAGING_VERSION, self.c, self.fs, self.image_width, self.image_height,
+            tuple(self.image_resolution), self.median_filter_size, self.dr_threshold,
+            self.dec, self.no_lines, self.iq_decimation))
+
+    def convert(self, bmode):
+        """
+        :param bmode: B-mode image(s) of any dtype returned by an imaging
+            system, e.g. from a cache saved with another dtype.
+        :return: the image(s) with this imaging system's dtype.
+        """
+        bmode = np.asarray(bmode)
+        if bmode.dtype == self.dtype:
+            return bmode
+        if not np.issubdtype(bmode.dtype, np.floating):
+            bmode = bmode/255
+        return self._quantize(bmode.astype(self._float_dtype))
+
+    def _quantize(self, data):
+        """
+        :param data: B-mode image(s) with values in [0, 1].
+        :return: the image(s) with this imaging system's dtype.
+        """
+        if self.is_float():
+            return data
+        return np.round(data*255).astype(self.dtype)
+
+    def _interp(self, data, fs=None):
+        """
+        Bicubic spline interpolation of the data to the image's grid, as two
+        matrix products. The matrices depend on the data's shape and fs
+        only, so they are computed once per shape.
+        """
+        if fs is None:
+            fs = self.fs
+        key = (data.shape[-2:], fs)
+        if key in self._interp_matrices:
+            self._interp_matrices.move_to_end(key)
+        else:
+            input_xs = np.arange(0, data.shape[-1])*(self.image_width/data.shape[-1])
+            input_zs = np.arange(0, data.shape[-2])*(self.c/(2*fs))
+            output_xs = np.arange(
+                self.image_width,
+                step=self.image_width/self.image_resolution[0])
+            output_zs = np.arange(
+                self.image_height,
+                step=self.image_height/self.image_resolution[1])
+            self._interp_matrices[key] = (
+                _get_interp_matrix(input_zs, output_zs).astype(self._float_dtype),
+                _get_interp_matrix(input_xs, output_xs).T.astype(self._float_dtype))
+            while len(self._interp_matrices) > _INTERP_CACHE_SIZE:
+                self._interp_matrices.popitem(last=False)
+        rows, columns = self._interp_matrices[key]
+        return rows @ data @ columns
 
     def _detect_envelope(self, data):
-        return np.abs(signal.hilbert(data, axis=0))
+        """
+        :param data: (..., samples, no_lines) RF data.
+        :return: envelope of the data: magnitude of its analytic signal. The
+            data is zero padded to a fast FFT length.
+        """
+        data = data.astype(np.float64, copy=False)
+        no_samples = data.shape[-2]
+        n = fft.next_fast_len(no_samples, real=True)
+        spectrum = fft.rfft(data, n, axis=-2, workers=_FFT_WORKERS)
+        spectrum *= _get_analytic_mask(n)
+        analytic = fft.ifft(spectrum, n, axis=-2, workers=_FFT_WORKERS)
+        return np.abs(analytic[..., :no_samples, :])
 
     def _adjust_dynamic_range(self, data, dr=-60):
-        nonzero_idx = data != 0
-        data = 20*np.log10(np.abs(data)/np.max((np.abs(data[nonzero_idx]))))
-        return np.clip(data, dr, 0)
+        """
+        :param data: (..., samples, no_lines) envelope, each frame is
+            normalized to its max.
+        :return: the log-compressed data [dB] in the imaging's precision.
+        """
+        data = np.abs(data).astype(np.float64, copy=False)
+        data = 20*np.log10(data/np.max(data, axis=(-2, -1), keepdims=True))
+        return np.clip(data, dr, 0).astype(self._float_dtype, copy=False)
 
     def image(self, rf):
         """
         Computes new B-mode image from given RF data.
 
         :param rf: recorded ultrasound signal to image
-        :return: B-mode image with values in [0, 1]
+        :return: B-mode image with values in [0, 1] ([0, 255] for uint8 dtype)
         """
         data = rf[::self.dec, :]
         data = self._detect_envelope(data)
+        return self._image_envelope(data)
+
+    def image_iq(self, iq):
+        """
+        Computes new B-mode image from given baseband (I/Q) data, e.g.
+        returned by a simulator with the same iq_decimation. The envelope is
+        the magnitude of the I/Q data.
+
+        :param iq: (samples, no_lines) I/Q data, which starts at t=0,
+            sampled at fs/iq_decimation.
+        :return: B-mode image with values in [0, 1] ([0, 255] for uint8 dtype)
+        """
+        if self.iq_decimation is None:
+            raise ValueError("iq_decimation of the imaging system is not set.")
+        data = np.abs(iq).astype(self._float_dtype)
+        return self._image_envelope(data, fs=self.fs/self.iq_decimation)
+
+    def image_batch(self, rf_arrays):
+        """
+        Computes B-mode images of a stack of frames at once, e.g. returned by
+        Simulator.simulate_linear_array_batch. Each step is vectorized
+        across the frames.
+
+        :param rf_arrays: (N, samples, no_lines) RF data, or I/Q data (see
+            'image_iq').
+        :return: (N, 1, H, W) B-mode images with values in [0, 1] ([0, 255]
+            for uint8 dtype), the same as the observations of the environment.
+        """
+        if np.iscomplexobj(rf_arrays):
+            if self.iq_decimation is None:
+                raise ValueError("iq_decimation of the imaging system is not set.")
+            data = np.abs(rf_arrays).astype(self._float_dtype)
+            fs = self.fs/self.iq_decimation
+        else:
+            data = self._detect_envelope(rf_arrays[:, ::self.dec, :])
+            fs = None
+        return self._image_envelope(data, fs=fs)[:, None]
+
+    def stream(self):
+        """
+        Start imaging a frame scanline by scanline, as the scanlines arrive
+        from a simulator, see ScanlineStream.
+
+        :return: ScanlineStream of the frame.
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ImagingSystem")
+        return ScanlineStream(self, self._executor)
+
+    def _compress_scanlines(self, data):
+        """
+        :param data: (samples, k) RF or I/Q data of k scanlines.
+        :return: log-compressed envelope of the scanlines [dB], not
+            normalized.
+        """
+        if np.iscomplexobj(data):
+            data = np.abs(data).astype(self._float_dtype)
+        else:
+            data = self._detect_envelope(data[::self.dec, :])
+        with np.errstate(divide="ignore"):
+            return 20*np.log10(data)
+
+    def _image_envelope(self, data, fs=None):
+        """
+        :param data: (..., samples, no_lines) envelope of the RF data.
+        :param fs: sampling frequency of the envelope, fs if None.
+        :return: B-mode image with values in [0, 1] ([0, 255] for uint8 dtype)
+        """
         data = self._adjust_dynamic_range(data, dr=self.dr_threshold)
-        data = self._interp(data)
-        data = signal.medfilt(data, kernel_size=self.median_filter_size)
-        data = data-data.min()
-        data = data/data.max()
-        return data
+        return self._image_compressed(data, fs)
 
+    def _image_compressed(self, data, fs=None):
+        """
+        :param data: (..., samples, no_lines) log-compressed envelope, in
+            [dr_threshold, 0] dB.
+        :param fs: sampling frequency of the envelope, fs if None.
+        :return: (..., H, W) B-mode images with values in [0, 1] ([0, 255] for uint8 dtype)
+        """
+        data = self._interp(data, fs)
+        # Each frame is filtered and normalized on its own.
+        kernel_size = (1,)*(data.ndim - 2) + (self.median_filter_size,)*2
+        # The same as signal.medfilt, which pads with zeros.
+        data = ndimage.median_filter(data, size=kernel_size, mode="constant", cval=0.0)
+        data = data-data.min(axis=(-2, -1), keepdims=True)
+        data = data/data.max(axis=(-2, -1), keepdims=True)
+        return self._quantize(data)
+
+
+class ScanlineStream:
+    """
+    ScanlineStream: Images a frame of RF (or I/Q) data scanline by scanline,
+    as the scanlines arrive from the simulator (see 'on_scanlines' of
+    Simulator.submit). Envelope detection and log compression of the
+    scanlines run in the background, so only normalization, interpolation
+    and the median filter wait for the last scanline.
+
+    Scanlines are envelope-detected on their own, so the samples near the
+    end of a scanline may differ slightly from ImagingSystem.image, where
+    all the scanlines are zero padded to the longest one.
+
+    :param imaging: imaging system of the frame.
+    :param executor: executor which compresses the scanlines.
+    """
+    def __init__(self, imaging, executor):
+        self.imaging = imaging
+        self._executor = executor
+        # scanline -> log-compressed envelope.
+        self._scanlines = {}
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def add_scanlines(self, first_line, data):
+        """
+        Start compressing received scanlines, without waiting for it.
+
+        :param first_line: index of the first scanline (counting from 0).
+        :param data: (samples, k) RF or I/Q data of k consecutive
+            scanlines, which starts at t=0.
+        """
+        future = self._executor.submit(self._compress, first_line, data)
+        with self._lock:
+            self._pending.append(future)
+
+    def image(self, data):
+        """
+        Computes the B-mode image of the frame, when all the scanlines are
+        received. The scanlines which were not streamed are imaged from
+        given data.
+
+        :param data: (samples, no_lines) RF or I/Q data of the frame,
+            returned by the simulator.
+        :return: B-mode image with values in [0, 1] ([0, 255] for uint8 dtype)
+        """
+        with self._lock:
+            pending = list(self._pending)
+        for future in pending:
+            future.result()
+        missing = [line for line in range(data.shape[1]) if line not in self._scanlines]
+        if missing:
+            self._compress(0, data[:, missing], lines=missing)
+        fs = None
+        if np.iscomplexobj(data):
+            if self.imaging.iq_decimation is None:
+                raise ValueError("iq_decimation of the imaging system is not set.")
+            fs = self.imaging.fs/self.imaging.iq_decimation
+        else:
+            data = data[::self.imaging.dec, :]
+        no_samples = data.shape[0]
+        compressed = np.full((no_samples, data.shape[1]), -np.inf)
+        for line in range(data.shape[1]):
+            scanline = self._scanlines[line][:no_samples]
+            compressed[:scanline.shape[0], line] = scanline
+        compressed = np.clip(compressed - np.max(compressed), self.imaging.dr_threshold, 0)
+        compressed = compressed.astype(self.imaging._float_dtype)
+        return self.imaging._image_compressed(compressed, fs)
+
+    def _compress(self, first_line, data, lines=None):
+        """
+        :param lines: indices of the scanlines of data, consecutive from
+            first_line if None.
+        """
+        compressed = self.imaging._compress_scanlines(data)
+        if lines is None:
+            lines = range(first_line, first_line + data.shape[1])
+        with self._lock:
+            for k, line in enumerate(lines):
+                self._scanlines[line] = compressed[:, k]
@@ -293,6 +293,46 @@ class ScatterersPhantom:
         amps[bck_amps_idx] = self.bck_amp*amps[bck_amps_idx]
         return points, amps
 
+    def get_static_points(self, window):
+        """
+        Returns positions and amps of a fixed set of scatterers of the whole
+        phantom, in the phantom's frame, to be made resident in a simulator
+        (see Simulator.upload_phantom). Scatterers have the same density as
+        the ones returned by 'get_points' and cover the FOV of a probe at any
+        position within the x/y borders and at any angle.
+
+        :param window: (x size, y size) of the probe's FOV [m].
+        :return: (points, amps), where:
+            points - an array (N,3) with scatterers positions (x,y,z)
+            amps - point amplitude
+        """
+        x_size, y_size = window
+        margin = math.hypot(x_size, y_size)/2
+        x_range = (self.x_border[0]-margin, self.x_border[1]+margin)
+        y_range = (self.y_border[0]-margin, self.y_border[1]+margin)
+        # Number of FOVs which fit the area.
+        scale = (x_range[1]-x_range[0])*(y_range[1]-y_range[0])/(x_size*y_size)
+
+        def get_uniform_points(n):
+            xs = self.rng.uniform(x_range[0], x_range[1], (n, 1))
+            ys = self.rng.uniform(y_range[0], y_range[1], (n, 1))
+            zs = self.rng.uniform(self.z_border[0], self.z_border[1], (n, 1))
+            points = np.concatenate((xs, ys, zs), axis=1)
+            points_idx = self.objects[0].contains(points)
+            for o in self.objects[1:]:
+                points_idx = np.logical_or(points_idx, o.contains(points))
+            return points, points_idx
+
+        points, points_idx = get_uniform_points(int(self.n_scatterers*scale))
+        objects_points = points[points_idx]
+        points, points_idx = get_uniform_points(int(self.n_bck_scatterers*scale))
+        background_points = points[np.logical_not(points_idx)]
+        points = np.concatenate((objects_points, background_points))
+        amps = self.rng.randn(points.shape[0], 1)
+        amps[:objects_points.shape[0]] *= self.obj_amp
+        amps[objects_points.shape[0]:] *= self.bck_amp
+        return points, amps
+
     def get_main_object(self):
         return self.objects[0]
 
@@ -0,0 +1,303 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+import numpy as np
+import scipy.io
+from envs.simulator import (
+    cull_points, get_fov_points, get_gate_samples, rf_to_iq, _IQ_FILTER_HALF_TAPS)
+
+# Same settings as in 'simulate_linear_array.m'.
+_SAMPLING_FREQUENCY = 100e6
+_SPEED_OF_SOUND = 1540
+_CENTER_FREQUENCY = 3.5e6
+_PROBE_HALF_LENGTH = 192*(_SPEED_OF_SOUND/_CENTER_FREQUENCY + 0.05/1000)/2
+# Width of the synthetic beam at the focal depth [m], and the distance [m]
+# from the focal depth at which it is sqrt(2) times wider.
+_BEAM_WIDTH = 1/1000
+_FOCAL_RANGE = 10/1000
+
+
+def _get_pulse():
+    """
+    :return: two-way pulse of the synthetic RF data, sampled at the
+        sampling frequency.
+    """
+    t = np.arange(0, 4/_CENTER_FREQUENCY, 1/_SAMPLING_FREQUENCY)
+    return np.sin(2*np.pi*_CENTER_FREQUENCY*t)*np.hanning(t.shape[0])
+
+
+class PythonWorker:
+    """
+    PythonWorker: A stand-in for the Field2 worker ('simulate_linear_array.m'),
+    which needs neither MATLAB nor Field II, e.g. to test or profile Field2
+    on any machine. It speaks the same protocol ('started'/'go'/'done'/'die'
+    over 'file' or 'fifo' channels), reads the same job files and writes the
+    scanlines the same way (to the RF buffer or to
+    '<job>.rf/p<pose>_ln<i>.<id>.mat' files).
+
+    RF data is synthetic: every scatterer echoes a pulse at its two-way
+    travel time, weighted by its lateral distance from the scanline w.r.t.
+    the width of a beam focused at z_focus. Simulating a scanline takes
+    line_time [s], plus a uniformly distributed jitter.
+
+    :param worker_id: id of the worker.
+    :param working_dir: directory of the worker's requests, replies and
+        jobs.
+    :param ipc: 'fifo' or 'file'.
+    :param line_time: mean time [s] of simulating a scanline.
+    :param jitter: max. deviation [s] of the time of a scanline from
+        line_time.
+    :param startup_time: time [s] before the worker replies 'started'.
+    :param poll_interval: interval [s] of polling the request files
+        ('file' channel).
+    :param seed: seed of the jitter.
+    """
+    def __init__(
+        self,
+        worker_id,
+        working_dir,
+        ipc="file",
+        line_time=0.0,
+        jitter=0.0,
+        startup_time=0.0,
+        poll_interval=1.0,
+        seed=None
+    ):
+        self.worker_id = worker_id
+        self.working_dir = working_dir
+        self.ipc = ipc
+        self.line_time = line_time
+        self.jitter = jitter
+        self.startup_time = startup_time
+        self.poll_interval = poll_interval
+        self._random = np.random.default_rng(seed)
+        self._pulse = _get_pulse()
+        self._cmd = None
+        # The job's data is loaded once, even if the worker gets several
+        # shards of the same job; the phantom stays loaded for the next jobs.
+        self._job_name, self._job_data, self._rf_buffer = None, None, None
+        self._phantom_file, self._phantom = None, None
+
+    def run(self):
+        """
+        Serve the requests till 'die' is received.
+        """
+        if self.ipc == "fifo":
+            # Field2 keeps both ends of the pipes open, so opening does not
+            # block.
+            self._cmd = open(self._get_path("cmd"))
+        time.sleep(self.startup_time)
+        self._send("started")
+        try:
+            while True:
+                request = self._receive().split()
+                if not request or request[0] == "die":
+                    break
+                if request[0] == "go":
+                    job, pose, first, last = request[1], int(request[2]), int(request[3]), int(request[4])
+                    self._simulate_shard(job, pose, first, last)
+                    self._send("done %s %d %d %d" % (job, pose, first, last))
+        finally:
+            if self._cmd is not None:
+                self._cmd.close()
+
+    def _simulate_shard(self, job, pose, first, last):
+        self._load_job(job)
+        job_data = self._job_data
+        point_positions, point_amplitudes = self._get_points(pose)
+        no_lines = int(job_data["no_lines"].flatten()[0])
+        image_width = float(job_data["image_width"].flatten()[0])
+        z_focus = float(job_data["z_focus"].flatten()[pose - 1])
+        depth_gate = job_data["depth_gate"].flatten() if "depth_gate" in job_data else np.zeros(0)
+        output_dir = os.path.join(self.working_dir, job + ".rf")
+        if self._rf_buffer is None:
+            os.makedirs(output_dir, exist_ok=True)
+        for line in range(first, last + 1):
+            started = time.monotonic()
+            x = -image_width/2 + (line - 1)*image_width/no_lines
+            rf_data, tstart = self._simulate_scanline(point_positions, point_amplitudes, x, z_focus)
+            if depth_gate.size > 0:
+                rf_data, tstart = self._gate_scanline(rf_data, tstart, depth_gate)
+            if self._rf_buffer is None:
+                scipy.io.savemat(
+                    os.path.join(output_dir, "p%d_ln%d.%d.mat" % (pose, line, self.worker_id)),
+                    {"i": line, "rf_data": rf_data[:, None], "tstart": tstart})
+            else:
+                self._write_scanline((pose - 1)*no_lines + line - 1, line, rf_data, tstart)
+            delay = self.line_time + self._random.uniform(-self.jitter, self.jitter)
+            time.sleep(max(0.0, delay - (time.monotonic() - started)))
+
+    def _load_job(self, job):
+        if job == self._job_name:
+            return
+        self._job_data = scipy.io.loadmat(os.path.join(self.working_dir, job))
+        self._job_name = job
+        self._rf_buffer = None
+        rf_buffer = self._job_data["rf_buffer"]
+        if rf_buffer.size > 0:
+            self._rf_buffer = np.memmap(str(rf_buffer[0]), dtype=np.float64, mode="r+")
+
+    def _get_points(self, pose):
+        """
+        :return: points (in the probe's frame) and amplitudes of given pose.
+        """
+        job_data = self._job_data
+        phantom = job_data["phantom"]
+        if phantom.size == 0:
+            return (np.asarray(job_data["point_positions"].flatten()[pose - 1], dtype=np.float64).reshape(-1, 3),
+                    np.asarray(job_data["point_amplitudes"].flatten()[pose - 1], dtype=np.float64).reshape(-1, 1))
+        if str(phantom[0]) != self._phantom_file:
+            self._phantom = scipy.io.loadmat(str(phantom[0]))
+            self._phantom_file = str(phantom[0])
+        points, amps = get_fov_points(
+            self._phantom["phantom_positions"], self._phantom["phantom_amplitudes"],
+            job_data["probe_pos"][pose - 1], float(job_data["probe_angle"].flatten()[pose - 1]),
+            job_data["fov"].flatten())
+        depth_gate = job_data["depth_gate"].flatten() if "depth_gate" in job_data else np.zeros(0)
+        # Points of the other jobs are culled before they are saved.
+        if depth_gate.size > 0:
+            points, amps = cull_points(points, amps, depth_gate, _PROBE_HALF_LENGTH)
+        return points, amps
+
+    def _simulate_scanline(self, point_positions, point_amplitudes, x, z_focus):
+        """
+        :return: synthetic RF data of the scanline at given lateral position,
+            and the time of its first sample.
+        """
+        if point_positions.shape[0] == 0:
+            return np.zeros(1), 0.0
+        xs, ys, zs = point_positions[:, 0] - x, point_positions[:, 1], point_positions[:, 2]
+        beam_width = _BEAM_WIDTH*np.sqrt(1 + ((zs - z_focus)/_FOCAL_RANGE)**2)
+        weights = point_amplitudes[:, 0]*np.exp(-(xs**2 + ys**2)/beam_width**2)
+        in_beam = np.abs(weights) > 1e-3*np.max(np.abs(point_amplitudes), initial=0)
+        if not np.any(in_beam):
+            return np.zeros(1), 0.0
+        delays = 2*np.sqrt(xs[in_beam]**2 + ys[in_beam]**2 + zs[in_beam]**2)/_SPEED_OF_SOUND
+        samples = np.round(delays*_SAMPLING_FREQUENCY).astype(int)
+        first = samples.min()
+        rf_data = np.zeros(samples.max() - first + self._pulse.shape[0])
+        for weight, sample in zip(weights[in_beam], samples - first):
+            rf_data[sample:sample + self._pulse.shape[0]] += weight*self._pulse
+        return rf_data, first/_SAMPLING_FREQUENCY
+
+    def _gate_scanline(self, rf_data, tstart, depth_gate):
+        """
+        Keep the samples of the depth gate only, the same as gate_scanline
+        in 'simulate_linear_array.m'.
+        """
+        first = int(round(tstart*_SAMPLING_FREQUENCY))
+        gate_first, gate_end = get_gate_samples(depth_gate, _SAMPLING_FREQUENCY, _SPEED_OF_SOUND)
+        start = max(gate_first - first, 0)
+        end = min(gate_end - first, rf_data.shape[0])
+        if end <= start:
+            return np.zeros(1), gate_first/_SAMPLING_FREQUENCY
+        return rf_data[start:end], (first + start)/_SAMPLING_FREQUENCY
+
+    def _write_scanline(self, row, line, rf_data, tstart):
+        """
+        Write a scanline to its row of the RF buffer, the same as
+        write_scanline in 'simulate_linear_array.m'. If the job's RF data is
+        demodulated, the row holds the scanline's I/Q data (with the
+        filter's tail, see rf_to_iq), as interleaved real and imaginary
+        parts.
+        """
+        row_length = 3 + int(self._job_data["rf_buffer_samples"].flatten()[0])
+        offset = row*row_length
+        iq_decimation = self._job_data.get("iq_decimation", np.zeros(0))
+        max_samples = row_length - 3
+        if iq_decimation.size > 0:
+            decimation = int(iq_decimation.flatten()[0])
+            # RF samples whose I/Q data fits to the row.
+            max_samples = ((row_length - 3)//2 - _IQ_FILTER_HALF_TAPS)*decimation
+        first = int(round(tstart*_SAMPLING_FREQUENCY))
+        if first < 0:
+            rf_data, first = rf_data[-first:], 0
+        last = min(first + rf_data.shape[0], max_samples)
+        if iq_decimation.size == 0:
+            self._rf_buffer[offset + 3 + first:offset + 3 + last] = rf_data[:last - first]
+        elif last > first:
+            # The samples before tstart are zeros.
+            scanline = np.zeros(last)
+            scanline[first:] = rf_data[:last - first]
+            iq = rf_to_iq(scanline[:, None], _SAMPLING_FREQUENCY,
+                          float(self._job_data["center_frequency"].flatten()[0]),
+                          decimation, tail=True)
+            values = iq[:, 0].astype(np.complex128).view(np.float64)
+            self._rf_buffer[offset + 3:offset + 3 + values.shape[0]] = values
+        # The header is written after the samples.
+        self._rf_buffer[offset:offset + 3] = (tstart, line, last)
+
+    def _get_path(self, name):
+        return os.path.join(self.working_dir, "%s.%d" % (name, self.worker_id))
+
+    def _receive(self):
+        if self.ipc == "fifo":
+            # Blocks till a request is written to the pipe.
+            return self._cmd.readline().strip() or "die"
+        go_file, die_file = self._get_path("go"), self._get_path("die")
+        while not os.path.isfile(go_file) and not os.path.isfile(die_file):
+            time.sleep(self.poll_interval)
+        if os.path.isfile(die_file):
+            return "die"
+        with open(go_file) as f:
+            message = f.read().strip()
+        os.remove(go_file)
+        return message
+
+    def _send(self, message):
+        if self.ipc == "fifo":
+            with open(self._get_path("reply"), "w") as f:
+                f.write(message + "\n")
+        elif message == "started":
+            open(self._get_path("started"), "w").close()
+        else:
+            # The reply is written to a temporary file first, so Field2 never
+            # reads a partially written one.
+            ready_file = self._get_path("ready")
+            with open(ready_file + ".tmp", "w") as f:
+                f.write(message)
+            os.replace(ready_file + ".tmp", ready_file)
+
+
+def start_python_worker(worker_id, working_dir, ipc, line_time=0.0, jitter=0.0, startup_time=0.0):
+    """
+    Start a process running a PythonWorker, the same as start_matlab_worker.
+
+    :param line_time: mean time [s] of simulating a scanline.
+    :param jitter: max. deviation [s] of the time of a scanline.
+    :param startup_time: time [s] before the worker is started.
+    :return: subprocess.Popen of the worker's process.
+    """
+    return subprocess.Popen(
+        [sys.executable, "-m", "envs.python_worker", str(worker_id), working_dir, ipc,
+         "--line_time", str(line_time), "--jitter", str(jitter), "--startup_time", str(startup_time)],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a Python stand-in of the Field2 worker.")
+    parser.add_argument("worker_id", type=int, help="Id of the worker")
+    parser.add_argument("working_dir", type=str, help="Working directory of the Field2 session")
+    parser.add_argument("ipc", type=str, choices=("file", "fifo"), help="Channel of the requests and replies")
+    parser.add_argument("--line_time", dest="line_time", type=float, default=0.0,
+                        help="Mean time of simulating a scanline [s]")
+    parser.add_argument("--jitter", dest="jitter", type=float, default=0.0,
+                        help="Max. deviation of the time of a scanline [s]")
+    parser.add_argument("--startup_time", dest="startup_time", type=float, default=0.0,
+                        help="Time before the worker is started [s]")
+    args = parser.parse_args()
+
+    PythonWorker(
+        worker_id=args.worker_id,
+        working_dir=args.working_dir,
+        ipc=args.ipc,
+        line_time=args.line_time,
+        jitter=args.jitter,
+        startup_time=args.startup_time
+    ).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+import argparse
+import os
+import select
+import shutil
+import stat
+import tempfile
+import threading
+import time
+import numpy as np
+import scipy.io
+from functools import partial
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener
+from envs.fieldii import (
+    _FifoChannel, start_matlab_worker, RF_BUFFER_MAT_VAR, RF_BUFFER_SAMPLES_MAT_VAR,
+    PHANTOM_MAT_VAR, IQ_DECIMATION_MAT_VAR, REMOTE_AUTHKEY_ENV_VAR, _RF_BUFFER_HEADER,
+    _STARTUP_TIMEOUT)
+from envs.python_worker import start_python_worker
+from envs.simulator import get_iq_samples
+
+
+class RemoteWorkerHost:
+    """
+    RemoteWorkerHost: Runs Field2 workers for a Field2 session on another
+    host. Field2 connects to the host's TCP endpoint once per worker (see
+    the 'remote_workers' parameter), and the host starts a MATLAB worker
+    ('simulate_linear_array.m') in a working directory of its own for every
+    connection. The worker is stopped when the connection is closed.
+
+    Requests and replies of the worker are passed through the connection.
+    Job and phantom files are received before the worker's first shard of
+    the job. The worker writes the scanlines to a memory-mapped RF buffer on
+    this host, and the rows of the shard are sent back with its 'done'
+    reply. If the job's RF data is demodulated (see 'iq_decimation' of
+    Field2), the worker writes the I/Q data of the scanlines to the rows, so
+    only the I/Q data is sent.
+
+    Each message is a tuple:
+        Field2 -> host: ('message', request), ('job', name, content),
+            ('phantom', name, content), ('remove', job name)
+        host -> Field2: ('message', reply, scanlines or None), where
+            scanlines are rows of the RF buffer
+
+    :param address: (host, port) to listen on.
+    :param authkey: key used to authenticate the connections. Messages of
+        the connections are unpickled, so a host without a key would run
+        code sent by anyone who can reach it.
+    :param start_worker: function which starts a worker, the same as
+        'start_matlab_worker'.
+    """
+    def __init__(self, address, authkey, start_worker=start_matlab_worker):
+        if not authkey:
+            raise ValueError("Remote worker host requires an authkey.")
+        self.address = address
+        self.authkey = authkey
+        self.start_worker = start_worker
+        self._listener = None
+        self._no_workers = 0
+
+    def serve_forever(self):
+        """
+        Accept connections till the host is interrupted.
+        """
+        self._listener = Listener(self.address, family="AF_INET", authkey=self.authkey)
+        print("Remote worker host is listening on %s:%d." % self._listener.address)
+        try:
+            while True:
+                try:
+                    connection = self._listener.accept()
+                except AuthenticationError as ex:
+                    print("Rejected a connection: %s" % ex)
+                    continue
+                self._no_workers += 1
+                threading.Thread(
+                    target=self._serve_worker,
+                    args=(connection, self._no_workers),
+                    name="RemoteWorkerHost-worker-%d" % self._no_workers,
+                    daemon=True
+                ).start()
+        finally:
+            self.close()
+
+    def close(self):
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+
+    def _serve_worker(self, connection, worker_id):
+        """
+        Start a worker and pass the messages between the worker and the
+        connection, till either of them is closed.
+        """
+        working_dir = tempfile.mkdtemp(suffix='_fieldii_remote')
+        buffer_dir = tempfile.mkdtemp(
+            suffix='_fieldii_remote', dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+        # job -> RF buffer of the job on this host, and the decimation
+        # factor of its I/Q data or None.
+        rf_buffers = {}
+        channel = _FifoChannel(working_dir, 0)
+        process = self.start_worker(0, working_dir, "fifo")
+        print("Started worker %d." % worker_id)
+        try:
+            while process.poll() is None:
+                readable, _, _ = select.select(
+                    [connection.fileno(), channel.fileno()], [], [], 1)
+                if channel.fileno() in readable:
+                    for reply in channel.recv():
+                        connection.send(("message", reply, self._get_scanlines(reply, rf_buffers)))
+                if connection.fileno() in readable:
+                    kind, *payload = connection.recv()
+                    if kind == "message":
+                        channel.send(payload[0])
+                    elif kind == "job":
+                        rf_buffers[payload[0]] = self._save_job(working_dir, buffer_dir, *payload)
+                    elif kind == "phantom":
+                        name, content = payload
+                        with open(os.path.join(working_dir, name), "wb") as f:
+                            f.write(content)
+                    elif kind == "remove":
+                        rf_buffers.pop(payload[0], None)
+                        self._remove_job(working_dir, buffer_dir, payload[0])
+        except (EOFError, OSError):
+            # Field2 session is closed.
+            pass
+        finally:
+            self._stop_worker(process, channel)
+            channel.close()
+            connection.close()
+            rf_buffers.clear()
+            shutil.rmtree(working_dir, ignore_errors=True)
+            shutil.rmtree(buffer_dir, ignore_errors=True)
+            print("Worker %d stopped." % worker_id)
+
+    def _save_job(self, working_dir, buffer_dir, name, content):
+        """
+        Save a job's .mat file, with the paths of the RF buffer and the
+        phantom on this host.
+
+        :return: the job's RF buffer, and the decimation factor of its I/Q
+            data or None.
+        """
+        input_file = os.path.join(working_dir, name)
+        with open(input_file, "wb") as f:
+            f.write(content)
+        job_data = scipy.io.loadmat(input_file)
+        job_data = {key: value for key, value in job_data.items() if not key.startswith("__")}
+        rf_buffer_file = os.path.join(buffer_dir, name + ".rf")
+        rf_buffer = np.memmap(
+            rf_buffer_file, dtype=np.float64, mode="w+",
+            shape=(job_data["z_focus"].size, int(job_data["no_lines"].flatten()[0]),
+                   _RF_BUFFER_HEADER + int(job_data[RF_BUFFER_SAMPLES_MAT_VAR].flatten()[0])))
+        job_data[RF_BUFFER_MAT_VAR] = rf_buffer_file
+        if job_data[PHANTOM_MAT_VAR].size > 0:
+            phantom_name = os.path.basename(str(job_data[PHANTOM_MAT_VAR][0]))
+            job_data[PHANTOM_MAT_VAR] = os.path.join(working_dir, phantom_name)
+        scipy.io.savemat(input_file, job_data)
+        iq_decimation = None
+        if job_data.get(IQ_DECIMATION_MAT_VAR, np.zeros(0)).size > 0:
+            iq_decimation = int(job_data[IQ_DECIMATION_MAT_VAR].flatten()[0])
+        return rf_buffer, iq_decimation
+
+    def _remove_job(self, working_dir, buffer_dir, name):
+        for path in (os.path.join(working_dir, name), os.path.join(buffer_dir, name + ".rf")):
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def _get_scanlines(self, reply, rf_buffers):
+        """
+        :return: rows of the scanlines of a 'done <job> <pose> <first> <last>'
+            reply, up to the end of the longest one (of its I/Q data, if the
+            job's RF data is demodulated), None for other replies.
+        """
+        if not reply.startswith("done"):
+            return None
+        _, job, pose, first, last = reply.split()
+        rf_buffer, iq_decimation = rf_buffers[job]
+        rows = rf_buffer[int(pose) - 1, int(first) - 1:int(last)]
+        no_samples = int(np.max(rows[:, 2], initial=0))
+        if iq_decimation is not None:
+            no_samples = 2*get_iq_samples(no_samples, iq_decimation, tail=True)
+        return np.array(rows[:, :_RF_BUFFER_HEADER + no_samples])
+
+    def _stop_worker(self, process, channel):
+        if process.poll() is not None:
+            return
+        channel.send("die")
+        deadline = time.monotonic() + _STARTUP_TIMEOUT
+        while process.poll() is None and time.monotonic() < deadline:
+            time.sleep(0.1)
+        if process.poll() is None:
+            process.kill()
+
+
+def read_authkey(path):
+    """
+    :param path: file with the key, which can be read by its owner only.
+    :return: the key in the file, without surrounding whitespace.
+    """
+    if os.stat(path).st_mode & (stat.S_IRWXG | stat.S_IRWXO):
+        raise PermissionError(
+            "Key file %s can be accessed by other users, 'chmod 600' it." % path)
+    with open(path, "rb") as key_file:
+        return key_file.read().strip()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run Field2 workers for remote Field2 sessions.")
+    parser.add_argument("--host", dest="host", type=str, default="0.0.0.0",
+                        help="Address to listen on")
+    parser.add_argument("--port", dest="port", type=int, required=True,
+                        help="Port to listen on")
+    parser.add_argument("--authkey_file", dest="authkey_file", type=str, default=None,
+                        help="File with the key used to authenticate the connections (see 'remote_authkey' "
+                             "in the config), readable by its owner only. The key is read from the %s "
+                             "environment variable if not given" % REMOTE_AUTHKEY_ENV_VAR)
+    parser.add_argument("--authkey", dest="authkey", type=str, default=None,
+                        help="The key itself. INSECURE: other users can read it from the process list")
+    parser.add_argument("--worker", dest="worker", type=str, choices=("matlab", "python"), default="matlab",
+                        help="Workers to run, MATLAB ones or their Python stand-ins")
+    parser.add_argument("--line_time", dest="line_time", type=float, default=0.0,
+                        help="Mean time of simulating a scanline by a Python worker [s]")
+    parser.add_argument("--jitter", dest="jitter", type=float, default=0.0,
+                        help="Max. deviation of the time of a scanline by a Python worker [s]")
+    args = parser.parse_args()
+
+    if args.authkey_file is not None:
+        authkey = read_authkey(args.authkey_file)
+    elif os.environ.get(REMOTE_AUTHKEY_ENV_VAR):
+        authkey = os.environ[REMOTE_AUTHKEY_ENV_VAR].encode()
+    elif args.authkey is not None:
+        print("WARN: --authkey can be read by other users of this host, use --authkey_file "
+              "or %s instead." % REMOTE_AUTHKEY_ENV_VAR)
+        authkey = args.authkey.encode()
+    else:
+        parser.error("the key is required: --authkey_file or %s" % REMOTE_AUTHKEY_ENV_VAR)
+
+    start_worker = start_matlab_worker
+    if args.worker == "python":
+        start_worker = partial(start_python_worker, line_time=args.line_time, jitter=args.jitter)
+    host = RemoteWorkerHost(
+        address=(args.host, args.port),
+        authkey=authkey,
+        start_worker=start_worker
+    )
+    host.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,298 @@
+import os
+import stat
+import tempfile
+import threading
+from concurrent.futures import Future
+from multiprocessing.connection import Client
+from envs.simulator import Simulator, PRIORITY_TRAIN
+
+
+def _get_runtime_dir():
+    """
+    :return: directory of the current user's sockets, $XDG_RUNTIME_DIR or a
+        directory named after the user's id in the temporary directory.
+    """
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return runtime_dir
+    return os.path.join(tempfile.gettempdir(), "rlus-%d" % os.getuid())
+
+
+# Socket of the simulation server, which Field2 attaches to by default.
+DEFAULT_SERVER_ADDRESS = os.path.join(_get_runtime_dir(), "rlus_simulation.sock")
+
+
+def check_server_address(address):
+    """
+    Check that the socket of a simulation server belongs to the current
+    user, and cannot be replaced by other users. Replies of the server are
+    unpickled, so a server of another user could run code in this process.
+
+    :param address: path of the server's socket.
+    :raise FileNotFoundError: if there is no such socket.
+    :raise PermissionError: if the socket, or its directory, is not safe.
+    """
+    socket_stat = os.lstat(address)
+    if socket_stat.st_uid != os.getuid():
+        raise PermissionError("Socket %s belongs to another user." % address)
+    directory = os.path.dirname(os.path.abspath(address))
+    dir_stat = os.stat(directory)
+    if dir_stat.st_uid not in (os.getuid(), 0):
+        raise PermissionError("Directory %s of socket %s belongs to another user."
+                              % (directory, address))
+    # Files of a sticky directory (e.g. /tmp) are removed by their owners only.
+    if dir_stat.st_mode & (stat.S_IWGRP | stat.S_IWOTH) and not dir_stat.st_mode & stat.S_ISVTX:
+        raise PermissionError("Directory %s of socket %s is writable by other users."
+                              % (directory, address))
+
+
+class _RequestFuture(Future):
+    """
+    Future of a request sent to a SimulationServer. The request can be
+    cancelled only if the server confirms that its job was not started yet.
+
+    :param client: SimulationClient which sent the request.
+    :param request_id: id of the request.
+    """
+    def __init__(self, client, request_id):
+        super().__init__()
+        self._client = client
+        self._request_id = request_id
+
+    def cancel(self):
+        """
+        Ask the server to cancel the request, and wait for its answer.
+
+        :return: whether the request was cancelled.
+        """
+        if self.done():
+            return self.cancelled()
+        if not self._client._cancel(self._request_id):
+            return False
+        return super().cancel()
+
+
+class SimulationClient(Simulator):
+    """
+    SimulationClient: A simulator which sends the requests to a
+    SimulationServer (see 'envs/sim_server.py'), so many environments, in
+    any number of processes, share the server's worker pool.
+
+    :param address: path of the server's socket, which has to belong to the
+        current user (see check_server_address).
+    :param priority: priority of the requests of this client, e.g.
+        PRIORITY_TRAIN, PRIORITY_EVAL or PRIORITY_RENDER.
+    """
+    asynchronous = True
+
+    def __init__(self, address, priority=PRIORITY_TRAIN):
+        super().__init__()
+        self.address = address
+        self.priority = priority
+        check_server_address(address)
+        self._connection = Client(address, family="AF_UNIX")
+        # request id -> future of the request's result.
+        self._futures = {}
+        # request id -> future of the server's answer to its cancellation.
+        self._cancels = {}
+        self._no_requests = 0
+        # Guards the connection's sending end and the futures.
+        self._lock = threading.Lock()
+        self._receiver = threading.Thread(
+            target=self._receive, name="SimulationClient-receiver", daemon=True)
+        self._receiver.start()
+
+    def simulate_linear_array(
+        self,
+        point_positions, point_amplitudes, sampling_frequency,
+        no_lines=50, z_focus=60/1000, image_width=40/1000
+    ):
+        return self.submit(
+            point_positions, point_amplitudes, sampling_frequency,
+            no_lines=no_lines, z_focus=z_focus, image_width=image_width).result()
+
+    def simulate_linear_array_batch(
+        self,
+        point_positions, point_amplitudes, sampling_frequency,
+        no_lines=50, z_focus=60/1000, image_width=40/1000
+    ):
+        return self.submit_batch(
+            point_positions, point_amplitudes, sampling_frequency,
+            no_lines=no_lines, z_focus=z_focus, image_width=image_width).result()
+
+    def submit(
+        self,
+        point_positions, point_amplitudes, sampling_frequency,
+        no_lines=50, z_focus=60/1000, image_width=40/1000,
+        priority=None, owner=None, on_scanlines=None, lines=None
+    ):
+        """
+        Send a request to the server. Parameters are the same as in
+        'simulate_linear_array'.
+
+        :param priority: priority of the request, the client's priority if
+            None.
+        :param owner: ignored, the server serves its clients fairly.
+        :param on_scanlines: ignored, the server sends whole results.
+        :param lines: see 'Simulator.submit'.
+        :return: concurrent.futures.Future of (RF data, start times).
+        """
+        return self._send_request(
+            method="submit",
+            kwargs=dict(
+                point_positions=point_positions,
+                point_amplitudes=point_amplitudes,
+                sampling_frequency=sampling_frequency,
+                no_lines=no_lines,
+                z_focus=z_focus,
+                image_width=image_width,
+                lines=lines),
+            priority=priority)
+
+    def submit_batch(
+        self,
+        point_positions, point_amplitudes, sampling_frequency,
+        no_lines=50, z_focus=60/1000, image_width=40/1000,
+        priority=None, owner=None
+    ):
+        """
+        Send a request of many probe poses to the server. Parameters are the
+        same as in 'simulate_linear_array_batch'.
+
+        :return: concurrent.futures.Future of (RF data, start times).
+        """
+        return self._send_request(
+            method="submit_batch",
+            kwargs=dict(
+                point_positions=point_positions,
+                point_amplitudes=point_amplitudes,
+                sampling_frequency=sampling_frequency,
+                no_lines=no_lines,
+                z_focus=z_focus,
+                image_width=image_width),
+            priority=priority)
+
+    def upload_phantom(self, point_positions, point_amplitudes):
+        """
+        Upload the scatterers of a static phantom to the server, see
+        'Simulator.upload_phantom'. The phantom stays on the server, so it
+        is uploaded once by all the clients of the server.
+
+        :return: id of the phantom on the server.
+        """
+        future = Future()
+        with self._lock:
+            request_id = self._no_requests
+            self._no_requests += 1
+            self._futures[request_id] = future
+            self._connection.send(("upload", request_id, point_positions, point_amplitudes))
+        phantom_id, = future.result()
+        return phantom_id
+
+    def submit_pose(
+        self,
+        phantom_id, probe_pos, probe_angle, window, sampling_frequency,
+        no_lines=50, z_focus=60/1000, image_width=40/1000,
+        priority=None, owner=None, on_scanlines=None, lines=None
+    ):
+        """
+        Send a request of a probe pose in a phantom uploaded to the server.
+        Parameters are the same as in 'Simulator.submit_pose', on_scanlines
+        is ignored.
+
+        :return: concurrent.futures.Future of (RF data, start times).
+        """
+        return self._send_request(
+            method="submit_pose",
+            kwargs=dict(
+                phantom_id=phantom_id,
+                probe_pos=probe_pos,
+                probe_angle=probe_angle,
+                window=window,
+                sampling_frequency=sampling_frequency,
+                no_lines=no_lines,
+                z_focus=z_focus,
+                image_width=image_width,
+                lines=lines),
+            priority=priority)
+
+    def close(self):
+        """
+        Disconnect from the server, the server keeps running. Pending
+        requests are cancelled.
+        """
+        if self._connection.closed:
+            return
+        with self._lock:
+            try:
+                self._connection.send(("close",))
+            except OSError:
+                pass
+        # The server closes the connection, which stops the receiver.
+        self._receiver.join()
+        self._connection.close()
+
+    def _send_request(self, method, kwargs, priority):
+        if priority is None:
+            priority = self.priority
+        with self._lock:
+            request_id = self._no_requests
+            self._no_requests += 1
+            future = _RequestFuture(self, request_id)
+            self._futures[request_id] = future
+            self._connection.send(("submit", request_id, method, kwargs, priority))
+        return future
+
+    def _cancel(self, request_id):
+        """
+        Ask the server to cancel a request. The server cancels the job only
+        if none of its shards was given to a worker yet.
+
+        :return: whether the server cancelled the request.
+        """
+        answer = Future()
+        with self._lock:
+            if request_id not in self._futures or self._connection.closed:
+                return False
+            self._cancels[request_id] = answer
+            self._connection.send(("cancel", request_id))
+        if not answer.result():
+            return False
+        with self._lock:
+            self._futures.pop(request_id, None)
+        return True
+
+    def _receive(self):
+        """
+        Main loop of the receiver thread: resolve the futures with the
+        server's replies.
+        """
+        try:
+            while True:
+                kind, request_id, *payload = self._connection.recv()
+                if kind == "cancelled":
+                    with self._lock:
+                        answer = self._cancels.pop(request_id, None)
+                    if answer is not None:
+                        answer.set_result(payload[0])
+                    continue
+                with self._lock:
+                    future = self._futures.pop(request_id, None)
+                if future is None or not future.set_running_or_notify_cancel():
+                    continue
+                if kind == "result":
+                    future.set_result(tuple(payload))
+                else:
+                    future.set_exception(RuntimeError(payload[0]))
+        except (EOFError, OSError):
+            with self._lock:
+                futures = list(self._futures.values())
+                self._futures.clear()
+                answers = list(self._cancels.values())
+                self._cancels.clear()
+            for answer in answers:
+                answer.set_result(False)
+            for future in futures:
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(RuntimeError(
+                        "Connection to the simulation server %s is closed." % self.address))
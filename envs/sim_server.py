@@ -0,0 +1,240 @@
+import argparse
+import os
+import queue
+import signal
+import sys
+import threading
+import numpy as np
+from functools import partial
+from multiprocessing.connection import Listener, Client
+from envs.env_fn import simulator_fn, server_address_fn
+from envs.utils import Config
+
+# Simulator's methods which can be requested by the clients.
+SUBMIT_METHODS = ("submit", "submit_batch", "submit_pose")
+
+
+class SimulationServer:
+    """
+    SimulationServer: Serves the simulation requests of many environments
+    (in any number of processes, see SimulationClient) with a single
+    simulator, e.g. a Field2 worker pool. Clients connect to a local (unix)
+    socket. Every client is an owner of its requests, so the requests of the
+    same priority are served fairly between the clients, and requests of
+    higher priority (training) outrank the ones of lower priority
+    (evaluation, rendering, prefetching).
+
+    The server can run as a long-lived daemon (see '--detach'), which keeps
+    initialized MATLAB workers warm between training runs: Field2 attaches
+    to it when it is present.
+
+    Each message is a tuple:
+        client -> server: ('submit', request id, method, kwargs, priority),
+            where method is one of SUBMIT_METHODS,
+            ('upload', request id, point_positions, point_amplitudes),
+            ('cancel', request id), ('close',), ('shutdown',)
+        server -> client: ('result', request id, rf_array, t_start),
+            ('result', request id, phantom id), ('error', request id, message),
+            ('cancelled', request id, whether the request was cancelled)
+
+    :param simulator: simulator used to serve the requests.
+    :param address: path of the socket. Its directory is created (readable
+        by the current user only), if it does not exist.
+    """
+    def __init__(self, simulator, address):
+        self.simulator = simulator
+        self.address = address
+        self._listener = None
+        self._no_clients = 0
+        self._shutdown = False
+
+    def serve_forever(self):
+        """
+        Accept clients till the server is shut down or interrupted.
+        """
+        directory = os.path.dirname(os.path.abspath(self.address))
+        if not os.path.isdir(directory):
+            os.makedirs(directory, mode=0o700)
+        if os.path.exists(self.address):
+            os.remove(self.address)
+        self._listener = Listener(self.address, family="AF_UNIX")
+        # Requests are unpickled, only the current user can connect.
+        os.chmod(self.address, 0o600)
+        print("Simulation server is listening on %s." % self.address)
+        try:
+            while True:
+                connection = self._listener.accept()
+                if self._shutdown:
+                    connection.close()
+                    break
+                self._no_clients += 1
+                threading.Thread(
+                    target=self._serve_client,
+                    args=(connection, self._no_clients),
+                    name="SimulationServer-client-%d" % self._no_clients,
+                    daemon=True
+                ).start()
+        finally:
+            self.close()
+
+    def shutdown(self):
+        """
+        Stop accepting clients, serve_forever returns.
+        """
+        self._shutdown = True
+        # Wakes up the listener.
+        Client(self.address, family="AF_UNIX").close()
+
+    def close(self):
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+        self.simulator.close()
+
+    def _serve_client(self, connection, client_id):
+        """
+        Receive the requests of a client. Replies are sent by a separate
+        thread, so a slow client never blocks the simulator.
+        """
+        print("Client %d connected." % client_id)
+        replies = queue.Queue()
+        sender = threading.Thread(
+            target=self._send_replies, args=(connection, replies), daemon=True)
+        sender.start()
+        # request id -> future of the simulator.
+        futures = {}
+        try:
+            while True:
+                message = connection.recv()
+                if message[0] == "submit":
+                    _, request_id, method, kwargs, priority = message
+                    try:
+                        if method not in SUBMIT_METHODS:
+                            raise ValueError("Unknown method '%s'." % method)
+                        submit = getattr(self.simulator, method)
+                        future = submit(priority=priority, owner=client_id, **kwargs)
+                    except Exception as ex:
+                        replies.put(("error", request_id, repr(ex)))
+                        continue
+                    futures[request_id] = future
+                    future.add_done_callback(partial(self._on_done, replies, futures, request_id))
+                elif message[0] == "upload":
+                    _, request_id, point_positions, point_amplitudes = message
+                    try:
+                        phantom_id = self.simulator.upload_phantom(point_positions, point_amplitudes)
+                        replies.put(("result", request_id, phantom_id))
+                    except Exception as ex:
+                        replies.put(("error", request_id, repr(ex)))
+                elif message[0] == "cancel":
+                    # A job which was started already is not cancelled.
+                    future = futures.get(message[1])
+                    replies.put(("cancelled", message[1], future is not None and future.cancel()))
+                elif message[0] == "close":
+                    break
+                elif message[0] == "shutdown":
+                    self.shutdown()
+                    break
+        except (EOFError, OSError):
+            pass
+        for future in list(futures.values()):
+            future.cancel()
+        replies.put(None)
+        sender.join()
+        connection.close()
+        print("Client %d disconnected." % client_id)
+
+    def _on_done(self, replies, futures, request_id, future):
+        futures.pop(request_id, None)
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            replies.put(("error", request_id, repr(future.exception())))
+        else:
+            rf_array, t_start = future.result()
+            replies.put(("result", request_id, np.asarray(rf_array), np.asarray(t_start)))
+
+    def _send_replies(self, connection, replies):
+        while True:
+            reply = replies.get()
+            if reply is None:
+                break
+            try:
+                connection.send(reply)
+            except (EOFError, OSError):
+                break
+
+
+def is_server_running(address):
+    """
+    :return: whether a simulation server is listening on given address.
+    """
+    try:
+        Client(address, family="AF_UNIX").close()
+        return True
+    except (FileNotFoundError, ConnectionRefusedError):
+        return False
+
+
+def stop_server(address):
+    """
+    Ask the simulation server listening on given address to shut down.
+    """
+    connection = Client(address, family="AF_UNIX")
+    connection.send(("shutdown",))
+    connection.close()
+
+
+def _detach(log_file):
+    """
+    Continue in a background process, detached from the terminal, with
+    output redirected to given file.
+    """
+    if os.fork() > 0:
+        os._exit(0)
+    os.setsid()
+    if os.fork() > 0:
+        os._exit(0)
+    log_fd = os.open(log_file, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    null_fd = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(null_fd, 0)
+    os.dup2(log_fd, 1)
+    os.dup2(log_fd, 2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve simulation requests of the environments.")
+    parser.add_argument("--config_path", dest="config_path", type=str,
+                        help="Path of the configurations file",
+                        required=True)
+    parser.add_argument("--backend", dest="backend", type=str, default="field2",
+                        help="Simulator backend used by the server ('field2' or 'numpy')")
+    parser.add_argument("--detach", dest="detach", action="store_true",
+                        help="Run as a daemon in the background, output is appended to --log_file")
+    parser.add_argument("--log_file", dest="log_file", type=str, default="sim_server.log",
+                        help="Output file of the daemon")
+    parser.add_argument("--stop", dest="stop", action="store_true",
+                        help="Stop the running server")
+    args = parser.parse_args()
+
+    config = Config(args.config_path)
+    address = server_address_fn(config)
+    if args.stop:
+        stop_server(address)
+        return
+    if is_server_running(address):
+        print("Simulation server is running on %s already." % address)
+        return
+    if args.detach:
+        # Before any thread and MATLAB process is started.
+        _detach(args.log_file)
+    # Workers are stopped on 'kill' as well.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    server = SimulationServer(
+        simulator=simulator_fn(config, backend=args.backend, attach=False),
+        address=address
+    )
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,28 @@
 % This implementation bases on script 'sim_img.m' from field's II 'cyst example'.
-% 'lockfile' program is required to exclusively lock the work of each thread
-% per scanline. In Ubuntu, it's available in procmail package.
+%
+% Requests are received and replies are sent through named pipes
+% 'cmd.<id>'/'reply.<id>' (ipc = "fifo"), or through 'go.<id>'/'die.<id>' and
+% 'started.<id>'/'ready.<id>' files (ipc = "file", default).
+%
+% A 'go <job> <pose> <first> <last>' request makes the worker simulate
+% scanlines first..last of given pose of the job described in <job> .mat file.
+% Points, amplitudes and focal depths of the poses are stored in cell arrays
+% and a vector. A job of a resident phantom has no points: it names the
+% phantom's .mat file instead, which is loaded once, and the probe position
+% and angle of each pose; the scatterers are moved to the probe's frame and
+% cropped to the field of view here. If the job has an RF buffer, each scanline is written to its
+% row of the memory-mapped buffer: tstart, line number and the end of the
+% samples, followed by the samples, which start at t=0. If the job has an
+% I/Q decimation factor, the row holds the I/Q data of the scanline instead
+% (see rf_to_iq), with real and imaginary parts interleaved. Otherwise, each
+% scanline is saved to '<job>.rf/p<pose>_ln<i>.<id>.mat'. Then
+% 'done <job> <pose> <first> <last>' is replied.
 
-function [] = simulate_linear_array(id, input_path, output_path)
+function [] = simulate_linear_array(id, input_path, output_path, ipc)
+
+    if nargin < 4
+        ipc = "file";
+    end
 
                              % TODO parametrize?
     randn('seed', 42)        % TODO gather all seeds in one place
@@ -45,38 +65,66 @@ function [] = simulate_linear_array(id, input_path, output_path)
         mkdir(output_path);
     end
 
-    input_file = fullfile(input_path, "input.mat");
+    loaded_job = "";
+    loaded_phantom = "";
 
-    path_to_go = fullfile(input_path, strcat("go.", num2str(id)));
-    path_to_die = fullfile(input_path, strcat("die.", num2str(id)));
+    channel = open_channel(id, input_path, ipc);
 	
     disp(strcat("Starting worker ", num2str(id)));
-    disp(path_to_go);
+    send_message(channel, "started");
 	
     while true
 	
         disp(strcat('Worker ', num2str(id), ': waiting for the job...'));
-        fclose(fopen(fullfile(input_path, strcat("started.", num2str(id))), 'w'));
-		
-        while (~isfile(path_to_go)) && (~isfile(path_to_die))
-		
-            pause(1);
-			
-        end
+        message = receive_message(channel);
+        request = strsplit(char(message));
 		
-        if isfile(path_to_die)
+        if strcmp(request{1}, "die")
 		
             break;
         
-		elseif isfile(path_to_go)
+		elseif strcmp(request{1}, "go")
 		
-            disp(strcat('Worker ', num2str(id), ' is now proceeding to new job..'))
-            delete(path_to_go);
+            job = request{2};
+            pose = str2double(request{3});
+            first_line = str2double(request{4});
+            last_line = str2double(request{5});
+            disp(strcat('Worker ', num2str(id), ' is now proceeding to lines ', ...
+                        num2str(first_line), '-', num2str(last_line), ' of pose ', ...
+                        num2str(pose), ' of ', job))
 			
             tic;
 			
-            clear point_positions point_amplitudes z_focus no_lines image_width;
-            load(input_file, "point_positions", "point_amplitudes", "z_focus", "no_lines", "image_width");
+            % The job's data is loaded once, even if the worker gets several
+            % shards of the same job.
+            if ~strcmp(job, loaded_job)
+                clear job_data rf_buffer;
+                job_data = load(fullfile(input_path, job), "point_positions", "point_amplitudes", "z_focus", "no_lines", "image_width", "rf_buffer", "rf_buffer_samples", "phantom", "probe_pos", "probe_angle", "fov", "depth_gate", "iq_decimation", "center_frequency");
+                if ~isempty(job_data.rf_buffer)
+                    rf_buffer = memmapfile(job_data.rf_buffer, 'Format', 'double', 'Writable', true);
+                end
+                loaded_job = job;
+            end
+            if isempty(job_data.phantom)
+                point_positions = job_data.point_positions{pose};
+                point_amplitudes = job_data.point_amplitudes{pose};
+            else
+                % The phantom stays loaded for the next jobs.
+                if ~strcmp(job_data.phantom, loaded_phantom)
+                    phantom = load(job_data.phantom, "phantom_positions", "phantom_amplitudes");
+                    loaded_phantom = job_data.phantom;
+                end
+                [point_positions, point_amplitudes] = get_fov_points(phantom, ...
+                    job_data.probe_pos(pose, :), job_data.probe_angle(pose), job_data.fov);
+                % Points of the other jobs are culled before they are saved.
+                if ~isempty(job_data.depth_gate)
+                    [point_positions, point_amplitudes] = cull_points(point_positions, ...
+                        point_amplitudes, job_data.depth_gate, N_elements*(width+kerf)/2);
+                end
+            end
+            z_focus = job_data.z_focus(pose);
+            no_lines = job_data.no_lines;
+            image_width = job_data.image_width;
 
 			% Set the different focal zones for reception
             focal_zones = [z_focus];
@@ -90,63 +138,59 @@ function [] = simulate_linear_array(id, input_path, output_path)
             disp(['LOG: image_width=', num2str(image_width)])
 
             % Determining an output directory for a single input file.
-            example_dir_path = fullfile(output_path, "input.mat.rf");
-            if ~isfolder(example_dir_path)
+            example_dir_path = fullfile(output_path, strcat(job, ".rf"));
+            if isempty(job_data.rf_buffer) && ~isfolder(example_dir_path)
                 mkdir(example_dir_path);
             end
+            row_length = 3 + double(job_data.rf_buffer_samples);
 
             % Do imaging line by line
-            for i = 1:no_lines
+            for i = first_line:last_line
 			
-                filename = fullfile(example_dir_path, strcat("ln", num2str(i), ".mat"));
-                lock_filename = strcat(filename, ".lock");
-                
-                if ~system(sprintf("lockfile -r 0 %s > /tmp/sim_field2_lockfile.log 2>&1", lock_filename))
-                %if exist(lock_filename, 'file') == 0
-                    
-                 %   fid = fopen(lock_filename, 'w');
-                    
-                    disp(strcat("creating line ", num2str(i)));
-                    % We are first in locking this scanline.
+                filename = fullfile(example_dir_path, strcat("p", num2str(pose), "_ln", num2str(i), ".", num2str(id), ".mat"));
+                disp(strcat("creating line ", num2str(i)));
 								
-					% The imaging direction
-                    x = -image_width/2 +(i-1)*d_x;
+                % The imaging direction
+                x = -image_width/2 +(i-1)*d_x;
 					
-                    % Set the focus for this direction with the proper reference point
-                    xdc_center_focus(xmit_aperture, [x 0 0]);
-                    xdc_focus(xmit_aperture, 0, [x 0 z_focus]);
-                    xdc_center_focus(receive_aperture, [x 0 0]);
-                    xdc_focus(receive_aperture, focus_times, [x*ones(Nf,1), zeros(Nf,1), focal_zones]);
+                % Set the focus for this direction with the proper reference point
+                xdc_center_focus(xmit_aperture, [x 0 0]);
+                xdc_focus(xmit_aperture, 0, [x 0 z_focus]);
+                xdc_center_focus(receive_aperture, [x 0 0]);
+                xdc_focus(receive_aperture, focus_times, [x*ones(Nf,1), zeros(Nf,1), focal_zones]);
                     
-					% Calculate the apodization
-                    N_pre = round(x/(width+kerf)+N_elements/2-N_active/2);
-                    N_post = N_elements-N_pre-N_active;
-                    apo_vector = [zeros(1,N_pre) apo zeros(1,N_post)];
-                    xdc_apodization(xmit_aperture, 0, apo_vector);
-                    xdc_apodization(receive_aperture, 0, apo_vector);
+                % Calculate the apodization
+                N_pre = round(x/(width+kerf)+N_elements/2-N_active/2);
+                N_post = N_elements-N_pre-N_active;
+                apo_vector = [zeros(1,N_pre) apo zeros(1,N_post)];
+                xdc_apodization(xmit_aperture, 0, apo_vector);
+                xdc_apodization(receive_aperture, 0, apo_vector);
 					
-                    % Calculate the received response
+                % Calculate the received response
+                if isempty(point_positions)
+                    % All the points are culled or out of the field of view.
+                    rf_data = 0;
+                    tstart = 0;
+                else
                     [rf_data, tstart] = calc_scat(xmit_aperture, receive_aperture, point_positions, point_amplitudes);
+                end
+                if ~isempty(job_data.depth_gate)
+                    [rf_data, tstart] = gate_scanline(rf_data, tstart, fs, c, job_data.depth_gate);
+                end
                     
-					% Store the result
+                % Store the result
+                if isempty(job_data.rf_buffer)
                     save(filename, "i", "rf_data", "tstart");
-                    
-                    % --- Delete lock file.
-                    %fclose(fid);
-                    %delete(fid);
-					
-                %else
-                    
-                    %disp(['Line ', num2str(i),' is being made by another worker.'])
-                  
+                else
+                    row = (pose-1)*no_lines + i-1;
+                    write_scanline(rf_buffer, row*row_length, row_length, i, rf_data, tstart, fs, ...
+                        job_data.iq_decimation, job_data.center_frequency);
                 end
                 
-                
-                
             end
             toc;
             disp(strcat("Worker ", num2str(id), ' finished the job.'))
-            fclose(fopen(fullfile(input_path, strcat("ready.", num2str(id))), 'w'));
+            send_message(channel, sprintf("done %s %d %d %d", job, pose, first_line, last_line));
         end
     end
     disp(strcat("Killing worker ", num2str(id), '.'))
@@ -154,5 +198,143 @@ function [] = simulate_linear_array(id, input_path, output_path)
 	% Free space for apertures
     xdc_free(xmit_aperture)
     xdc_free(receive_aperture)
+    close_channel(channel);
 	
 end
+
+function write_scanline(rf_buffer, offset, row_length, i, rf_data, tstart, fs, iq_decimation, f0)
+    % The samples before tstart are zeros, the buffer is zero-filled.
+    max_samples = row_length - 3;
+    if ~isempty(iq_decimation)
+        % RF samples whose I/Q data fits to the row.
+        max_samples = (floor((row_length - 3)/2) - 8)*iq_decimation;
+    end
+    first = round(tstart*fs);
+    if first < 0
+        rf_data = rf_data(1-first:end);
+        first = 0;
+    end
+    last = min(first + numel(rf_data), max_samples);
+    if last < first + numel(rf_data)
+        disp(strcat("WARN: scanline ", num2str(i), " is truncated to the RF buffer."));
+    end
+    if isempty(iq_decimation)
+        rf_buffer.Data(offset+4+first:offset+3+last) = rf_data(1:last-first);
+    elseif last > first
+        scanline = zeros(last, 1);
+        scanline(first+1:last) = rf_data(1:last-first);
+        iq = rf_to_iq(scanline, fs, f0, iq_decimation);
+        values = [real(iq).'; imag(iq).'];
+        rf_buffer.Data(offset+4:offset+3+numel(values)) = values(:);
+    end
+    % The header is written after the samples.
+    rf_buffer.Data(offset+1:offset+3) = [tstart; i; last];
+end
+
+function iq = rf_to_iq(rf_data, fs, f0, decimation)
+    % Same as rf_to_iq in 'simulator.py' with the filter's tail: the RF data
+    % (starting at t=0) is demodulated to baseband, low-pass filtered and
+    % decimated.
+    half_taps = 8;
+    n = numel(rf_data);
+    carrier = exp(-2i*pi*f0/fs*(0:n-1).');
+    cutoff = min(1/decimation, 2*f0/fs);
+    taps = fir1(2*half_taps*decimation, cutoff);
+    iq = upfirdn(rf_data(:).*carrier, 2*taps(:), 1, decimation);
+    iq = iq(half_taps+1:half_taps+ceil(n/decimation)+half_taps);
+end
+
+function [rf_data, tstart] = gate_scanline(rf_data, tstart, fs, c, depth_gate)
+    % Keep the samples of the depth gate only, see get_gate_samples in
+    % 'simulator.py'.
+    first = round(tstart*fs);
+    gate_first = floor(2*depth_gate(1)/c*fs);
+    gate_end = ceil(2*depth_gate(2)/c*fs) + 1;
+    from = max(gate_first - first, 0);
+    to = min(gate_end - first, numel(rf_data));
+    if to <= from
+        rf_data = 0;
+        tstart = gate_first/fs;
+    else
+        rf_data = rf_data(from+1:to);
+        tstart = (first + from)/fs;
+    end
+end
+
+function [points, amplitudes] = cull_points(points, amplitudes, depth_gate, probe_half_length)
+    % Same as cull_points in 'simulator.py'.
+    margin = 5/1000;
+    max_distance = sqrt((abs(points(:, 1)) + probe_half_length).^2 + points(:, 2).^2 + points(:, 3).^2);
+    keep = points(:, 3) <= depth_gate(2) + margin & max_distance >= depth_gate(1) - margin;
+    points = points(keep, :);
+    amplitudes = amplitudes(keep);
+end
+
+function [points, amplitudes] = get_fov_points(phantom, probe_pos, probe_angle, fov)
+    % Same transform as get_fov_points in 'simulator.py'.
+    c = cosd(-probe_angle);
+    s = sind(-probe_angle);
+    points = phantom.phantom_positions - probe_pos;
+    xs = c*points(:, 1) - s*points(:, 2);
+    ys = s*points(:, 1) + c*points(:, 2);
+    in_fov = abs(xs) <= fov(1)/2 & abs(ys) <= fov(2)/2;
+    points = [xs(in_fov), ys(in_fov), points(in_fov, 3)];
+    amplitudes = phantom.phantom_amplitudes(in_fov);
+end
+
+function channel = open_channel(id, input_path, ipc)
+    channel.ipc = ipc;
+    channel.go_file = fullfile(input_path, strcat("go.", num2str(id)));
+    channel.die_file = fullfile(input_path, strcat("die.", num2str(id)));
+    channel.started_file = fullfile(input_path, strcat("started.", num2str(id)));
+    channel.ready_file = fullfile(input_path, strcat("ready.", num2str(id)));
+    channel.reply_pipe = fullfile(input_path, strcat("reply.", num2str(id)));
+    if strcmp(ipc, "fifo")
+        % Python keeps both ends of the pipes open, so fopen does not block.
+        channel.cmd_fid = fopen(fullfile(input_path, strcat("cmd.", num2str(id))), 'r');
+    end
+end
+
+function message = receive_message(channel)
+    if strcmp(channel.ipc, "fifo")
+        % Blocks till a request is written to the pipe.
+        message = fgetl(channel.cmd_fid);
+        if ~ischar(message)
+            message = "die";
+        end
+        message = strtrim(message);
+    else
+        while (~isfile(channel.go_file)) && (~isfile(channel.die_file))
+            pause(1);
+        end
+        if isfile(channel.die_file)
+            message = "die";
+        else
+            message = strtrim(fileread(channel.go_file));
+            delete(channel.go_file);
+        end
+    end
+end
+
+function send_message(channel, message)
+    if strcmp(channel.ipc, "fifo")
+        fid = fopen(channel.reply_pipe, 'w');
+        fprintf(fid, '%s\n', message);
+        fclose(fid);
+    elseif strcmp(message, "started")
+        fclose(fopen(channel.started_file, 'w'));
+    else
+        % The reply is written to a temporary file first, so Python never
+        % reads a partially written one.
+        fid = fopen(strcat(channel.ready_file, ".tmp"), 'w');
+        fprintf(fid, '%s', message);
+        fclose(fid);
+        movefile(strcat(channel.ready_file, ".tmp"), channel.ready_file);
+    end
+end
+
+function close_channel(channel)
+    if strcmp(channel.ipc, "fifo")
+        fclose(channel.cmd_fid);
+    end
+end
@@ -0,0 +1,799 @@
+import threading
+import numpy as np
+from collections import namedtuple, OrderedDict
+from concurrent.futures import Future
+from scipy import signal, fft
+
+# Priorities of the simulation requests, lower values are served first.
+PRIORITY_TRAIN = 0
+PRIORITY_EVAL = 1
+PRIORITY_RENDER = 2
+PRIORITY_PREFETCH = 3
+PRIORITY_DEFAULT = PRIORITY_TRAIN
+
+# Taps of the I/Q low-pass filter per decimated sample, on each side.
+_IQ_FILTER_HALF_TAPS = 8
+# Scatterers are culled only if their echoes miss the depth gate by more than
+# this margin [m] (length of the pulse, focusing delays).
+_GATE_MARGIN = 5/1000
+
+ChannelData = namedtuple("ChannelData", [
+    # (no_lines, n_active, n) complex responses of the scatterers at the
+    # active elements of each scanline, at the center frequency, relative to
+    # the center of the aperture.
+    "responses",
+    # (no_lines, n_active) positions of the active elements w.r.t. the
+    # scanline [m].
+    "element_xs",
+    # (no_lines, n) distances of the scatterers from the center of the
+    # aperture [m].
+    "ranges",
+    # (no_lines, n) amplitudes of the scatterers, with the two-way directivity
+    # of the elements in elevation.
+    "amplitudes",
+    "sampling_frequency"
+])
+
+
+def _hanning(n):
+    """
+    Same as MATLAB's hanning(n), which does not include the zero endpoints.
+    """
+    return 0.5 - 0.5*np.cos(2*np.pi*np.arange(1, n+1)/(n+1))
+
+
+def rf_to_iq(rf_arrays, sampling_frequency, center_frequency, decimation, tail=False):
+    """
+    Demodulate RF data (starting at t=0) to complex baseband and decimate
+    it. The magnitude of the result is the envelope of the RF data, as given
+    by the Hilbert transform.
+
+    :param rf_arrays: (..., samples, no_lines) RF data.
+    :param sampling_frequency: sampling frequency of the RF data.
+    :param center_frequency: center frequency of the transducer.
+    :param decimation: decimation factor, the I/Q data is sampled at
+        sampling_frequency/decimation.
+    :param tail: whether the response of the filter after the end of the RF
+        data is returned too. The first samples of the I/Q data of longer
+        (zero padded) RF data are the same, so I/Q data of scanlines of
+        different lengths can be merged.
+    :return: (..., get_iq_samples(samples, decimation, tail), no_lines)
+        complex64 I/Q data.
+    """
+    rf_arrays = np.asarray(rf_arrays)
+    no_samples = rf_arrays.shape[-2]
+    carrier = np.exp(-2j*np.pi*center_frequency/sampling_frequency*np.arange(no_samples))
+    # The cutoff is below the image of the carrier at -2*center_frequency.
+    cutoff = min(1/decimation, 2*center_frequency/sampling_frequency)
+    taps = signal.firwin(2*_IQ_FILTER_HALF_TAPS*decimation + 1, cutoff)
+    iq = signal.upfirdn(2*taps, rf_arrays*carrier[:, None], down=decimation, axis=-2)
+    # Delay of the filter is _IQ_FILTER_HALF_TAPS decimated samples.
+    no_iq_samples = get_iq_samples(no_samples, decimation, tail)
+    iq = iq[..., _IQ_FILTER_HALF_TAPS:_IQ_FILTER_HALF_TAPS + no_iq_samples, :]
+    return iq.astype(np.complex64)
+
+
+def get_iq_samples(no_samples, decimation, tail=False):
+    """
+    :return: number of samples of the I/Q data of given number of RF samples
+        (see rf_to_iq): ceil(samples/decimation), with _IQ_FILTER_HALF_TAPS
+        more if tail is set.
+    """
+    no_iq_samples = -(-no_samples//decimation)
+    if tail:
+        no_iq_samples += _IQ_FILTER_HALF_TAPS
+    return no_iq_samples
+
+
+def cull_points(point_positions, point_amplitudes, depth_gate, probe_half_length):
+    """
+    Drop the scatterers whose echoes do not reach the depth gate: the ones
+    deeper than the max. depth, and the ones closer to every element of the
+    probe than the min. depth.
+
+    :param point_positions: (n, 3) points, in the probe's frame.
+    :param point_amplitudes: (n, 1) amplitudes of the points.
+    :param depth_gate: (min. depth, max. depth) [m].
+    :param probe_half_length: half length of the transducer [m].
+    :return: points and amplitudes which are kept.
+    """
+    points = np.asarray(point_positions).reshape(-1, 3)
+    max_distance = np.sqrt((np.abs(points[:, 0]) + probe_half_length)**2
+                           + points[:, 1]**2 + points[:, 2]**2)
+    keep = (points[:, 2] <= depth_gate[1] + _GATE_MARGIN) & \
+        (max_distance >= depth_gate[0] - _GATE_MARGIN)
+    return points[keep], np.asarray(point_amplitudes).reshape(-1, 1)[keep]
+
+
+def get_gate_samples(depth_gate, sampling_frequency, c):
+    """
+    :return: (first, end) samples (counting from t=0) of the echoes from
+        the depths of the depth gate.
+    """
+    return (int(np.floor(2*depth_gate[0]/c*sampling_frequency)),
+            int(np.ceil(2*depth_gate[1]/c*sampling_frequency)) + 1)
+
+
+def get_fov_points(point_positions, point_amplitudes, probe_pos, probe_angle, window):
+    """
+    Same transform as Probe.get_fov, applied to the scatterers of a resident
+    phantom: points are moved to the probe's frame (probe at the origin, the
+    scanning plane is OXZ) and cropped to the probe's window.
+
+    :param point_positions: (n, 3) points, in the phantom's frame.
+    :param point_amplitudes: (n, 1) amplitudes of the points.
+    :param probe_pos: 3-D position of the probe.
+    :param probe_angle: angle of the probe, in degrees.
+    :param window: (x size, y size) of the field of view [m].
+    :return: points and amplitudes in the field of view.
+    """
+    c = np.cos(np.radians(-probe_angle))
+    s = np.sin(np.radians(-probe_angle))
+    points = np.asarray(point_positions) - np.asarray(probe_pos)
+    xs = c*points[:, 0] - s*points[:, 1]
+    ys = s*points[:, 0] + c*points[:, 1]
+    in_fov = (np.abs(xs) <= window[0]/2) & (np.abs(ys) <= window[1]/2)
+    points = np.stack((xs[in_fov], ys[in_fov], points[in_fov, 2]), axis=1)
+    return points, np.asarray(point_amplitudes)[in_fov]
+
+
+class Simulator:
+    """
+    Simulator: Base class of the RF data simulators used by the environment.
+    Every simulator returns the same (rf_array, t_start) contract as
+    Field2.simulate_linear_array, so they can be used interchangeably.
+
+    :param iq_decimation: if given, the simulator returns complex64 baseband
+        (I/Q) data decimated by this factor instead of RF data (see
+        'rf_to_iq'), e.g. for ImagingSystem.image_iq.
+    :param center_frequency: center frequency of the transducer, used to
+        demodulate the RF data.
+    :param depth_gate: (min. depth, max. depth) [m] of the returned data,
+        or None. The samples outside the gate are not returned (the ones
+        before min. depth are zeros) and the scatterers whose echoes miss
+        the gate are not simulated. The samples of the gate are the same,
+        but their envelope is not: the Hilbert transform of the shorter
+        data has another numerical noise floor (below about -100 dB), and
+        B-mode images are normalized by their min. So with a low
+        dr_threshold (e.g. -200 dB) all pixels of a gated image differ from
+        the ungated one, and from the observations cached without the gate.
+    :param speed_of_sound: speed of sound [m/s], used to convert depths to
+        time.
+    """
+    # Whether submitted requests are simulated in the background.
+    asynchronous = False
+    # Whether the simulator captures the channel data of a pose, which is
+    # beamformed for any focal depth (see 'capture').
+    supports_capture = False
+
+    def __init__(self, iq_decimation=None, center_frequency=3.5e6, depth_gate=None, speed_of_sound=1540):
+        self.iq_decimation = iq_decimation
+        self.center_frequency = center_frequency
+        self.depth_gate = depth_gate
+        self.speed_of_sound = speed_of_sound
+        # phantom id -> (points, amplitudes) of the resident phantoms.
+        self._phantoms = {}
+
+    def simulate_linear_array(
+        self,
+        point_positions, point_amplitudes, sampling_frequency,
+        no_lines=50, z_focus=60/1000, image_width=40/1000
+    ):
+        """
+        Create RF data.
+
+        :param point_positions: (n, 3) points used to generate the RF data.
+        :param point_amplitudes: (n, 1) amplitudes of the points used.
+        :param sampling_frequency: sampling frequency.
+        :param no_lines: number of lines of RF data.
+        :param z_focus: focal depth of the probe.
+        :param image_width: width of the imaged area, in [m].
+        :return: RF data (samples, no_lines), which starts at t=0, and a
+            vector including start time of each scanline.
+        """
+        raise NotImplementedError
+
+    def simulate_linear_array_batch(
+        self,
+        point_positions, point_amplitudes, sampling_frequency,
+        no_lines=50, z_focus=60/1000, image_width=40/1000
+    ):
+        """
+        Create RF data for many probe poses. By default, poses are simulated
+        one by one.
+
+        :param point_positions: list of (n_k, 3) points, one per pose.
+        :param point_amplitudes: list of (n_k, 1) amplitudes, one per pose.
+        :param sampling_frequency: sampling frequency.
+        :param no_lines: number of lines of RF data.
+        :param z_focus: focal depth of the probe, a single value or one per
+            pose.
+        :param image_width: width of the imaged area, in [m].
+        :return: (N, samples, no_lines) RF data, zero padded to the longest
+            pose, and (N, no_lines) start times of the scanlines.
+        """
+        z_focus = np.broadcast_to(z_focus, (len(point_positions),))
+        results = [self.simulate_linear_array(
+                       points, amps, sampling_frequency,
+                       no_lines=no_lines, z_focus=focus, image_width=image_width)
+                   for points, amps, focus in zip(point_positions, point_amplitudes, z_focus)]
+        return stack_rf_arrays([rf for rf, _ in results]), np.array([t for _, t in results])
+
+    def submit(
+        self,
+        point_positions, point_amplitudes, sampling_frequency,
+        no_lines=50, z_focus=60/1000, image_width=40/1000,
+        priority=PRIORITY_DEFAULT, owner=None, on_scanlines=None, lines=None
+    ):
+        """
+        Start creating RF data, without waiting for the result. By default,
+        RF data is created at once. Parameters are the same as in
+        'simulate_linear_array'.
+
+        :param priority: priority of the request, e.g. PRIORITY_PREFETCH.
+        :param owner: who submits the request (e.g. a client of the
+            simulation server), requests of the same priority are served
+            fairly between the owners.
+        :param on_scanlines: function called with (first line, (samples, k)
+            data) of the scanlines which are ready before the whole result
+            (e.g. ScanlineStream.add_scanlines), or None. It must return
+            quickly. By default, it is not called and all the scanlines
+            come with the result.
+        :param lines: indices (from 0) of the scanlines which are needed, or
+            None for all of them. The other scanlines may be left empty
+            (zeros, start time 0), e.g. when they are in a ScanlineCache.
+            By default, all the scanlines are simulated.
+        :return: concurrent.futures.Future of (RF data, start times).
+        """
+        return _run_now(
+            self.simulate_linear_array,
+            point_positions, point_amplitudes, sampling_frequency,
+            no_lines=no_lines, z_focus=z_focus, image_width=image_width)
+
+    def submit_batch(
+        self,
+        point_positions, point_amplitudes, sampling_frequency,
+        no_lines=50, z_focus=60/1000, image_width=40/1000,
+        priority=PRIORITY_DEFAULT, owner=None
+    ):
+        """
+        Start creating RF data for many probe poses, without waiting for the
+        result. Parameters are the same as in 'simulate_linear_array_batch'.
+
+        :param priority: priority of the request.
+        :param owner: who submits the request.
+        :return: concurrent.futures.Future of (RF data, start times).
+        """
+        return _run_now(
+            self.simulate_linear_array_batch,
+            point_positions, point_amplitudes, sampling_frequency,
+            no_lines=no_lines, z_focus=z_focus, image_width=image_width)
+
+    def upload_phantom(self, point_positions, point_amplitudes):
+        """
+        Make the scatterers of a static phantom resident in the simulator, so
+        the requests of 'submit_pose' carry only the probe's pose.
+
+        :param point_positions: (n, 3) points, in the phantom's frame.
+        :param point_amplitudes: (n, 1) amplitudes of the points.
+        :return: id of the phantom.
+        """
+        phantom_id = len(self._phantoms)
+        self._phantoms[phantom_id] = (
+            np.asarray(point_positions, dtype=np.float64),
+            np.asarray(point_amplitudes, dtype=np.float64))
+        return phantom_id
+
+    def submit_pose(
+        self,
+        phantom_id, probe_pos, probe_angle, window, sampling_frequency,
+        no_lines=50, z_focus=60/1000, image_width=40/1000,
+        priority=PRIORITY_DEFAULT, owner=None, on_scanlines=None, lines=None
+    ):
+        """
+        Start creating RF data of a resident phantom seen from given probe
+        pose. By default, the field of view is cropped here and submitted.
+
+        :param phantom_id: id returned by 'upload_phantom'.
+        :param probe_pos: 3-D position of the probe.
+        :param probe_angle: angle of the probe, in degrees.
+        :param window: (x size, y size) of the probe's field of view [m].
+        :param on_scanlines: see 'submit'.
+        :param lines: see 'submit'.
+        :return: concurrent.futures.Future of (RF data, start times).
+        """
+        points, amps = get_fov_points(
+            *self._phantoms[phantom_id], probe_pos, probe_angle, window)
+        return self.submit(
+            points, amps, sampling_frequency,
+            no_lines=no_lines, z_focus=z_focus, image_width=image_width,
+            priority=priority, owner=owner, on_scanlines=on_scanlines, lines=lines)
+
+    def capture(
+        self,
+        point_positions, point_amplitudes, sampling_frequency,
+        no_lines=50, image_width=40/1000
+    ):
+        """
+        Simulate the channel data of a probe pose, which does not depend on
+        the focal depth: 'beamform' creates the RF data of the pose for any
+        focal depth, without simulating it again. Parameters are the same as
+        in 'simulate_linear_array'.
+
+        :return: ChannelData of the pose.
+        """
+        raise NotImplementedError
+
+    def capture_pose(
+        self,
+        phantom_id, probe_pos, probe_angle, window, sampling_frequency,
+        no_lines=50, image_width=40/1000
+    ):
+        """
+        Simulate the channel data of a resident phantom seen from given
+        probe pose, see 'capture' and 'submit_pose'.
+
+        :return: ChannelData of the pose.
+        """
+        points, amps = get_fov_points(
+            *self._phantoms[phantom_id], probe_pos, probe_angle, window)
+        return self.capture(
+            points, amps, sampling_frequency, no_lines=no_lines, image_width=image_width)
+
+    def beamform(self, channel_data, z_focus=60/1000):
+        """
+        Create RF data from the channel data of a pose.
+
+        :param channel_data: ChannelData returned by 'capture'.
+        :param z_focus: focal depth of the probe.
+        :return: the same as 'simulate_linear_array'.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def _get_output(self, rf_arrays, sampling_frequency):
+        """
+        :return: given (..., samples, no_lines) RF data cut to the depth
+            gate, or its I/Q data if iq_decimation is set.
+        """
+        if self.depth_gate is not None:
+            first, end = get_gate_samples(self.depth_gate, sampling_frequency, self.speed_of_sound)
+            rf_arrays = rf_arrays[..., :end, :]
+            if first > 0:
+                # The given data can be shared (e.g. cached), so it is not
+                # changed in place.
+                rf_arrays = rf_arrays.copy()
+                rf_arrays[..., :first, :] = 0
+        if self.iq_decimation is None:
+            return rf_arrays
+        return rf_to_iq(rf_arrays, sampling_frequency, self.center_frequency, self.iq_decimation)
+
+
+def _run_now(fn, *args, **kwargs):
+    """
+    :return: a finished future with the result (or exception) of fn call.
+    """
+    future = Future()
+    try:
+        future.set_result(fn(*args, **kwargs))
+    except Exception as ex:
+        future.set_exception(ex)
+    return future
+
+
+class _MappedFuture(Future):
+    """
+    Future of fn(*result) of another future. Cancelling it cancels the
+    other future.
+    """
+    def __init__(self, future, fn):
+        super().__init__()
+        self._future = future
+        self._fn = fn
+        future.add_done_callback(self._on_done)
+
+    def cancel(self):
+        return self._future.cancel()
+
+    def _on_done(self, future):
+        if future.cancelled():
+            super().cancel()
+            return
+        if future.exception() is not None:
+            self.set_exception(future.exception())
+            return
+        try:
+            self.set_result(self._fn(*future.result()))
+        except Exception as ex:
+            self.set_exception(ex)
+
+
+class ScanlineCache:
+    """
+    ScanlineCache: RF data of single scanlines, keyed by the phantom and
+    the geometry of the scanline in the phantom's frame: its origin, the
+    angle of the scanning plane and the focal depth. The probe's position
+    along its scanning plane is snapped to a grid of the line spacing
+    (image_width/no_lines), fixed in the phantom's frame, so a probe moved
+    along its scanning plane by any step sees most of its scanlines from the
+    previous pose, and only the new ones are simulated. The scanlines of a
+    pose are shifted by up to half of the line spacing then.
+
+    A move across the scanning plane (e.g. along the x axis, with the probe
+    rotated) changes all the scanlines. If elevation_spacing is given, the
+    position across the plane is snapped to a grid of this spacing as well,
+    so the scanlines are reused till the probe crosses to another cell of
+    the grid, at the cost of an error of up to half of the spacing in
+    elevation.
+
+    Cached scanlines are the ones simulated from the pose which saw them
+    first. The active aperture of a scanline is aligned to the elements of
+    the probe, and the field of view is cropped to the probe's window, so
+    they can differ slightly from a new simulation (mostly at the edges of
+    the window). The phantom has to be static.
+
+    :param max_lines: max number of scanlines kept, least recently used ones
+        are dropped first.
+    :param resolution: positions and focal depths are rounded to this [m].
+    :param elevation_spacing: spacing [m] of the grid of the probe's
+        position across its scanning plane, or None if it is not snapped.
+    """
+    def __init__(self, max_lines, resolution=1e-6, elevation_spacing=None):
+        self.max_lines = max_lines
+        self.resolution = resolution
+        self.elevation_spacing = elevation_spacing
+        # Key -> (samples, ) scanline, its start time.
+        self._lines = OrderedDict()
+        # Requests are merged by the simulator's threads as well.
+        self._lock = threading.Lock()
+
+    def snap(self, probe_pos, probe_angle, no_lines, image_width):
+        """
+        :return: given position of the probe, moved along its scanning plane
+            to the nearest multiple of the line spacing, and across it to the
+            nearest multiple of elevation_spacing, if it is given.
+        """
+        angle = np.radians(probe_angle)
+        grid = [((np.cos(angle), np.sin(angle)), image_width/no_lines)]
+        if self.elevation_spacing is not None:
+            grid.append(((-np.sin(angle), np.cos(angle)), self.elevation_spacing))
+        probe_pos = np.array(probe_pos, dtype=np.float64)
+        for direction, spacing in grid:
+            direction = np.array(direction)
+            pos = probe_pos[:2] @ direction
+            probe_pos[:2] += direction*(np.round(pos/spacing)*spacing - pos)
+        return probe_pos
+
+    def get_keys(self, phantom_id, probe_pos, probe_angle, z_focus, no_lines, image_width):
+        """
+        :return: keys of the scanlines of given (snapped) probe pose.
+        """
+        angle = np.radians(probe_angle)
+        line_xs = -image_width/2 + np.arange(no_lines)*image_width/no_lines
+        origins = np.asarray(probe_pos)[:2] + line_xs[:, None]*(np.cos(angle), np.sin(angle))
+        origins = np.round(origins/self.resolution).astype(int)
+        angle = int(round((probe_angle % 360)*1e3))
+        focus = int(round(z_focus/self.resolution))
+        return [(phantom_id, x, y, angle, focus) for x, y in origins]
+
+    def submit(self, submit, phantom_id, probe_pos, probe_angle, **kwargs):
+        """
+        Start creating RF data of given probe pose: the scanlines which are
+        not in the cache are requested from the simulator, then merged with
+        the cached ones.
+
+        :param submit: function which submits the request to the simulator,
+            e.g. Simulator.submit_pose with the angle given. It is called
+            with the snapped 'probe_pos', the 'lines' to simulate and the
+            rest of kwargs.
+        :param phantom_id: identity of the phantom, e.g. the id returned by
+            Simulator.upload_phantom.
+        :param probe_pos: 3-D position of the probe.
+        :param probe_angle: angle of the probe, in degrees.
+        :param kwargs: sampling_frequency, no_lines, z_focus, image_width
+            and the other parameters of the request.
+        :return: concurrent.futures.Future of (RF data, start times).
+        """
+        probe_pos = self.snap(probe_pos, probe_angle, kwargs["no_lines"], kwargs["image_width"])
+        keys = self.get_keys(
+            phantom_id, probe_pos, probe_angle, kwargs["z_focus"], kwargs["no_lines"],
+            kwargs["image_width"])
+        cached = self._lookup(keys)
+        lines = [i for i, key in enumerate(keys) if key not in cached]
+        if not lines:
+            return _run_now(self._merge, keys, cached, None, None)
+        return _MappedFuture(
+            submit(probe_pos=probe_pos, lines=lines, **kwargs),
+            lambda rf_array, t_start: self._merge(keys, cached, rf_array, t_start))
+
+    def clear(self):
+        with self._lock:
+            self._lines.clear()
+
+    def __len__(self):
+        return len(self._lines)
+
+    def _lookup(self, keys):
+        """
+        :return: key -> cached scanline of the given keys which are cached.
+        """
+        with self._lock:
+            cached = {}
+            for key in keys:
+                if key in self._lines:
+                    self._lines.move_to_end(key)
+                    cached[key] = self._lines[key]
+            return cached
+
+    def _merge(self, keys, cached, rf_array, t_start):
+        """
+        Store the simulated scanlines and merge them with the cached ones.
+
+        :return: RF data and start times of all the scanlines.
+        """
+        lines = []
+        with self._lock:
+            for i, key in enumerate(keys):
+                line = cached.get(key, None)
+                if line is None:
+                    line = (np.array(rf_array[:, i]), t_start[i])
+                    self._lines[key] = line
+                    self._lines.move_to_end(key)
+                lines.append(line)
+            while len(self._lines) > self.max_lines:
+                self._lines.popitem(last=False)
+        rf_array = stack_rf_arrays([scanline[:, None] for scanline, _ in lines])
+        return rf_array[..., 0].T, np.array([t for _, t in lines])
+
+
+def stack_rf_arrays(rf_arrays):
+    """
+    Stacks RF arrays of different lengths (all starting at t=0).
+
+    :param rf_arrays: list of (samples_k, no_lines) arrays.
+    :return: (N, max samples, no_lines) array, zero padded at the end.
+    """
+    no_samples = max(rf.shape[0] for rf in rf_arrays)
+    stack = np.zeros((len(rf_arrays), no_samples, rf_arrays[0].shape[1]),
+                     dtype=np.result_type(*rf_arrays))
+    for i, rf in enumerate(rf_arrays):
+        stack[i, :rf.shape[0]] = rf
+    return stack
+
+
+class FarFieldSimulator(Simulator):
+    """
+    FarFieldSimulator: A pure NumPy/SciPy linear array simulator.
+    Uses the same transducer as 'simulate_linear_array.m' and a narrowband
+    far-field approximation of the spatial impulse response: for every
+    scanline, the two-way field of the focused, apodized active aperture is
+    evaluated at each scatterer at the center frequency, and the received
+    pulse is delayed by the round trip time from the center of the aperture.
+
+    :param f0: transducer center frequency [Hz].
+    :param c: speed of sound [m/s].
+    :param element_width: width of an element [m]. If None, the wavelength
+        is used.
+    :param element_height: height of an element [m].
+    :param kerf: kerf [m].
+    :param n_elements: number of physical elements.
+    :param n_active: number of active elements.
+    :param iq_decimation: see Simulator.
+    :param depth_gate: see Simulator.
+
+    The responses of the scatterers at the elements do not depend on the
+    focal depth, so the channel data of a pose can be captured once (see
+    'capture') and beamformed for any focal depth: delay-and-sum with the
+    focusing delays applied as phase shifts at the center frequency.
+    Channel data takes n_active*no_lines complex64 values per scatterer.
+    """
+    supports_capture = True
+
+    def __init__(
+        self,
+        f0=3.5e6,
+        c=1540,
+        element_width=None,
+        element_height=5/1000,
+        kerf=0.05/1000,
+        n_elements=192,
+        n_active=64,
+        iq_decimation=None,
+        depth_gate=None
+    ):
+        super().__init__(
+            iq_decimation=iq_decimation, center_frequency=f0, depth_gate=depth_gate, speed_of_sound=c)
+        self.f0 = f0
+        self.c = c
+        self.wavelength = c/f0
+        self.element_width = self.wavelength if element_width is None else element_width
+        self.element_height = element_height
+        self.kerf = kerf
+        self.n_elements = n_elements
+        self.n_active = n_active
+        self.pitch = self.element_width + self.kerf
+        self.element_xs = (np.arange(n_elements) - (n_elements-1)/2)*self.pitch
+        self.apodization = _hanning(n_active).astype(np.float32)
+        self._pulses = {}
+
+    def simulate_linear_array(
+        self,
+        point_positions, point_amplitudes, sampling_frequency,
+        no_lines=50, z_focus=60/1000, image_width=40/1000
+    ):
+        """
+        Create RF data.
+
+        :param point_positions: (n, 3) points used to generate the RF data.
+        :param point_amplitudes: (n, 1) amplitudes of the points used.
+        :param sampling_frequency: sampling frequency.
+        :param no_lines: number of lines of RF data.
+        :param z_focus: focal depth of the probe.
+        :param image_width: width of the imaged area, in [m].
+        :return: RF data (or I/Q data, see Simulator) and a vector
+            including start time of each scanline.
+        """
+        fs = sampling_frequency
+        points, amps = self._get_points(point_positions, point_amplitudes)
+        if points.shape[0] == 0:
+            return self._get_empty_output(fs, no_lines)
+        delays = []
+        weights = []
+        for x in self._get_line_xs(no_lines, image_width):
+            elem_xs = self._get_active_elements(x)
+            responses, ranges, elevation = self._get_element_responses(points, elem_xs, x)
+            tau, g = self._focus(responses, ranges, elem_xs, z_focus)
+            delays.append(tau)
+            weights.append(amps*elevation**2*g)
+        return self._sum_echoes(np.array(delays), np.array(weights), fs)
+
+    def capture(
+        self,
+        point_positions, point_amplitudes, sampling_frequency,
+        no_lines=50, image_width=40/1000
+    ):
+        """
+        Simulate the channel data of a probe pose, see Simulator.capture.
+
+        :return: ChannelData of the pose.
+        """
+        points, amps = self._get_points(point_positions, point_amplitudes)
+        element_xs, responses, ranges, amplitudes = [], [], [], []
+        for x in self._get_line_xs(no_lines, image_width):
+            elem_xs = self._get_active_elements(x)
+            line_responses, line_ranges, elevation = self._get_element_responses(points, elem_xs, x)
+            element_xs.append(elem_xs)
+            responses.append(line_responses)
+            ranges.append(line_ranges)
+            amplitudes.append(amps*elevation**2)
+        return ChannelData(
+            responses=np.array(responses, dtype=np.complex64).reshape(no_lines, self.n_active, -1),
+            element_xs=np.array(element_xs),
+            ranges=np.array(ranges).reshape(no_lines, -1),
+            amplitudes=np.array(amplitudes).reshape(no_lines, -1),
+            sampling_frequency=sampling_frequency
+        )
+
+    def beamform(self, channel_data, z_focus=60/1000):
+        """
+        Create RF data from the channel data of a pose, focused at given
+        depth, see Simulator.beamform.
+
+        :return: RF data (or I/Q data, see Simulator) and a vector
+            including start time of each scanline.
+        """
+        fs = channel_data.sampling_frequency
+        no_lines = channel_data.responses.shape[0]
+        if channel_data.responses.shape[2] == 0:
+            return self._get_empty_output(fs, no_lines)
+        delays = []
+        weights = []
+        for responses, elem_xs, ranges, amps in zip(*channel_data[:4]):
+            tau, g = self._focus(responses, ranges, elem_xs, z_focus)
+            delays.append(tau)
+            weights.append(amps*g)
+        return self._sum_echoes(np.array(delays), np.array(weights), fs)
+
+    def _get_points(self, point_positions, point_amplitudes):
+        """
+        :return: (n, 3) points and (n,) amplitudes, without the points culled
+            by the depth gate.
+        """
+        points = np.asarray(point_positions, dtype=np.float64).reshape(-1, 3)
+        amps = np.asarray(point_amplitudes, dtype=np.float64).flatten()
+        if self.depth_gate is not None:
+            points, amps = cull_points(
+                points, amps, self.depth_gate, self.n_elements*self.pitch/2)
+            amps = amps.flatten()
+        return points, amps
+
+    def _get_line_xs(self, no_lines, image_width):
+        d_x = image_width/no_lines
+        return -image_width/2 + np.arange(no_lines)*d_x
+
+    def _get_empty_output(self, fs, no_lines):
+        pulse = self._get_pulse(fs)
+        return self._get_output(np.zeros((pulse.shape[0], no_lines)), fs), np.zeros(no_lines)
+
+    def _sum_echoes(self, delays, weights, fs):
+        """
+        Sum the pulses echoed by the scatterers.
+
+        :param delays: (no_lines, n) round trip times of the scatterers.
+        :param weights: (no_lines, n) complex amplitudes of the echoes.
+        :return: RF data (or I/Q data) and start times of the scanlines.
+        """
+        pulse = self._get_pulse(fs)
+        no_lines = delays.shape[0]
+        # Round trip times are rounded to the sampling grid, the residual is
+        # compensated in the phase of the carrier.
+        idx = np.round(delays*fs).astype(int)
+        weights = weights*np.exp(-2j*np.pi*self.f0*(delays - idx/fs))
+        no_samples = idx.max() + pulse.shape[0]
+        impulses = np.zeros((no_samples, no_lines), dtype=np.complex128)
+        np.add.at(impulses, (idx, np.arange(no_lines)[:, None]), weights)
+        n_fft = fft.next_fast_len(no_samples + pulse.shape[0] - 1)
+        rf_array = np.real(fft.ifft(
+            fft.fft(impulses, n_fft, axis=0)*fft.fft(pulse, n_fft)[:, None],
+            axis=0)[:no_samples])
+        t_start = idx.min(axis=1)/fs
+        return self._get_output(rf_array, fs), t_start
+
+    def _get_active_elements(self, x):
+        """
+        :return: positions of the active elements of the scanline at x,
+            w.r.t. the scanline.
+        """
+        n_pre = int(round(x/self.pitch + self.n_elements/2 - self.n_active/2))
+        n_pre = min(max(n_pre, 0), self.n_elements - self.n_active)
+        return self.element_xs[n_pre:n_pre+self.n_active] - x
+
+    def _get_element_responses(self, points, elem_xs, x):
+        """
+        Responses of the points at the active elements of the scanline at x,
+        which do not depend on the focal depth.
+
+        :return: (n_active, n) complex responses relative to the center of
+            the aperture, distances of the points from the center and the
+            directivity of the elements in elevation.
+        """
+        k = 2*np.pi/self.wavelength
+        dx = points[:, 0] - x
+        yz2 = points[:, 1]**2 + points[:, 2]**2
+        r_center = np.sqrt(dx**2 + yz2)
+        r = np.sqrt((dx[None, :] - elem_xs[:, None])**2 + yz2[None, :])
+        # Far-field amplitude, the phase is evaluated per element.
+        phase = (k*(r - r_center[None, :])).astype(np.float32)
+        responses = np.cos(phase) - 1j*np.sin(phase)
+        elevation = np.sinc(self.element_height*points[:, 1]/(self.wavelength*r_center))
+        return responses, r_center, elevation
+
+    def _focus(self, responses, r_center, elem_xs, z_focus):
+        """
+        Two-way response of the active aperture focused at (x, 0, z_focus):
+        the responses of the elements are delayed (phase shifted) by the
+        focusing delays, apodized and summed.
+
+        :return: round trip times and complex two-way field for each point.
+        """
+        k = 2*np.pi/self.wavelength
+        # Focusing delays [m] of the active elements.
+        delays = z_focus - np.sqrt(elem_xs**2 + z_focus**2)
+        focusing = (self.apodization*np.exp(-1j*k*delays)).astype(np.complex64)
+        field = (focusing@responses)/r_center
+        return 2*r_center/self.c, field**2
+
+    def _get_pulse(self, fs):
+        """
+        Two-way pulse: excitation convolved with the transmit and receive
+        impulse responses, as analytic signal.
+        """
+        if fs not in self._pulses:
+            t = np.arange(0, 2/self.f0 + 1/(2*fs), 1/fs)
+            excitation = np.sin(2*np.pi*self.f0*t)
+            impulse_response = excitation*_hanning(t.shape[0])
+            pulse = np.convolve(np.convolve(excitation, impulse_response), impulse_response)
+            self._pulses[fs] = signal.hilbert(pulse/np.max(np.abs(pulse)))
+        return self._pulses[fs]
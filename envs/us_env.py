@@ -1,17 +1,39 @@
+import hashlib
 import math
+import os
 import numpy as np
 import gym
 import json
 from gym import spaces
 from envs.generator import ConstPhantomGenerator
 from envs.fieldii import Field2
+from envs.simulator import PRIORITY_PREFETCH, ScanlineCache, _run_now
+from envs.utils import copy_and_apply, to_string
 import matplotlib.pyplot as plt
 import matplotlib.ticker
 from mpl_toolkits.mplot3d import Axes3D
 import logging
+from collections import namedtuple, OrderedDict
 
 _LOGGER = logging.getLogger(__name__)
 
+
+# Entry of the saved cache file with the signature of the imaging system
+# which created its observations (see ImagingSystem.get_signature).
+CACHE_IMAGING_KEY = "imaging"
+
+
+PendingObservation = namedtuple("PendingObservation", [
+    # Cache key of the probe state, None if cache is not used.
+    "state",
+    # Future of the (rf_array, t_start) simulation result, None if
+    # the observation is in the cache already.
+    "rf_future",
+    # ScanlineStream imaging the scanlines as they arrive, None if
+    # streaming is not used.
+    "stream"
+], defaults=[None])
+
 class PhantomUsEnv(gym.Env):
     """
     Ultrasound environment of the Phantom.
@@ -21,6 +43,9 @@ class PhantomUsEnv(gym.Env):
     :param probe_generator: probe generator instance used (constant or random).
     :param max_steps: max number of steps executed per episode.
     :param no_workers: number of workers used in the Field2 session.
+    :param simulator: simulator instance used to generate the RF data
+        (e.g. FarFieldSimulator). If None, a Field2 session with
+        'no_workers' workers is started.
     :param step_size: step size to move in x,y axes.
     :param focal_step: step size 
     :param rot_deg: rotation step size.
@@ -29,11 +54,51 @@ class PhantomUsEnv(gym.Env):
     :param use_cache: whether to use cache memory. If parameter is string
         type, cache is loaded from 'cache_memory.npz' file. Else if parameter
         is boolean type, if cache is used it will be initiliazed as empty dict.
+        A cache file saved by another imaging system (other parameters or
+        version of the pipeline) is not used, see 'save_cache'.
     :param reward_params: reward singal parameters value.
     :param noise_prob: propability to apply noise (value in [0, 1]).
     :param max_probe_dislocation: max number of steps to apply as noise.
     :param noise_seed: seed given to noise application.
     :param trajectory_logger: trajectory logger instance.
+    :param use_prefetch: whether to simulate the not cached probe states
+        reachable with a single action in the background, while the agent
+        decides (requires cache and an asynchronous simulator, e.g. Field2).
+    :param use_resident_phantom: whether the phantom's scatterers are
+        uploaded to the simulator once (see
+        ScatterersPhantom.get_static_points), so simulation requests carry
+        only the probe's pose. Speckle is fixed in the phantom's frame then.
+        Can be used with ConstPhantomGenerator only.
+    :param use_streaming: whether the observations are imaged scanline by
+        scanline, while the rest of the frame is simulated (see
+        ScanlineStream). Simulators which return whole frames only are
+        imaged when the frame is done.
+    :param use_synthetic_aperture: whether the channel data of each lateral
+        probe pose (x, y, angle) is captured once (see Simulator.capture) and
+        beamformed for the requested focal depth, so moving the focal point
+        does not require a new simulation. Requires a simulator which
+        supports capture (e.g. FarFieldSimulator).
+    :param channel_cache_size: max number of lateral poses, which channel
+        data is kept for (least recently used ones are dropped first).
+    :param use_scanline_cache: whether the RF data of single scanlines is
+        cached by their geometry in the phantom's frame (see ScanlineCache),
+        so only the scanlines which were not seen from the previous poses are
+        simulated. Probe positions are snapped to the line spacing for the
+        simulation, so the observations are shifted by up to half of it.
+        The x/y moves of a rotated probe cross its scanning plane, so its
+        scanlines are reused only if scanline_elevation_spacing is given.
+        Can be used with ConstPhantomGenerator only.
+    :param scanline_cache_size: max number of scanlines in the cache.
+    :param scanline_elevation_spacing: spacing [m] of the grid which the
+        probe's position across its scanning plane is snapped to, for the
+        scanline cache (see ScanlineCache), or None. The observations are
+        shifted by up to half of it in elevation.
+    :param use_rf_cache: whether the RF (or I/Q) data of each probe state is
+        cached as well, a tier below the B-mode cache (requires cache). The
+        B-mode images which are not in the cache are imaged from it, so the
+        imaging parameters can be changed without simulating again. If
+        'use_cache' is a string, RF data is loaded from 'rf_cache_memory.npz'
+        and the B-mode cache starts empty.
     """
 
     def __init__(
@@ -53,11 +118,31 @@ class PhantomUsEnv(gym.Env):
         max_probe_dislocation=None,
         noise_seed=None,
         trajectory_logger=None,
+        simulator=None,
+        use_prefetch=False,
+        use_resident_phantom=False,
+        use_streaming=False,
+        use_synthetic_aperture=False,
+        channel_cache_size=8,
+        use_scanline_cache=False,
+        scanline_cache_size=2048,
+        scanline_elevation_spacing=None,
+        use_rf_cache=False,
     ):
         # Cache is used only with ConstPhantomGenerator.
         if use_cache and not isinstance(phantom_generator, ConstPhantomGenerator):
             raise ValueError("Cache can be used with %s instances only." %
                              ConstPhantomGenerator.__name__)
+        if use_prefetch and not use_cache:
+            raise ValueError("Prefetching requires cache.")
+        if use_rf_cache and not use_cache:
+            raise ValueError("RF cache requires cache.")
+        if use_resident_phantom and not isinstance(phantom_generator, ConstPhantomGenerator):
+            raise ValueError("Resident phantom can be used with %s instances only." %
+                             ConstPhantomGenerator.__name__)
+        if use_scanline_cache and not isinstance(phantom_generator, ConstPhantomGenerator):
+            raise ValueError("Scanline cache can be used with %s instances only." %
+                             ConstPhantomGenerator.__name__)
 
         self.phantom, self.probe = None, None
         self.phantom_generator = phantom_generator
@@ -76,17 +161,67 @@ class PhantomUsEnv(gym.Env):
         self.out_of_bounds = None
         self.current_observation = None
         self.last_error = None
-        self.field_session = Field2(no_workers=no_workers)
+        if simulator is None:
+            simulator = Field2(no_workers=no_workers)
+        self.field_session = simulator
+        self.use_prefetch = use_prefetch
+        if self.use_prefetch and not self.field_session.asynchronous:
+            _LOGGER.warning("%s simulates requests at once, prefetching is disabled." %
+                            type(self.field_session).__name__)
+            self.use_prefetch = False
+        # Whether the neighbours are prefetched after each step (and reset).
+        # Off when they are prefetched by the caller instead, e.g. ordered by
+        # the policy (see PrefetchCallback).
+        self.prefetch_on_step = True
+        # Cache key of the probe state -> future of its prefetched RF data.
+        self._prefetching = {}
+        self.use_resident_phantom = use_resident_phantom
+        # Phantom uploaded to the simulator and its id.
+        self._resident_phantom, self._phantom_id = None, None
+        self.use_streaming = use_streaming
+        self.use_synthetic_aperture = use_synthetic_aperture
+        if self.use_synthetic_aperture and not self.field_session.supports_capture:
+            raise ValueError("%s does not support synthetic aperture capture." %
+                             type(self.field_session).__name__)
+        self.channel_cache_size = channel_cache_size
+        # Lateral pose -> channel data of the pose, of the phantom below.
+        self._channel_cache = OrderedDict()
+        self._channel_phantom = None
+        self.scanline_cache = None
+        if use_scanline_cache:
+            self.scanline_cache = ScanlineCache(
+                max_lines=scanline_cache_size, elevation_spacing=scanline_elevation_spacing)
+        # Phantom of the last request to the scanline cache, and its key.
+        self._scanline_phantom, self._scanline_phantom_id = None, None
         self.use_cache = use_cache
+        self.use_rf_cache = use_rf_cache
         self.reward_params = reward_params
         if self.use_cache:
+            # Cache key of the probe state -> its RF (or I/Q) data.
+            self.rf_cache = {}
             if isinstance(self.use_cache, bool):
                 self.cache = {}
+            elif isinstance(self.use_cache, str) and self.use_rf_cache:
+                try:
+                    self.rf_cache = dict(np.load('rf_cache_memory.npz'))
+                except FileNotFoundError:
+                    raise Exception('The RF cache file specified does not exist.')
+                # Images of the loaded RF data are created with the current
+                # imaging parameters.
+                self.cache = {}
             elif isinstance(self.use_cache, str):
                 try:
-                    self.cache = np.load('cache_memory.npz')
+                    cache = dict(np.load('cache_memory.npz'))
                 except: 
                     raise Exception('The cache file specified does not exist.')
+                signature = cache.pop(CACHE_IMAGING_KEY, None)
+                if signature is None or str(signature) != self.imaging.get_signature():
+                    _LOGGER.warning("The cache file was saved by another imaging system, "
+                                    "its observations are not used.")
+                    cache = {}
+                # Observations of the cache have the imaging's dtype.
+                self.cache = {state: self.imaging.convert(bmode)
+                              for state, bmode in cache.items()}
 
         self.action_space = spaces.Discrete(len(self._get_action_map()))
         observation_shape = (
@@ -94,11 +229,12 @@ class PhantomUsEnv(gym.Env):
             self.imaging.image_resolution[1],
             self.imaging.image_resolution[0]
             )
+        # Quantized observations are images, which SB3 normalizes itself.
         self.observation_space = spaces.Box(
             low=0,
-            high=1,
+            high=1 if self.imaging.is_float() else 255,
             shape=observation_shape,
-            dtype=np.float64)
+            dtype=self.imaging.dtype)
         self.metadata = {
             'render.modes': ['rgb_array']
         }
@@ -155,12 +291,19 @@ class PhantomUsEnv(gym.Env):
         _LOGGER.debug("Restarting environment.")
         self.phantom = next(self.phantom_generator)
         self.probe = next(self.probe_generator)
+        if self.use_resident_phantom and self.phantom is not self._resident_phantom:
+            points, amps = self.phantom.get_static_points(
+                window=(self.probe.width, self.probe.height))
+            self._phantom_id = self.field_session.upload_phantom(points, amps)
+            self._resident_phantom = self.phantom
         self.out_of_bounds = False
         self.last_error = self.get_error()
         self.current_step = 0
         self.current_episode += 1
         o = self._get_observation()
         self.current_observation = o
+        if self.use_prefetch and self.prefetch_on_step:
+            self.prefetch_neighbours()
 
         if self.trajectory_logger is not None:
             self.trajectory_logger.restart(episode_nr=self.current_episode)
@@ -174,7 +317,9 @@ class PhantomUsEnv(gym.Env):
         """
         Perform action and move environment state to the next timestep.
         The sequence followed is:
-        perform action -> get_observation -> compute reward -> update_state -> log state
+        perform action -> start observation -> compute reward -> update_state
+            -> collect observation -> log state
+        The reward is computed while the observation is simulated.
 
         :param action: action to perform.
         :return: observation, reward, episode over?, diagnostic info
@@ -184,15 +329,18 @@ class PhantomUsEnv(gym.Env):
             raise RuntimeError("This episode is over, reset the environment.")
         self.current_step += 1
         self._perform_action(action)
-        o = self._get_observation()
-        
+        pending_observation = self.start_observation()
+
         reward = self._get_reward()
         # Apply noise to the current state.
         self._update_state(action)
 
+        o = self.collect_observation(pending_observation)
         self.current_observation = o
         info = dict(is_success = None)
         episode_over, info["is_success"] = self._check_termination_conditions()
+        if self.use_prefetch and self.prefetch_on_step and not episode_over:
+            self.prefetch_neighbours()
 
         if self.trajectory_logger is not None:
             self.trajectory_logger.log_action(
@@ -228,9 +376,20 @@ class PhantomUsEnv(gym.Env):
         else:
             super(PhantomUsEnv).render(mode=mode)
 
+    def save_cache(self, exp_dir):
+        """
+        Save the cache to 'cache_memory.npz' in given directory, with the
+        signature of the imaging system, and the RF cache to
+        'rf_cache_memory.npz' if it is used.
+        """
+        np.savez(os.path.join(exp_dir, 'cache_memory.npz'),
+                 **self.cache, **{CACHE_IMAGING_KEY: self.imaging.get_signature()})
+        if self.use_rf_cache:
+            np.savez(os.path.join(exp_dir, 'rf_cache_memory.npz'), **self.rf_cache)
+
     def close(self):
         """
-        Terminate a Field2 session.
+        Terminate the simulator session.
         """
         self.field_session.close()
 
@@ -334,11 +493,22 @@ class PhantomUsEnv(gym.Env):
         
         :return: new probe position and focal depth.
         """
-        pr_pos_x_l = (self.probe.pos[0] - self.probe.width/2) + x_t
-        pr_pos_x_r = (self.probe.pos[0] + self.probe.width/2) + x_t
-        pr_pos_y_l = (self.probe.pos[1] - self.probe.height/2) + y_t
-        pr_pos_y_r = (self.probe.pos[1] + self.probe.height/2) + y_t
-        pr_pos_z = self.probe.focal_depth + z_t
+        self.probe, out_of_bounds = self._get_moved_probe(self.probe, x_t, y_t, z_t)
+        if out_of_bounds:
+            self.out_of_bounds = True
+
+    def _get_moved_probe(self, probe, x_t, y_t, z_t):
+        """
+        Move given probe in the phantom. Moves which would place the probe
+        outside the phantom limits are cancelled.
+
+        :return: moved probe (a copy) and whether any move was cancelled.
+        """
+        pr_pos_x_l = (probe.pos[0] - probe.width/2) + x_t
+        pr_pos_x_r = (probe.pos[0] + probe.width/2) + x_t
+        pr_pos_y_l = (probe.pos[1] - probe.height/2) + y_t
+        pr_pos_y_r = (probe.pos[1] + probe.height/2) + y_t
+        pr_pos_z = probe.focal_depth + z_t
         x_border_l, x_border_r = self.phantom.x_border
         y_border_l, y_border_r = self.phantom.y_border
         z_border_l, z_border_r = self.phantom.z_border
@@ -351,20 +521,24 @@ class PhantomUsEnv(gym.Env):
         def ge(a, b):
             return a > b or math.isclose(a, b, rel_tol=rel_tol)
 
+        out_of_bounds = False
         if le(x_border_l, pr_pos_x_l) and ge(x_border_r, pr_pos_x_r):
-            self.probe = self.probe.translate(np.array([x_t, 0, 0]))
+            probe = probe.translate(np.array([x_t, 0, 0]))
         else:
-            self.out_of_bounds = True
+            out_of_bounds = True
         if le(y_border_l, pr_pos_y_l) and ge(y_border_r, pr_pos_y_r):
-            self.probe = self.probe.translate(np.array([0, y_t, 0]))
+            probe = probe.translate(np.array([0, y_t, 0]))
         else:
-            self.out_of_bounds = True 
+            out_of_bounds = True
         if le(z_border_l, pr_pos_z) and ge(z_border_r, pr_pos_z):
-            self.probe = self.probe.change_focal_depth(z_t)
+            probe = probe.change_focal_depth(z_t)
         else:
-            self.out_of_bounds = True
-        self.probe.pos = np.round(self.probe.pos, decimals=3)
-        self.probe.focal_depth = round(self.probe.focal_depth, ndigits=3)
+            out_of_bounds = True
+        probe = copy_and_apply(
+            probe, deep=True,
+            pos=np.round(probe.pos, decimals=3),
+            focal_depth=round(probe.focal_depth, ndigits=3))
+        return probe, out_of_bounds
 
     def _update_state(self, action):
         """
@@ -380,32 +554,211 @@ class PhantomUsEnv(gym.Env):
             self.probe.rotate(theta_t)
 
     def _get_observation(self):
+        return self.collect_observation(self.start_observation())
+
+    def start_observation(self):
+        """
+        Start rendering the observation of the current probe state, without
+        waiting for it. The simulator's field of view is taken now, so the
+        probe can be moved before the observation is collected.
+
+        .. warning:
+            When cache is used, assumes that objects in the phantom does not
+            move (are 'static').
+
+        :return: pending observation, to be given to 'collect_observation'.
+        """
+        state = None
         if self.use_cache:
-            return self._get_cached_observation()
+            self._store_prefetched()
+            state = str(self._get_cache_key(self.probe))
+            if state in self.cache:
+                _LOGGER.info("Using cached value for probe state (x, y, z, theta)=%s"
+                              % state)
+                return PendingObservation(state=state, rf_future=None)
+            if state in self.rf_cache:
+                _LOGGER.info("Using cached RF data for probe state (x, y, z, theta)=%s"
+                              % state)
+                return PendingObservation(state=state, rf_future=None)
+            rf_future = self._prefetching.pop(state, None)
+            # A prefetch which is in progress already is awaited, the one
+            # which is not started yet is submitted again with the default
+            # priority.
+            if rf_future is not None and not rf_future.cancel():
+                _LOGGER.info("Using prefetched value for probe state (x, y, z, theta)=%s"
+                              % state)
+                return PendingObservation(state=state, rf_future=rf_future)
+        stream = self.imaging.stream() if self.use_streaming else None
+        rf_future = self._submit_simulation(self.probe, stream=stream)
+        return PendingObservation(state=state, rf_future=rf_future, stream=stream)
+
+    def _submit_simulation(self, probe, priority=None, stream=None):
+        """
+        Start simulating the RF data seen by given probe.
+
+        :param priority: priority of the request, the simulator's default
+            if None.
+        :param stream: ScanlineStream which gets the scanlines as they
+            arrive, or None.
+        :return: future of the (rf_array, t_start) simulation result.
+        """
+        if self.use_synthetic_aperture:
+            return _run_now(self._beamform, probe)
+        kwargs = dict(
+            sampling_frequency=self.imaging.fs,
+            no_lines=self.imaging.no_lines,
+            z_focus=probe.focal_depth,
+            image_width=self.imaging.image_width)
+        if priority is not None:
+            kwargs["priority"] = priority
+        if stream is not None:
+            kwargs["on_scanlines"] = stream.add_scanlines
+
+        def submit(probe_pos, **kwargs):
+            if self.use_resident_phantom:
+                return self.field_session.submit_pose(
+                    self._phantom_id, probe_pos, probe.angle,
+                    window=(probe.width, probe.height), **kwargs)
+            points, amps, _ = probe.translate(probe_pos - probe.pos).get_fov(self.phantom)
+            return self.field_session.submit(points, amps, **kwargs)
+
+        if self.scanline_cache is None:
+            return submit(probe.pos, **kwargs)
+        if self.phantom is not self._scanline_phantom:
+            self._scanline_phantom = self.phantom
+            self._scanline_phantom_id = self._get_scanline_phantom_id()
+        return self.scanline_cache.submit(
+            submit, self._scanline_phantom_id, probe.pos, probe.angle, **kwargs)
+
+    def _get_scanline_phantom_id(self):
+        """
+        :return: identity of the phantom in the scanline cache: its id in the
+            simulator if it is resident, else a digest of its objects and
+            borders (its scatterers are drawn for each request then).
+        """
+        if self.use_resident_phantom:
+            return self._phantom_id
+        phantom = self.phantom
+        description = to_string((phantom.objects, phantom.x_border, phantom.y_border, phantom.z_border))
+        return hashlib.sha1(description.encode()).hexdigest()
+
+    def _beamform(self, probe):
+        """
+        Create the RF data seen by given probe from the channel data of its
+        lateral pose, which is captured if it is not in the cache.
+
+        :return: (rf_array, t_start) simulation result.
+        """
+        if self.phantom is not self._channel_phantom:
+            self._channel_cache.clear()
+            self._channel_phantom = self.phantom
+        key = self._get_cache_key(probe)
+        key = (key[0], key[1], key[3])
+        channel_data = self._channel_cache.get(key, None)
+        if channel_data is None:
+            kwargs = dict(
+                sampling_frequency=self.imaging.fs,
+                no_lines=self.imaging.no_lines,
+                image_width=self.imaging.image_width)
+            if self.use_resident_phantom:
+                channel_data = self.field_session.capture_pose(
+                    self._phantom_id, probe.pos, probe.angle,
+                    window=(probe.width, probe.height), **kwargs)
+            else:
+                points, amps, _ = probe.get_fov(self.phantom)
+                channel_data = self.field_session.capture(points, amps, **kwargs)
+            self._channel_cache[key] = channel_data
+            while len(self._channel_cache) > self.channel_cache_size:
+                self._channel_cache.popitem(last=False)
         else:
-            return self._get_image() 
+            self._channel_cache.move_to_end(key)
+        return self.field_session.beamform(channel_data, z_focus=probe.focal_depth)
 
-    def _get_cached_observation(self):
+    def collect_observation(self, pending_observation):
         """
-        .. warning:
-            Assumes that objects in the phantom does not move (are 'static').
-        
-        :return: a previously observed state from cache.
+        Wait for the RF data of a pending observation and image it.
+
+        :param pending_observation: value returned by 'start_observation'.
+        :return: bmode image
         """
-        state = (
-            int(round(self.probe.pos[0], 3)*1e3),
-            int(round(self.probe.pos[1], 3)*1e3),
-            int(round(self.probe.focal_depth, 3)*1e3),
-            int(round(self.probe.angle))
+        state, rf_future, stream = pending_observation
+        if rf_future is None:
+            if state not in self.cache:
+                self.cache[state] = self._to_bmode(self.rf_cache[state])
+            return self.cache[state]
+        rf_array, _ = rf_future.result()
+        bmode = self._to_bmode(rf_array, stream)
+        if state is not None:
+            self._store(state, rf_array, bmode)
+        return bmode
+
+    def prefetch_neighbours(self, action_probabilities=None):
+        """
+        Start simulating the observations of the probe states reachable from
+        the current one with a single action, which are not in the cache
+        yet. Requests have low priority, so only the workers which would be
+        idle otherwise are used. Prefetches which are not started yet are
+        submitted again in the new order.
+
+        :param action_probabilities: probabilities of the actions in the
+            current state (e.g. given by the policy), the states of more
+            probable actions are simulated first. If None, actions are taken
+            in order.
+        """
+        if not self.use_prefetch:
+            return
+        self._store_prefetched()
+        for state, rf_future in list(self._prefetching.items()):
+            if rf_future.cancel():
+                del self._prefetching[state]
+        actions = list(self._get_action_map())
+        if action_probabilities is not None:
+            actions.sort(key=lambda action: -action_probabilities[action])
+        for action in actions:
+            x_t, y_t, z_t, theta_t = self._get_action(action)
+            probe, out_of_bounds = self._get_moved_probe(self.probe, x_t, y_t, z_t)
+            if out_of_bounds:
+                continue
+            probe = probe.rotate(theta_t)
+            state = str(self._get_cache_key(probe))
+            if state in self.cache or state in self.rf_cache or state in self._prefetching:
+                continue
+            self._prefetching[state] = self._submit_simulation(probe, priority=PRIORITY_PREFETCH)
+
+    def _store_prefetched(self):
+        """
+        Move the finished prefetches to the cache.
+        """
+        for state, rf_future in list(self._prefetching.items()):
+            if not rf_future.done():
+                continue
+            del self._prefetching[state]
+            if rf_future.cancelled():
+                continue
+            if rf_future.exception() is not None:
+                _LOGGER.warning("Prefetching probe state %s failed: %s"
+                                % (state, rf_future.exception()))
+                continue
+            rf_array, _ = rf_future.result()
+            self._store(state, rf_array, self._to_bmode(rf_array))
+
+    def _store(self, state, rf_array, bmode):
+        """
+        Store the observation of a probe state in the cache, and its RF data
+        in the RF cache if it is used.
+        """
+        self.cache[state] = bmode
+        if self.use_rf_cache:
+            # A copy, the simulator's RF data can be a view of its buffer.
+            self.rf_cache[state] = np.array(rf_array)
+
+    def _get_cache_key(self, probe):
+        return (
+            int(round(probe.pos[0], 3)*1e3),
+            int(round(probe.pos[1], 3)*1e3),
+            int(round(probe.focal_depth, 3)*1e3),
+            int(round(probe.angle))
         )
-        state = str(state)
-        if state in self.cache:
-            _LOGGER.info("Using cached value for probe state (x, y, z, theta)=%s"
-                          % state)
-        else:
-            bmode = self._get_image()
-            self.cache[state] = bmode
-        return self.cache[state]
             
     def _check_termination_conditions(self):
         """
@@ -424,20 +777,17 @@ class PhantomUsEnv(gym.Env):
             success = self.is_episode_successful()
         return episode_over, success
 
-    def _get_image(self):
+    def _to_bmode(self, rf_array, stream=None):
         """
-        Feed probe's field of view to Field2 simulation.
-        
-        :return: bmode image
+        :param stream: ScanlineStream of the RF data, or None.
+        :return: bmode image of given RF (or I/Q) data, with a channel axis.
         """
-        points, amps, _ = self.probe.get_fov(self.phantom)
-        rf_array, _ = self.field_session.simulate_linear_array(
-            points, amps,
-            sampling_frequency=self.imaging.fs,
-            no_lines=self.imaging.no_lines,
-            z_focus=self.probe.focal_depth,
-            image_width=self.imaging.image_width)
-        bmode = self.imaging.image(rf_array)
+        if stream is not None:
+            bmode = stream.image(rf_array)
+        elif np.iscomplexobj(rf_array):
+            bmode = self.imaging.image_iq(rf_array)
+        else:
+            bmode = self.imaging.image(rf_array)
         bmode = bmode.reshape((1,)+bmode.shape)
         _LOGGER.debug("B-mode image shape: %s" % str(bmode.shape))
         return bmode
@@ -172,6 +172,15 @@ class Config:
                 f'Key "{key}" does not exist in config file!!!'
             )
         
+    def get_simulator_values(self, key):
+        try:
+            value = self.config_dict['env']['simulator'][key]
+            return value
+        except KeyError:
+            raise KeyError(
+                f'Key "{key}" does not exist in config file!!!'
+            )
+
     def get_env_values(self, key):
         try:
             value = self.config_dict['env'][key]